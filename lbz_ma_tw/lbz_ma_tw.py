@@ -1,122 +1,188 @@
 #!/usr/bin/env python3
 
+import asyncio
+import concurrent.futures
+import contextvars
 import datetime
-import os
+import functools
+import io
+import sys
 
-# TODO: remove import and create my own exception in twitter.py library
-import tweepy
+import requests
 
 import libs.lb_mb_data as lb_mb_data
+import libs.cassette as cassette
+import libs.collage as collage
 import libs.cons as cons
 import libs.download as download
-import libs.mastodon as mastodon
-import libs.twitter as twitter
+import libs.images as images
+import libs.ledger as ledger
+import libs.metrics as metrics
+import libs.profiler as profiler
+import libs.retry as retry
+import libs.scheduler as scheduler
+import libs.users as users
+# libs.mastodon and libs.twitter (with Mastodon.py and tweepy, the slowest imports by far) are only imported when a user
+# publishes to them, see _get_publishers()
 
 import libs.releases_to_twitter as releases_to_twitter
 
 
 # Functions
 #=======================================================================================================================
-def _filter_unverified_releases(plo_releases):
+def _get_cover_size(po_user):
     """
-    Function to remove unverified releases (releases without a proper MusicBrainz Id.) from a list.
-    :param plo_releases:
-    :type plo_releases: List[libs.lb_mb_data.Release]
+    Function to get the resolution of the covers to download for a user: the biggest one required by the enabled
+    publishers, so a single download is shared by all of them (each publisher scales it down later if needed).
 
-    :return:
-    :rtype: List[libs.lb_mb_data.Release]
+    :param po_user:
+    :type po_user: users.User
+
+    :return: Size in pixels, 0 for the original images.
+    :rtype: Int
     """
-    lo_verified_releases = [o_release for o_release in plo_releases if o_release.u_release_mbid]
-    return lo_verified_releases
+    if cons.b_COLLAGE:
+        return cons.i_COLLAGE_TILE
+
+    li_sizes = []
+    if po_user.b_mastodon:
+        li_sizes.append(cons.i_MA_IMAGE_SIZE)
+    if po_user.b_twitter:
+        li_sizes.append(cons.i_TW_IMAGE_SIZE)
+
+    if not li_sizes:
+        return cons.i_MA_IMAGE_SIZE
+    if 0 in li_sizes:
+        return 0
+    return max(li_sizes)
 
 
-def _filter_duplicated_releases(plo_releases):
+def _download_cover(po_release, pi_size=500):
     """
-    Function to remove duplicated releases (same id) from a list of releases.
+    Function to download the cover of a release.
 
-    :param plo_releases:
-    :type plo_releases: List[libs.lb_mb_data.Release]
+    :param po_release:
+    :type po_release: lb_mb_data.Release
 
-    :return:
-    :rtype List[libs.lb_mb_data.Release]
+    :param pi_size: Target resolution of the cover, the smallest thumbnail reaching it is downloaded (see
+                    images.get_thumbnail_url()).
+    :type pi_size: Int
+
+    :return: The data of the cover. None when the release has no cover or it couldn't be downloaded.
+    :rtype: Union[Bytes, None]
     """
-    # We need to keep the order, so mapping the objects to a dictionary where the unique key is the attribute we don't
-    # want to have repeated is not an option. So I need to use "cheap" workaround.
-    lu_used_keys = []
-    lo_filtered_releases = []
-    for o_release in plo_releases:
-        if o_release.u_release_mbid not in lu_used_keys:
-            lo_filtered_releases.append(o_release)
-            lu_used_keys.append(o_release.u_release_mbid)
+    b_cover = None
+    try:
+        u_url = images.get_thumbnail_url(po_release.lo_covers[0], pi_size)
+        b_cover = download.dl_bytes(u_url, pb_cache=True)
+    except (IndexError, KeyError, requests.exceptions.RequestException, retry.CircuitOpenError):
+        pass
 
-    return lo_filtered_releases
+    return b_cover
 
 
-def _tweet_releases(plo_releases, ps_period='month'):
+@metrics.timer('stage_download')
+def _download_covers(plo_releases, pi_size=500):
+    """
+    Function to download the covers of the releases, so the same data can be shared by all the publishers instead of
+    downloading every cover once per publisher.
+
+    :param plo_releases:
+    :type plo_releases: List[lb_mb_data.Release]
+
+    :param pi_size: Target resolution of the covers, see _download_cover().
+    :type pi_size: Int
+
+    :return: List with the data of each cover, in the same order as the releases. None for the releases without cover
+             or whose cover couldn't be downloaded.
+    :rtype: List[Union[Bytes, None]]
+    """
+    return [_download_cover(o_release, pi_size) for o_release in plo_releases]
+
+
+def _tweet_releases(plo_releases, plb_covers, ps_period='month', plx_media_ids=None, plb_images=None, po_user=None):
     """
     Function to tweet the popular releases.
 
+    :param po_user: User whose releases are tweeted.
+    :type po_user: users.User
+
     :param plo_releases:
     :type plo_releases: List[lb_mb_data.Release]
 
-    :return: True if the Tweet was sent, False otherwise
-    :rtype Bool
+    :param plb_covers: Data of the covers of each release (see _download_covers()).
+    :type plb_covers: List[Union[Bytes, None]]
+
+    :param plx_media_ids: Ids of the covers already uploaded to Twitter. When present, they are attached instead of
+                          uploading plb_covers.
+    :type plx_media_ids: List[Int]
+
+    :param plb_images: Images to be uploaded. If not specified, they are obtained from plb_covers (see
+                       collage.get_message_images()).
+    :type plb_images: List[Bytes]
+
+    :return: Tuple with the id of the Tweet (True in debug mode, False if it wasn't sent) and a report of the problems
+             found.
+    :rtype Tuple[Union[Int, Bool], Str]
     """
 
     # TODO: Find a way to indicate whether there were no releases found, so the empty tweet wasn't sent. Do the same as
     # it's done for toots.
-    b_tweet_sent = False
+    import libs.twitter as twitter
 
-    if plo_releases:
-        # Downloading the covers because tweepy can only post local files
-        #----------------------------------------------------------------
-        lu_cover_paths = []
+    x_tweet_sent = False
 
-        for i_release, o_release in enumerate(plo_releases, start=1):
-            # Tweepy only allows posting local images, so we have to download the covers
-            try:
-                u_url = o_release.lo_covers[0].du_thumbnails['large']
-                u_path = '/tmp/lb2twitter_cover_%s.jpg' % i_release
-                download.dl_file(u_url, u_path)
-                lu_cover_paths.append(u_path)
-
-            except KeyError:
-                pass
+    if plo_releases:
+        lb_images = []
+        if plx_media_ids is None:
+            lb_images = plb_images if plb_images is not None else collage.get_message_images(plb_covers)
 
         s_msg = releases_to_twitter.build_tweet_text(plo_releases=plo_releases,
                                                      ps_period=ps_period,
-                                                     ps_locale=cons.s_LOCALE)
-        b_tweet_sent = twitter.tweet(s_msg, plu_images=lu_cover_paths)
+                                                     ps_locale=po_user.s_locale,
+                                                     pi_max_length=cons.i_TW_MSG_LENGTH)
+        try:
+            x_tweet_sent = twitter.tweet(s_msg, plb_images=lb_images, pli_media_ids=plx_media_ids or (),
+                                         ptu_credentials=po_user.get_tw_credentials())
+        except twitter.AuthenticationError as o_exception:
+            raise RuntimeError(str(o_exception)) from None
 
-        # Deleting the files after sending the tweet
-        for u_file in lu_cover_paths:
-            os.remove(u_file)
+    return x_tweet_sent, ''
 
-    return b_tweet_sent
 
-
-def _toot_releases(plo_releases, ps_period='month'):
+def _toot_releases(plo_releases, plb_covers, ps_period='month', plx_media_ids=None, plb_images=None, po_user=None):
     """
     Function to tweet the popular releases.
 
+    :param po_user: User whose releases are tooted.
+    :type po_user: users.User
+
     :param plo_releases:
     :type plo_releases: List[lb_mb_data.Release]
 
-    :return: True if the Tweet was sent, False otherwise
-    :rtype Bool
+    :param plb_covers: Data of the covers of each release (see _download_covers()).
+    :type plb_covers: List[Union[Bytes, None]]
+
+    :param plx_media_ids: Ids of the covers already uploaded to Mastodon. When present, they are attached instead of
+                          uploading plb_covers.
+    :type plx_media_ids: List[Str]
+
+    :param plb_images: Images to be uploaded. If not specified, they are obtained from plb_covers (see
+                       collage.get_message_images()).
+    :type plb_images: List[Bytes]
+
+    :return: Tuple with the id of the Toot (True in debug mode, False if it wasn't sent) and a report of the problems
+             found.
+    :rtype Tuple[Union[Str, Bool], Str]
     """
+    import libs.mastodon as mastodon
 
-    b_toot_sent = False
+    x_toot_sent = False
     s_error_report = ''
 
     if plo_releases:
-        lu_cover_urls = []
-
-        for o_release in plo_releases:
-            try:
-                u_url = o_release.lo_covers[0].du_thumbnails['large']
-                lu_cover_urls.append(u_url)
-            except (IndexError, KeyError):
+        for o_release, b_cover in zip(plo_releases, plb_covers):
+            if b_cover is None:
                 s_error_report += f'\nMissing cover:\n' \
                                   f'  artist mbids: {o_release.lu_artist_mbids}\n' \
                                   f'  artist msid:  {o_release.u_artist_msid}\n' \
@@ -127,14 +193,232 @@ def _toot_releases(plo_releases, ps_period='month'):
 
         s_msg = releases_to_twitter.build_tweet_text(plo_releases=plo_releases,
                                                      ps_period=ps_period,
-                                                     ps_locale=cons.s_LOCALE)
-        b_toot_sent = mastodon.toot(ps_text=s_msg,
-                                    pls_images=lu_cover_urls,
-                                    ps_instance=cons.s_MA_INSTANCE,
-                                    ps_token=cons.s_MA_TOKEN,
+                                                     ps_locale=po_user.s_locale,
+                                                     pi_max_length=cons.i_MA_MSG_LENGTH)
+        lb_images = []
+        if plx_media_ids is None:
+            lb_images = plb_images if plb_images is not None else collage.get_message_images(plb_covers)
+
+        x_toot_sent = mastodon.toot(ps_text=s_msg,
+                                    plb_images=lb_images,
+                                    pls_media_ids=plx_media_ids or (),
+                                    ps_instance=po_user.s_ma_instance,
+                                    ps_token=po_user.s_ma_token,
                                     pb_debug=cons.b_DEBUG)
 
-    return b_toot_sent, s_error_report
+    return x_toot_sent, s_error_report
+
+
+def _get_publishers(po_user):
+    """
+    Function to get the enabled publishers of a user. Adding a new publisher only requires adding it here.
+
+    :param po_user:
+    :type po_user: users.User
+
+    :return: List of tuples with the name of the message (e.g. 'toot'), the function to send it (same signature as
+             _toot_releases()), the function to upload a cover to the platform (returning the media id), whether
+             the same media id can be attached to several messages and the maximum length of the messages.
+    :rtype: List[Tuple[Str, Callable, Callable, Bool, Int]]
+    """
+    ltx_publishers = []
+    if po_user.b_mastodon:
+        import libs.mastodon as mastodon
+        f_send = functools.partial(_toot_releases, po_user=po_user)
+        f_upload = functools.partial(mastodon.upload_image,
+                                     ps_instance=po_user.s_ma_instance,
+                                     ps_token=po_user.s_ma_token)
+        ltx_publishers.append(('toot', f_send, f_upload, mastodon.b_REUSABLE_MEDIA, cons.i_MA_MSG_LENGTH))
+    if po_user.b_twitter:
+        import libs.twitter as twitter
+        f_send = functools.partial(_tweet_releases, po_user=po_user)
+        f_upload = functools.partial(twitter.upload_image, ptu_credentials=po_user.get_tw_credentials())
+        ltx_publishers.append(('tweet', f_send, f_upload, twitter.b_REUSABLE_MEDIA, cons.i_TW_MSG_LENGTH))
+
+    return ltx_publishers
+
+
+def _get_pending_publishers(po_user, po_run):
+    """
+    Function to get the enabled publishers of a user whose message of a report hasn't been posted yet (by a previous
+    try of the same report, see ledger.Run).
+
+    :param po_user:
+    :type po_user: users.User
+
+    :param po_run: Stages of the report. None when the ledger is disabled, then all the publishers are pending.
+    :type po_run: Union[ledger.Run, None]
+
+    :return: Same as _get_publishers().
+    :rtype: List[Tuple[Str, Callable, Callable, Bool, Int]]
+    """
+    ltx_publishers = _get_publishers(po_user)
+    if po_run is None:
+        return ltx_publishers
+
+    return [tx_publisher for tx_publisher in ltx_publishers if po_run.get_status(tx_publisher[0]) is None]
+
+
+def _is_published(po_user, ps_period):
+    """
+    Function to know whether a report has already been posted to all the publishers of a user, by previous tries.
+
+    :param po_user:
+    :type po_user: users.User
+
+    :param ps_period: Period of the report, e.g. 'month'.
+    :type ps_period: Str
+
+    :rtype: Bool
+    """
+    o_run = ledger.get_run(po_user.u_lb_user, ps_period)
+    return o_run is not None and bool(_get_publishers(po_user)) and not _get_pending_publishers(po_user, o_run)
+
+
+def _upload_images(po_run, ps_name, pf_upload, plb_images):
+    """
+    Function to upload images to a publisher. The images uploaded by previous tries of the same report are not uploaded
+    again, and the new ones are recorded in the ledger as soon as they are uploaded.
+
+    :param po_run: Stages of the report. None when the ledger is disabled, then all the images are uploaded.
+    :type po_run: Union[ledger.Run, None]
+
+    :param ps_name: Name of the publisher, e.g. 'toot'.
+    :type ps_name: Str
+
+    :param pf_upload: Upload function of the publisher, see _get_publishers().
+    :type pf_upload: Callable
+
+    :param plb_images: Data of the images.
+    :type plb_images: List[Bytes]
+
+    :return: List with the media id of each image, or the exception raised when uploading it.
+    :rtype: List[Union[Str, Int, Exception]]
+    """
+    di_copies = {}
+    ls_keys = [ledger.get_media_key(b_image, di_copies) for b_image in plb_images]
+    dx_uploaded = po_run.get_media_ids(ps_name) if po_run is not None else {}
+    db_missing = {s_key: b_image for s_key, b_image in zip(ls_keys, plb_images) if s_key not in dx_uploaded}
+
+    dx_failed = {}
+    if db_missing:
+        with metrics.timer('stage_upload'), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=cons.i_UPLOAD_WORKERS) as o_executor:
+            lx_media_ids = list(o_executor.map(functools.partial(_upload_cover, pf_upload), db_missing.values()))
+
+        dx_new = {}
+        for s_key, x_media_id in zip(db_missing, lx_media_ids):
+            if isinstance(x_media_id, Exception):
+                dx_failed[s_key] = x_media_id
+            else:
+                dx_new[s_key] = x_media_id
+        if po_run is not None and dx_new:
+            po_run.add_media_ids(ps_name, dx_new)
+        dx_uploaded.update(dx_new)
+
+    return [dx_uploaded[s_key] if s_key in dx_uploaded else dx_failed[s_key] for s_key in ls_keys]
+
+
+def _send(po_run, ptx_publisher, plo_releases, plb_covers, ps_period, plx_media_ids=None, plb_images=None):
+    """
+    Function to send a message with a publisher, capturing any error. With the ledger enabled, the images are uploaded
+    here (so they are recorded, see _upload_images()) and the id of the message is recorded once it's posted.
+
+    :param po_run: Stages of the report. None when the ledger is disabled.
+    :type po_run: Union[ledger.Run, None]
+
+    :param ptx_publisher: The publisher, see _get_publishers().
+    :type ptx_publisher: Tuple[Str, Callable, Callable, Bool, Int]
+
+    :param plx_media_ids: Media ids of the covers already uploaded (or exceptions raised while uploading them).
+    :type plx_media_ids: Union[List, None]
+
+    :param plb_images: Images to be uploaded when plx_media_ids is None.
+    :type plb_images: List[Bytes]
+
+    :return: Tuple with the result text to be printed and the report of problems found.
+    :rtype: Tuple[Str, Str]
+    """
+    s_name, f_send, f_upload, b_reusable, i_max_length = ptx_publisher
+    s_report = ''
+    try:
+        if plx_media_ids is None and po_run is not None and plb_images:
+            plx_media_ids = _upload_images(po_run, s_name, f_upload, plb_images)
+
+        if plx_media_ids is not None:
+            for x_media_id in plx_media_ids:
+                if isinstance(x_media_id, Exception):
+                    raise x_media_id
+            plx_media_ids = [x_media_id for x_media_id in plx_media_ids if x_media_id is not None]
+
+        x_sent, s_report = f_send(plo_releases, plb_covers, ps_period, plx_media_ids, plb_images)
+        if x_sent and po_run is not None:
+            po_run.set_status(s_name, x_sent)
+        s_result = ' DONE!' if x_sent else ' FAILED!'
+    except Exception as o_exception:
+        s_result = ' ERROR! %s' % o_exception
+
+    return s_result, s_report
+
+
+@metrics.timer('stage_publish')
+def _publish(po_user, plo_releases, plb_covers, ps_period='month', pdlx_media_ids=None):
+    """
+    Function to send the message with all the enabled publishers at the same time. The results are printed in the usual
+    order once all of them have finished.
+
+    :param po_user:
+    :type po_user: users.User
+
+    :param plo_releases:
+    :type plo_releases: List[lb_mb_data.Release]
+
+    :param plb_covers: Data of the covers of each release (see _download_covers()).
+    :type plb_covers: List[Union[Bytes, None]]
+
+    :param pdlx_media_ids: Media ids of the covers already uploaded, indexed by publisher name. None (or a missing
+                           publisher) to let the publishers upload plb_covers.
+    :type pdlx_media_ids: Dict[Str, List]
+
+    :return: Nothing
+    """
+    ltx_publishers = _get_publishers(po_user)
+    dtu_results = {}
+    pdlx_media_ids = pdlx_media_ids or {}
+
+    # The messages already posted by previous tries of the report are not posted again
+    o_run = ledger.get_run(po_user.u_lb_user, ps_period)
+    ltx_pending = _get_pending_publishers(po_user, o_run)
+    ls_pending = [tx_publisher[0] for tx_publisher in ltx_pending]
+    for s_name, f_send, f_upload, b_reusable, i_max_length in ltx_publishers:
+        if s_name not in ls_pending:
+            dtu_results[s_name] = (' ALREADY SENT! (id %s)' % o_run.get_status(s_name), '')
+
+    if plo_releases and ltx_pending:
+        # The images to upload (e.g. a collage) are prepared just once for all the publishers
+        lb_images = None
+        if any(s_name not in pdlx_media_ids for s_name, f_send, f_upload, b_reusable, i_max_length in ltx_pending):
+            lb_images = collage.get_message_images(plb_covers)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ltx_pending)) as o_executor:
+            do_futures = {}
+            for tx_publisher in ltx_pending:
+                do_futures[tx_publisher[0]] = o_executor.submit(_send, o_run, tx_publisher, plo_releases, plb_covers,
+                                                                ps_period, pdlx_media_ids.get(tx_publisher[0]),
+                                                                lb_images)
+            dtu_results.update({s_name: o_future.result() for s_name, o_future in do_futures.items()})
+
+    for s_name, f_send, f_upload, b_reusable, i_max_length in ltx_publishers:
+        # The messages are memoized, so this is the same text the publisher has just sent
+        s_status_message = releases_to_twitter.build_tweet_text(plo_releases,
+                                                                ps_period=ps_period,
+                                                                ps_locale=po_user.s_locale,
+                                                                pi_max_length=i_max_length)
+        s_msg = 'Sending %s (%s characters)...' % (s_name, len(s_status_message))
+        s_result, s_report = dtu_results.get(s_name, (' SKIPPED!', ''))
+        print(s_msg.ljust(cons.i_WIDTH, '.') + s_result)
+        if s_report:
+            print(s_report)
 
 
 def _print_debug_msg():
@@ -145,8 +429,32 @@ def _print_debug_msg():
     if cons.b_DEBUG:
         u_msg = 'DEBUG INFORMATION\n'
         u_msg += '~~~~~~~~~~~~~~~~~\n'
+        u_msg += 'b_PROFILE:                %s\n' % cons.b_PROFILE
+        u_msg += 's_PROFILE_DIR:            %s\n' % cons.s_PROFILE_DIR
+        u_msg += 'f_PROFILE_INTERVAL:       %s\n' % cons.f_PROFILE_INTERVAL
+        u_msg += '\n'
         u_msg += 'i_DL_RETRIES:             %s\n' % cons.i_DL_RETRIES
         u_msg += 'i_DL_DELAY:               %s\n' % cons.i_DL_DELAY
+        u_msg += 'i_MB_WORKERS:             %s\n' % cons.i_MB_WORKERS
+        u_msg += 'f_MB_RATE:                %s\n' % cons.f_MB_RATE
+        u_msg += 'f_CAA_RATE:               %s\n' % cons.f_CAA_RATE
+        u_msg += 'i_MB_SEARCH_BATCH:        %s\n' % cons.i_MB_SEARCH_BATCH
+        u_msg += '\n'
+        u_msg += 'f_HTTP_CONNECT_TIMEOUT:   %s\n' % cons.f_HTTP_CONNECT_TIMEOUT
+        u_msg += 'f_HTTP_READ_TIMEOUT:      %s\n' % cons.f_HTTP_READ_TIMEOUT
+        u_msg += 'i_HTTP_POOLS:             %s\n' % cons.i_HTTP_POOLS
+        u_msg += 'i_HTTP_POOL_SIZE:         %s\n' % cons.i_HTTP_POOL_SIZE
+        u_msg += 'f_HTTP_RATE:              %s\n' % cons.f_HTTP_RATE
+        u_msg += 'f_RETRY_MAX_DELAY:        %s\n' % cons.f_RETRY_MAX_DELAY
+        u_msg += 'i_BREAKER_FAILURES:       %s\n' % cons.i_BREAKER_FAILURES
+        u_msg += 'f_BREAKER_COOLDOWN:       %s\n' % cons.f_BREAKER_COOLDOWN
+        u_msg += '\n'
+        u_msg += 's_CACHE_DIR:              %s\n' % cons.s_CACHE_DIR
+        u_msg += 'i_CACHE_TTL:              %s\n' % cons.i_CACHE_TTL
+        u_msg += 'i_CACHE_NEGATIVE_TTL:     %s\n' % cons.i_CACHE_NEGATIVE_TTL
+        u_msg += 'i_CACHE_SIZE:             %s\n' % cons.i_CACHE_SIZE
+        u_msg += 'i_CACHE_IMAGES:           %s\n' % cons.i_CACHE_IMAGES
+        u_msg += 's_LEDGER:                 %s\n' % cons.s_LEDGER
         u_msg += '\n'
         u_msg += 's_LOCALE:                 %s\n' % cons.s_LOCALE
         u_msg += '\n'
@@ -159,83 +467,680 @@ def _print_debug_msg():
         u_msg += 's_TW_ACCESS_TOKEN:        %s\n' % cons.s_TW_ACCESS_TOKEN
         u_msg += 's_TW_ACCESS_TOKEN_SECRET: %s\n' % cons.s_TW_ACCESS_TOKEN_SECRET
         u_msg += '\n'
+        u_msg += 'i_TW_MSG_LENGTH:          %s\n' % cons.i_TW_MSG_LENGTH
+        u_msg += 'i_MA_MSG_LENGTH:          %s\n' % cons.i_MA_MSG_LENGTH
+        u_msg += 'i_UPLOAD_WORKERS:         %s\n' % cons.i_UPLOAD_WORKERS
+        u_msg += 'i_TW_IMAGE_SIZE:          %s\n' % cons.i_TW_IMAGE_SIZE
+        u_msg += 'i_TW_IMAGE_BYTES:         %s\n' % cons.i_TW_IMAGE_BYTES
+        u_msg += 'i_MA_IMAGE_SIZE:          %s\n' % cons.i_MA_IMAGE_SIZE
+        u_msg += 'i_MA_IMAGE_BYTES:         %s\n' % cons.i_MA_IMAGE_BYTES
+        u_msg += 'i_IMAGE_QUALITY:          %s\n' % cons.i_IMAGE_QUALITY
+        u_msg += 'b_COLLAGE:                %s\n' % cons.b_COLLAGE
+        u_msg += 'i_COLLAGE_COLUMNS:        %s\n' % cons.i_COLLAGE_COLUMNS
+        u_msg += 'i_COLLAGE_TILE:           %s\n' % cons.i_COLLAGE_TILE
+        u_msg += 'i_COLLAGE_QUALITY:        %s\n' % cons.i_COLLAGE_QUALITY
+        u_msg += '\n'
         u_msg += 's_MA_INSTANCE:            %s\n' % cons.s_MA_INSTANCE
         u_msg += 's_MA_TOKEN:               %s\n' % cons.s_MA_TOKEN
+        u_msg += '\n'
+        u_msg += 's_METRICS_JSON:           %s\n' % cons.s_METRICS_JSON
+        u_msg += 's_METRICS_PROMETHEUS:     %s\n' % cons.s_METRICS_PROMETHEUS
+        u_msg += '\n'
+        u_msg += 'b_DAEMON:                 %s\n' % cons.b_DAEMON
+        u_msg += 'i_MSG_DAY:                %s\n' % cons.i_MSG_DAY
+        u_msg += 'i_MSG_HOUR:               %s\n' % cons.i_MSG_HOUR
+        u_msg += 'i_PREFETCH_HOURS:         %s\n' % cons.i_PREFETCH_HOURS
+        u_msg += 'i_PREFETCH_RELEASES:      %s\n' % cons.i_PREFETCH_RELEASES
+        u_msg += '\n'
+        u_msg += 's_USERS_FILE:             %s\n' % cons.s_USERS_FILE
+        u_msg += 'i_USER_WORKERS:           %s\n' % cons.i_USER_WORKERS
+        u_msg += '\n'
+        u_msg += 's_CASSETTE_MODE:          %s\n' % cons.s_CASSETTE_MODE
+        u_msg += 's_CASSETTE:               %s\n' % cons.s_CASSETTE
         u_msg += '~~~~~~~~~~~~~~~~~'
         print(u_msg)
 
 
-def _report(ps_period='month'):
+@metrics.timer('stage_releases')
+def _get_releases(po_user, ps_period='month', pi_wanted=None):
+    """
+    Function to get the top verified releases of a period from ListenBrainz, without their covers.
+
+    :param po_user:
+    :type po_user: users.User
+
+    :param ps_period: Period of the report, 'month' or 'year' (or any other ListenBrainz time range, e.g. 'this_month').
+    :type ps_period: Str
+
+    :param pi_wanted: Number of verified releases to get. LB_VERIFIED by default.
+    :type pi_wanted: Int
+
+    :return:
+    :rtype: List[lb_mb_data.Release]
+    """
     # Getting a high enough number of albums, so later we can keep enough verified ones
     #----------------------------------------------------------------------------------
-    s_msg = 'Fetching top %s releases from ListenBrainz...' % cons.i_LB_FETCH
-    s_msg = s_msg.ljust(cons.i_WIDTH, '.')
-    print(s_msg, end='')
-    lo_releases = lb_mb_data.get_lb_releases(pu_user=cons.s_LB_USER,
-                                             pi_count=cons.i_LB_FETCH,
-                                             pi_offset=0,
-                                             pu_time_range=ps_period)
-    print(' DONE!')
+    # The releases are lazily fetched (page by page, only while more verified ones are needed), filtered and sliced;
+    # covers are NOT fetched yet, so we don't waste requests on releases that are going to be discarded.
+    i_wanted = pi_wanted if pi_wanted is not None else cons.i_LB_VERIFIED
+    lo_releases = lb_mb_data.iter_lb_releases(pu_user=po_user.u_lb_user,
+                                              pi_count=cons.i_LB_FETCH,
+                                              pi_offset=0,
+                                              pu_time_range=ps_period,
+                                              pi_wanted=i_wanted)
 
     # Filtering duplicated entries
     #-----------------------------
-    # Somehow, listenbrainz sometimes points twice to the same release, so I filter out duplicated release URLs
-    lo_releases = _filter_duplicated_releases(lo_releases)
+    # Somehow, listenbrainz sometimes points twice to the same release, so the table keeps the first one of each
+    o_table = lb_mb_data.ReleaseTable()
+    o_table.extend(lo_releases, pi_verified=i_wanted)
 
     # Filtering out unverified albums (totally wanted side effect: Podcasts won't be taken into account)
     #---------------------------------------------------------------------------------------------------
-    s_msg = 'Filtering top %s verified releases...' % cons.i_LB_VERIFIED
-    s_msg = s_msg.ljust(cons.i_WIDTH, '.')
-    print(s_msg, end='')
-    lo_releases = _filter_unverified_releases(lo_releases)[:cons.i_LB_VERIFIED]
-    print(' DONE!')
+    return o_table.get_top(i_wanted)
 
-    # Showing the text (only the text, not the covers) of the tweet about to be sent
-    #-------------------------------------------------------------------------------
+
+def _get_max_length(po_user):
+    """
+    Function to get the maximum length of the messages of a user: the longest one allowed by its publishers.
+
+    :param po_user:
+    :type po_user: users.User
+
+    :rtype: Int
+    """
+    return max([i_max_length for s_name, f_send, f_upload, b_reusable, i_max_length in _get_publishers(po_user)] or
+               [cons.i_TW_MSG_LENGTH])
+
+
+def _print_status_message(plo_releases, ps_period='month', ps_locale='', pi_max_length=280):
+    """
+    Function to show the text (only the text, not the covers) of the message about to be sent.
+
+    :param plo_releases:
+    :type plo_releases: List[lb_mb_data.Release]
+
+    :param ps_period: Period of the report, 'month' or 'year'.
+    :type ps_period: Str
+
+    :param ps_locale: Locale of the message.
+    :type ps_locale: Str
+
+    :param pi_max_length: Maximum length of the message.
+    :type pi_max_length: Int
+
+    :return: The text of the message.
+    :rtype: Str
+    """
     print('\nMessage:\n')
-    s_status_message = releases_to_twitter.build_tweet_text(lo_releases,
+    s_status_message = releases_to_twitter.build_tweet_text(plo_releases,
                                                             ps_period=ps_period,
-                                                            ps_locale=cons.s_LOCALE)
+                                                            ps_locale=ps_locale,
+                                                            pi_max_length=pi_max_length)
     if s_status_message:
         s_msg = '\n'.join([f'  │ {s_line}' for s_line in s_status_message.splitlines(False)])
     else:
         s_msg = '(Sorry, empty list of albums, so empty tweet)'
     print(f'{s_msg}\n')
 
-    # Sending the toot
-    #-----------------
-    if cons.b_MASTODON:
-        s_msg = 'Sending toot (%s characters)...' % len(s_status_message)
+    return s_status_message
+
+
+def _get_resumed_releases(po_run):
+    """
+    Function to get the releases (with their covers) resolved by a previous try of a report, see ledger.Run.
+
+    :param po_run: Stages of the report. None when the ledger is disabled.
+    :type po_run: Union[ledger.Run, None]
+
+    :return: The releases, None when there is no previous try.
+    :rtype: Union[List[lb_mb_data.Release], None]
+    """
+    lo_releases = po_run.get_releases() if po_run is not None else None
+    if lo_releases is not None:
+        s_msg = 'Resuming %s releases with covers from a previous try...' % len(lo_releases)
+        print(s_msg.ljust(cons.i_WIDTH, '.') + ' DONE!')
+
+    return lo_releases
+
+
+def _save_releases(po_run, plo_releases):
+    """
+    Function to record the releases of a report in the ledger once their covers are resolved. An empty list is not
+    recorded: ListenBrainz might not have computed the stats yet, so a retry must fetch them again.
+
+    :param po_run: Stages of the report. None when the ledger is disabled.
+    :type po_run: Union[ledger.Run, None]
+
+    :param plo_releases:
+    :type plo_releases: List[lb_mb_data.Release]
+
+    :return: Nothing
+    """
+    if po_run is not None and plo_releases:
+        po_run.set_releases(plo_releases)
+
+
+def _report(po_user, ps_period='month'):
+    if cons.b_ASYNC:
+        asyncio.run(_report_async(po_user, ps_period=ps_period))
+        return
+
+    o_run = ledger.get_run(po_user.u_lb_user, ps_period)
+    lo_releases = _get_resumed_releases(o_run)
+    if lo_releases is None:
+        s_msg = 'Fetching top %s verified releases from ListenBrainz...' % cons.i_LB_VERIFIED
         s_msg = s_msg.ljust(cons.i_WIDTH, '.')
         print(s_msg, end='')
-        if lo_releases:
-            try:
-                b_toot, s_report = _toot_releases(plo_releases=lo_releases, ps_period=ps_period)
-                s_result = ' DONE!'
-            except Exception as o_exception:
-                s_result = ' ERROR! %s' % o_exception
-        else:
-            s_result = ' SKIPPED!'
-        print(s_result)
+        lo_releases = _get_releases(po_user, ps_period=ps_period)
+        print(' DONE!')
 
-        if s_report:
-            print(s_report)
+        # Getting the covers of the releases we are going to keep
+        #--------------------------------------------------------
+        s_msg = 'Fetching covers of %s releases...' % len(lo_releases)
+        s_msg = s_msg.ljust(cons.i_WIDTH, '.')
+        print(s_msg, end='')
+        with metrics.timer('stage_covers'):
+            lb_mb_data.fetch_mb_covers(lo_releases)
+        print(' DONE!')
+        _save_releases(o_run, lo_releases)
 
-    # Sending the tweet
-    #------------------
-    if cons.b_TWITTER:
-        s_msg = 'Sending tweet (%s characters)...' % len(s_status_message)
+    # Showing the text (only the text, not the covers) of the tweet about to be sent
+    #-------------------------------------------------------------------------------
+    _print_status_message(lo_releases, ps_period=ps_period, ps_locale=po_user.s_locale,
+                          pi_max_length=_get_max_length(po_user))
+
+    # Downloading the covers (just once, they are shared by all the publishers)
+    #--------------------------------------------------------------------------
+    lb_covers = []
+    if lo_releases and _get_pending_publishers(po_user, o_run):
+        s_msg = 'Downloading %s covers...' % len(lo_releases)
         s_msg = s_msg.ljust(cons.i_WIDTH, '.')
         print(s_msg, end='')
-        if lo_releases:
-            try:
-                _tweet_releases(plo_releases=lo_releases, ps_period=ps_period)
-                s_result = ' DONE!'
-            except tweepy.errors.BadRequest:
-                s_result = ' ERROR! Wrong Twitter authentication keys.'
+        lb_covers = _download_covers(lo_releases, _get_cover_size(po_user))
+        print(' DONE!')
+
+    # Sending the messages
+    #---------------------
+    _publish(po_user, lo_releases, lb_covers, ps_period=ps_period)
+
+
+async def _upload_async(pf_upload, pb_cover, po_run=None, ps_name='', ps_key=''):
+    """
+    Coroutine to upload a cover to a publisher. With the ledger enabled, a cover uploaded by a previous try of the same
+    report is not uploaded again, and a new upload is recorded as soon as it's finished (see _upload_images()).
+
+    :param pf_upload: Upload function of the publisher, e.g. mastodon.upload_image.
+    :type pf_upload: Callable
+
+    :param pb_cover: Data of the cover.
+    :type pb_cover: Bytes
+
+    :param po_run: Stages of the report. None when the ledger is disabled.
+    :type po_run: Union[ledger.Run, None]
+
+    :param ps_name: Name of the publisher, e.g. 'toot'.
+    :type ps_name: Str
+
+    :param ps_key: Key of the cover in the ledger, see ledger.get_media_key().
+    :type ps_key: Str
+
+    :return: The id of the uploaded media, or the exception raised when uploading it.
+    :rtype: Union[Str, Int, Exception]
+    """
+    if po_run is not None:
+        dx_uploaded = await asyncio.to_thread(po_run.get_media_ids, ps_name)
+        if ps_key in dx_uploaded:
+            return dx_uploaded[ps_key]
+
+    try:
+        x_media_id = await asyncio.to_thread(pf_upload, pb_cover)
+    except Exception as o_exception:
+        return o_exception
+
+    if po_run is not None:
+        await asyncio.to_thread(po_run.add_media_ids, ps_name, {ps_key: x_media_id})
+    return x_media_id
+
+
+async def _prepare_release_async(po_release, po_lookup_semaphore, pltx_publishers, pi_cover_size=500, pb_upload=True,
+                                 pb_front=None, po_run=None, pdi_copies=None):
+    """
+    Coroutine to get everything needed to post a release. Its cover is resolved, downloaded and uploaded to every
+    publisher as soon as the previous step is finished, without waiting for the other releases.
+
+    :param po_release:
+    :type po_release: lb_mb_data.Release
+
+    :param po_lookup_semaphore: Semaphore to limit the number of parallel Cover Art Archive lookups.
+    :type po_lookup_semaphore: asyncio.Semaphore
+
+    :param pltx_publishers: Publishers of the user, see _get_publishers().
+    :type pltx_publishers: List[Tuple[Str, Callable, Callable, Bool, Int]]
+
+    :param pi_cover_size: Target resolution of the cover, see _download_cover().
+    :type pi_cover_size: Int
+
+    :param pb_upload: Whether the cover must be uploaded (it's not in collage mode, all the covers are needed first).
+    :type pb_upload: Bool
+
+    :param pb_front: Whether the release is known to have a front cover, see lb_mb_data.get_front_flags().
+    :type pb_front: Union[Bool, None]
+
+    :param po_run: Stages of the report, where the uploads are recorded. None when the ledger is disabled.
+    :type po_run: Union[ledger.Run, None]
+
+    :param pdi_copies: Copies of each cover already seen in the report, shared by all its releases (see
+                       ledger.get_media_key()).
+    :type pdi_copies: Dict[Str, Int]
+
+    :return: Tuple with the cover data (None when not available) and a dictionary with the media id of the cover in
+             each publisher (None when not uploaded, the exception for failed uploads).
+    :rtype: Tuple[Union[Bytes, None], Dict]
+    """
+    # Releases resumed from a previous try (see ledger.Run) already have their covers
+    if not po_release.lo_covers:
+        async with po_lookup_semaphore:
+            await asyncio.to_thread(po_release.fetch_mb_covers, pb_front)
+
+    b_cover = None
+    if pltx_publishers:
+        b_cover = await asyncio.to_thread(_download_cover, po_release, pi_cover_size)
+
+    dx_media_ids = {s_name: None for s_name, f_send, f_upload, b_reusable, i_max_length in pltx_publishers}
+    if b_cover is not None and pb_upload and not cons.b_DEBUG:
+        # The key is taken right after the download, in the event loop, so no other release can take it meanwhile
+        s_key = ledger.get_media_key(b_cover, pdi_copies if pdi_copies is not None else {})
+        lx_media_ids = await asyncio.gather(*[_upload_async(f_upload, b_cover, po_run, s_name, s_key)
+                                              for s_name, f_send, f_upload, b_reusable, i_max_length in pltx_publishers])
+        dx_media_ids = dict(zip(dx_media_ids, lx_media_ids))
+
+    return b_cover, dx_media_ids
+
+
+async def _report_async(po_user, ps_period='month'):
+    """
+    Asynchronous version of _report(). All the network operations run as coroutines in the same event loop, and each
+    release goes through cover lookup, download and upload as soon as it's ready, so the total time is roughly the
+    longest chain instead of the sum of all of them.
+    """
+    o_run = ledger.get_run(po_user.u_lb_user, ps_period)
+    lo_releases = _get_resumed_releases(o_run)
+    b_resumed = lo_releases is not None
+    if not b_resumed:
+        lo_releases = await asyncio.to_thread(_get_releases, po_user, ps_period)
+        s_msg = 'Fetching top %s verified releases from ListenBrainz...' % cons.i_LB_VERIFIED
+        print(s_msg.ljust(cons.i_WIDTH, '.') + ' DONE!')
+
+    _print_status_message(lo_releases, ps_period=ps_period, ps_locale=po_user.s_locale,
+                          pi_max_length=_get_max_length(po_user))
+
+    # Covers lookup, download and upload, release by release
+    #-------------------------------------------------------
+    ltx_publishers = _get_pending_publishers(po_user, o_run)
+    o_lookup_semaphore = asyncio.Semaphore(cons.i_MB_WORKERS)
+    i_cover_size = _get_cover_size(po_user)
+    di_copies = {}
+    with metrics.timer('stage_prepare'):
+        db_front = await asyncio.to_thread(lb_mb_data.get_front_flags,
+                                           [o_release for o_release in lo_releases if not o_release.lo_covers])
+        ltx_prepared = await asyncio.gather(*[_prepare_release_async(o_release, o_lookup_semaphore, ltx_publishers,
+                                                                     pi_cover_size=i_cover_size,
+                                                                     pb_upload=not cons.b_COLLAGE,
+                                                                     pb_front=db_front.get(o_release.u_release_mbid),
+                                                                     po_run=o_run,
+                                                                     pdi_copies=di_copies)
+                                              for o_release in lo_releases])
+    lb_covers = [tx_prepared[0] for tx_prepared in ltx_prepared]
+    s_msg = 'Preparing %s covers...' % len(lo_releases)
+    print(s_msg.ljust(cons.i_WIDTH, '.') + ' DONE!')
+    if not b_resumed:
+        _save_releases(o_run, lo_releases)
+
+    # Sending the messages
+    #---------------------
+    dlx_media_ids = None
+    if cons.b_DEBUG:
+        pass
+    elif cons.b_COLLAGE:
+        # The collage can only be built once all the covers are available, then it's uploaded to all the publishers
+        lb_images = await asyncio.to_thread(collage.get_message_images, lb_covers)
+        di_copies = {}
+        ls_keys = [ledger.get_media_key(b_image, di_copies) for b_image in lb_images]
+        llx_media_ids = await asyncio.gather(*[asyncio.gather(*[_upload_async(f_upload, b_image, o_run, s_name, s_key)
+                                                                for b_image, s_key in zip(lb_images, ls_keys)])
+                                               for s_name, f_send, f_upload, b_reusable, i_max_length in ltx_publishers])
+        dlx_media_ids = {tx_publisher[0]: lx_media_ids
+                         for tx_publisher, lx_media_ids in zip(ltx_publishers, llx_media_ids)}
+    else:
+        dlx_media_ids = {s_name: [tx_prepared[1][s_name] for tx_prepared in ltx_prepared]
+                         for s_name, f_send, f_upload, b_reusable, i_max_length in ltx_publishers}
+    await asyncio.to_thread(_publish, po_user, lo_releases, lb_covers, ps_period, dlx_media_ids)
+
+
+def _upload_cover(pf_upload, pb_cover):
+    """
+    Function to upload a cover to a publisher, capturing any error.
+
+    :param pf_upload: Upload function of the publisher, e.g. twitter.upload_image.
+    :type pf_upload: Callable
+
+    :param pb_cover: Data of the cover.
+    :type pb_cover: Bytes
+
+    :return: The id of the uploaded media, or the exception raised when uploading it.
+    :rtype: Union[Str, Int, Exception]
+    """
+    try:
+        return pf_upload(pb_cover)
+    except Exception as o_exception:
+        return o_exception
+
+
+def _get_cover_keys(plo_releases, pdb_covers):
+    """
+    Function to get the keys of the covers of a message in the ledger (see ledger.get_media_key()), the same ones
+    _upload_images() gives to the images of that message.
+
+    :param plo_releases: Releases of the message.
+    :type plo_releases: List[lb_mb_data.Release]
+
+    :param pdb_covers: Data of the covers, indexed by MusicBrainz Id. None for the missing ones.
+    :type pdb_covers: Dict[Str, Union[Bytes, None]]
+
+    :return: Dictionary with the key of the cover of each release with cover, indexed by MusicBrainz Id.
+    :rtype: Dict[Str, Str]
+    """
+    di_copies = {}
+    return {o_release.u_release_mbid: ledger.get_media_key(pdb_covers[o_release.u_release_mbid], di_copies)
+            for o_release in plo_releases if pdb_covers.get(o_release.u_release_mbid) is not None}
+
+
+def _report_periods(po_user, pls_periods):
+    """
+    Function to publish the reports of several periods at once (e.g. month and year in January). Their tops usually
+    share many releases, so the covers of all of them are planned together: each distinct release is looked up and
+    downloaded once, and uploaded once to the publishers whose media can be attached to several messages (see
+    _get_publishers()). Then the message of each period is published as usual. The planning is always synchronous, even
+    in asynchronous mode (ASYNC).
+
+    :param po_user:
+    :type po_user: users.User
+
+    :param pls_periods: Periods of the reports, e.g. ['month', 'year'].
+    :type pls_periods: List[Str]
+
+    :return: Nothing
+    """
+    # Top releases of every period
+    #-----------------------------
+    do_runs = {s_period: ledger.get_run(po_user.u_lb_user, s_period) for s_period in pls_periods}
+    dlo_releases = {}
+    for s_period in pls_periods:
+        dlo_releases[s_period] = _get_resumed_releases(do_runs[s_period])
+        if dlo_releases[s_period] is None:
+            s_msg = 'Fetching top %s verified releases of the %s...' % (cons.i_LB_VERIFIED, s_period)
+            print(s_msg.ljust(cons.i_WIDTH, '.'), end='')
+            dlo_releases[s_period] = _get_releases(po_user, ps_period=s_period)
+            print(' DONE!')
+
+    # Covers of the distinct releases of all the periods
+    #---------------------------------------------------
+    # The first object of each release gets the covers, and the rest of them (with their own listen counts) share them
+    o_distinct = lb_mb_data.ReleaseTable()
+    for lo_releases in dlo_releases.values():
+        o_distinct.extend(lo_releases)
+    lo_distinct = o_distinct.get_verified()
+
+    # Releases resumed from a previous try (see ledger.Run) already have their covers
+    lo_missing = [o_release for o_release in lo_distinct if not o_release.lo_covers]
+    s_msg = 'Fetching covers of %s distinct releases...' % len(lo_missing)
+    print(s_msg.ljust(cons.i_WIDTH, '.'), end='')
+    with metrics.timer('stage_covers'):
+        lb_mb_data.fetch_mb_covers(lo_missing)
+    for s_period, lo_releases in dlo_releases.items():
+        for o_release in lo_releases:
+            o_release.lo_covers = o_distinct.get(o_release.u_release_mbid).lo_covers
+        _save_releases(do_runs[s_period], lo_releases)
+    print(' DONE!')
+
+    # Publishers whose message of any period hasn't been posted yet
+    ltx_publishers = []
+    for s_period in pls_periods:
+        for tx_publisher in _get_pending_publishers(po_user, do_runs[s_period]):
+            if tx_publisher[0] not in [tx_added[0] for tx_added in ltx_publishers]:
+                ltx_publishers.append(tx_publisher)
+    db_covers = {}
+    if lo_distinct and ltx_publishers:
+        s_msg = 'Downloading %s distinct covers...' % len(lo_distinct)
+        print(s_msg.ljust(cons.i_WIDTH, '.'), end='')
+        db_covers = {o_release.u_release_mbid: b_cover
+                     for o_release, b_cover in zip(lo_distinct, _download_covers(lo_distinct, _get_cover_size(po_user)))}
+        print(' DONE!')
+
+    # Uploading the covers once to the publishers allowing it (a collage is different in every message)
+    #-------------------------------------------------------------------------------------------------
+    ddx_media_ids = {}
+    lu_mbids = [u_mbid for u_mbid, b_cover in db_covers.items() if b_cover is not None]
+    if lu_mbids and not cons.b_DEBUG and not cons.b_COLLAGE:
+        # Every report records the covers it uses, with the keys of its own message (see _upload_images()), so a report
+        # retried alone (e.g. when the other one was posted) finds them too
+        ddu_keys = {s_period: _get_cover_keys(lo_releases, db_covers)
+                    for s_period, lo_releases in dlo_releases.items() if do_runs[s_period] is not None}
+
+        for s_name, f_send, f_upload, b_reusable, i_max_length in ltx_publishers:
+            if not b_reusable:
+                continue
+
+            # Covers uploaded by previous tries of any of the reports are not uploaded again
+            dx_media_ids = {}
+            for s_period, du_keys in ddu_keys.items():
+                dx_uploaded = do_runs[s_period].get_media_ids(s_name)
+                dx_media_ids.update({u_mbid: dx_uploaded[s_key] for u_mbid, s_key in du_keys.items()
+                                     if s_key in dx_uploaded})
+            lu_missing = [u_mbid for u_mbid in lu_mbids if u_mbid not in dx_media_ids]
+
+            s_msg = 'Uploading %s distinct covers (%s)...' % (len(lu_missing), s_name)
+            print(s_msg.ljust(cons.i_WIDTH, '.'), end='')
+            lx_media_ids = _upload_images(None, s_name, f_upload, [db_covers[u_mbid] for u_mbid in lu_missing])
+            dx_new = {u_mbid: x_media_id for u_mbid, x_media_id in zip(lu_missing, lx_media_ids)
+                      if not isinstance(x_media_id, Exception)}
+            for s_period, du_keys in ddu_keys.items():
+                dx_recorded = {du_keys[u_mbid]: x_media_id for u_mbid, x_media_id in dx_new.items() if u_mbid in du_keys}
+                if dx_recorded:
+                    do_runs[s_period].add_media_ids(s_name, dx_recorded)
+
+            dx_media_ids.update(zip(lu_missing, lx_media_ids))
+            ddx_media_ids[s_name] = dx_media_ids
+            i_failed = sum(isinstance(x_media_id, Exception) for x_media_id in lx_media_ids)
+            print(' DONE!' if not i_failed else ' %s FAILED!' % i_failed)
+
+    # Sending the messages of every period
+    #-------------------------------------
+    for s_period, lo_releases in dlo_releases.items():
+        print('\n%s report' % s_period.capitalize())
+        _print_status_message(lo_releases, ps_period=s_period, ps_locale=po_user.s_locale,
+                              pi_max_length=_get_max_length(po_user))
+        lb_covers = [db_covers[o_release.u_release_mbid] for o_release in lo_releases] if db_covers else []
+        dlx_media_ids = {s_name: [dx_media_ids.get(o_release.u_release_mbid) for o_release in lo_releases]
+                         for s_name, dx_media_ids in ddx_media_ids.items()}
+        _publish(po_user, lo_releases, lb_covers, ps_period=s_period, pdlx_media_ids=dlx_media_ids)
+
+
+def _get_due_periods(po_user):
+    """
+    Function to get the periods whose report must be published now for a user. Year reports are only published in
+    January.
+
+    :param po_user:
+    :type po_user: users.User
+
+    :return:
+    :rtype: List[Str]
+    """
+    ls_periods = po_user.ls_periods or ['month', 'year']
+    if datetime.datetime.now().month != 1:
+        ls_periods = [s_period for s_period in ls_periods if s_period != 'year']
+
+    return ls_periods
+
+
+def _run(po_user):
+    """
+    Function to publish all the due reports of a user. When several reports are due, they are planned together (see
+    _report_periods()). The reports already published by previous tries are skipped (see ledger.Run).
+
+    :param po_user:
+    :type po_user: users.User
+
+    :return: Nothing
+    """
+    ls_periods = []
+    for s_period in _get_due_periods(po_user):
+        if _is_published(po_user, s_period):
+            s_msg = '\nLast %s report' % s_period
+            print(s_msg.ljust(cons.i_WIDTH, '.') + ' ALREADY PUBLISHED!')
+        else:
+            ls_periods.append(s_period)
+
+    if len(ls_periods) > 1:
+        # The reports share most of their covers, so they are planned together, see _report_periods()
+        ltx_reports = [('%s reports' % ' and '.join(ls_periods), '_'.join(ls_periods),
+                        functools.partial(_report_periods, po_user, ls_periods))]
+    else:
+        ltx_reports = [('%s report' % s_period, s_period, functools.partial(_report, po_user, ps_period=s_period))
+                       for s_period in ls_periods]
+
+    for s_title, s_name, f_report in ltx_reports:
+        print('\nLast %s\n%s' % (s_title, '-'*cons.i_WIDTH))
+        if cons.b_PROFILE:
+            profiler.run(f_report, pu_name='%s_%s' % (po_user.u_lb_user, s_name))
+        else:
+            f_report()
+
+
+class _UserOutput:
+    """
+    Stream replacing sys.stdout in batch mode. The text printed while processing each user is kept in its own buffer (a
+    context variable, so it's inherited by asyncio.to_thread()), and the report of each user is printed in one go,
+    instead of mixing lines of several users.
+    """
+    def __init__(self, po_stream):
+        self.o_stream = po_stream
+        self._o_buffer = contextvars.ContextVar('o_buffer', default=None)
+
+    def write(self, ps_text):
+        o_buffer = self._o_buffer.get()
+        if o_buffer is None:
+            return self.o_stream.write(ps_text)
+        return o_buffer.write(ps_text)
+
+    def flush(self):
+        self.o_stream.flush()
+
+    def capture(self, pf_function, *px_args):
+        """
+        Method to run a function capturing everything it prints.
+
+        :return: The printed text.
+        :rtype: Str
+        """
+        o_buffer = io.StringIO()
+        self._o_buffer.set(o_buffer)
+        try:
+            pf_function(*px_args)
+        except Exception as o_exception:
+            print('ERROR! %s' % o_exception)
+        finally:
+            self._o_buffer.set(None)
+
+        return o_buffer.getvalue()
+
+
+def _run_batch(plo_users):
+    """
+    Function to publish the reports of several users at the same time. All of them share the same HTTP connection
+    pools and cover caches.
+
+    :param plo_users:
+    :type plo_users: List[users.User]
+
+    :return: Nothing
+    """
+    o_output = _UserOutput(sys.stdout)
+    sys.stdout = o_output
+
+    def _run_user(po_user):
+        s_title = '\nListenBrainz user: %s\n%s' % (po_user.u_lb_user, '=' * cons.i_WIDTH)
+        return s_title + o_output.capture(_run, po_user)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=cons.i_USER_WORKERS) as o_executor:
+            for s_report in o_executor.map(_run_user, plo_users):
+                o_output.o_stream.write(s_report)
+                o_output.o_stream.flush()
+    finally:
+        sys.stdout = o_output.o_stream
+
+
+def _prefetch(po_user):
+    """
+    Function to prefetch the covers of the current top releases of a user: their Cover Art Archive information and
+    their images are stored in the persistent caches, so the reports published later don't need to request them.
+
+    :param po_user:
+    :type po_user: users.User
+
+    :return: Nothing
+    """
+    ls_periods = po_user.ls_periods or ['month', 'year']
+    # The year report is published in January, so the current year is only worth prefetching in December
+    if datetime.datetime.now().month != 12:
+        ls_periods = [s_period for s_period in ls_periods if s_period != 'year']
+
+    i_cover_size = _get_cover_size(po_user)
+    for s_period in ls_periods:
+        lo_releases = _get_releases(po_user, ps_period='this_%s' % s_period, pi_wanted=cons.i_PREFETCH_RELEASES)
+        lb_mb_data.fetch_mb_covers(lo_releases)
+        lb_covers = _download_covers(lo_releases, i_cover_size)
+
+        s_msg = 'Prefetching %s covers of %s (this_%s)...' % (len(lo_releases), po_user.u_lb_user, s_period)
+        i_missing = lb_covers.count(None)
+        print(s_msg.ljust(cons.i_WIDTH, '.') + (' DONE!' if not i_missing else ' %s MISSING!' % i_missing),
+              flush=True)
+
+
+def _prefetch_all():
+    """
+    Function to prefetch the covers of all the users, see _prefetch().
+
+    :return: Nothing
+    """
+    for o_user in users.get_users():
+        try:
+            _prefetch(o_user)
+        except Exception as o_exception:
+            print('Prefetching covers of %s... ERROR! %s' % (o_user.u_lb_user, o_exception), flush=True)
+
+
+def _run_all():
+    """
+    Function to publish the due reports of all the users. The users are read again in every call, so changes in the
+    users file are applied in the next run of daemon mode. The timings and counters of the run are exported at the end
+    (see metrics.export_run()), and so is the cassette when recording one (see cassette.save_cassette()).
+
+    :return: Nothing
+    """
+    metrics.reset()
+    try:
+        lo_users = users.get_users()
+        if cons.s_USERS_FILE or cons.s_USERS:
+            _run_batch(lo_users)
         else:
-            s_result = ' SKIPPED!'
-        print(s_result)
+            _run(lo_users[0])
+    finally:
+        metrics.export_run()
+        cassette.save_cassette()
 
 
 # Main code
@@ -247,10 +1152,19 @@ if __name__ == '__main__':
 
     _print_debug_msg()
 
-    print('\nLast month report\n%s' % ('-'*cons.i_WIDTH))
-    _report(ps_period='month')
+    # Every exchange is kept in memory until the cassette is saved, so a program running forever can't record one
+    if cons.b_DAEMON and cons.s_CASSETTE_MODE == 'record':
+        print('ERROR! CASSETTE_MODE "record" can\'t be used in daemon mode, a cassette records a single run')
+        sys.exit(1)
 
-    # Only launch year report if we're in January
-    if datetime.datetime.now().month == 1:
-        print('\nLast year report\n%s' % ('-'*cons.i_WIDTH))
-        _report(ps_period='year')
+    # Days after the 28th don't exist in every month, the scheduler would fail as soon as it reached a short one
+    if cons.b_DAEMON and not (1 <= cons.i_MSG_DAY <= 28 and 0 <= cons.i_MSG_HOUR <= 23):
+        print('ERROR! MSG_DAY must be between 1 and 28, and MSG_HOUR between 0 and 23 (got %s and %s)'
+              % (cons.i_MSG_DAY, cons.i_MSG_HOUR))
+        sys.exit(1)
+
+    if cons.b_DAEMON:
+        scheduler.run_forever(_run_all, pi_day=cons.i_MSG_DAY, pi_hour=cons.i_MSG_HOUR,
+                              pf_background=_prefetch_all, pi_background_hours=cons.i_PREFETCH_HOURS)
+    else:
+        _run_all()
@@ -0,0 +1,214 @@
+"""
+Library to record all the HTTP exchanges of a run to a cassette file, and to replay them later without any network
+access (CASSETTE and CASSETTE_MODE), e.g. to reproduce a production run locally, or to profile the CPU side of the
+pipeline in isolation.
+
+Cassette format: the magic line, the size of the index (8 bytes, little endian), the index (zlib compressed JSON list of
+[method, url, status, reason, headers, offset, length]) and then the bodies of all the responses, one after another.
+When replaying, the file is memory-mapped, so bodies are only read when they are requested.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import urllib.parse
+import zlib
+
+import requests
+import requests.structures
+import requests.utils
+
+from . import cons
+
+
+_b_MAGIC = b'LBZCASSETTE1\n'
+
+# Headers describing the transfer, not the content. They are not stored because the stored body is already decoded.
+_ts_TRANSFER_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length', 'connection', 'keep-alive')
+
+# Query parameters with a list of ids whose order depends on the order of other answers (e.g. the media uploaded in
+# parallel by the asynchronous mode). Their ids are sorted in the keys of the cassette.
+_ts_UNORDERED_PARAMS = ('media_ids',)
+
+# Cassette shared by the whole process, see get_cassette()
+_o_CASSETTE = None
+_o_CASSETTE_LOCK = threading.Lock()
+
+
+class CassetteMissError(requests.exceptions.RequestException):
+    """
+    Exception raised when replaying a request which is not in the cassette.
+    """
+
+
+def _get_key(po_request):
+    """
+    Function to get the key of a request in the cassette: its method and its URL, with the ids of the unordered query
+    parameters sorted (see _ts_UNORDERED_PARAMS).
+
+    :param po_request:
+    :type po_request: requests.PreparedRequest
+
+    :rtype: Tuple[Str, Str]
+    """
+    o_url = urllib.parse.urlsplit(po_request.url)
+    ltu_query = urllib.parse.parse_qsl(o_url.query, keep_blank_values=True)
+    if not any(u_name in _ts_UNORDERED_PARAMS for u_name, u_value in ltu_query):
+        return po_request.method, po_request.url
+
+    ltu_query = [(u_name, ','.join(sorted(u_value.split(','))) if u_name in _ts_UNORDERED_PARAMS else u_value)
+                 for u_name, u_value in ltu_query]
+    return po_request.method, o_url._replace(query=urllib.parse.urlencode(ltu_query)).geturl()
+
+
+class Cassette:
+    """
+    Class with the HTTP exchanges of a run. The answers to the same method and URL are kept in order, so a request sent
+    several times (e.g. the posts of every message) gets the same answers as in the recorded run. Once they are
+    exhausted, the last one is repeated.
+    """
+    def __init__(self, pu_path):
+        """
+        :param pu_path: Path of the cassette file.
+        :type pu_path: Str
+        """
+        self.u_path = pu_path
+        self.dlx_answers = {}   # (method, url) -> list of (status, reason, headers, offset, length) or Response
+        self._di_replayed = {}  # (method, url) -> number of answers already replayed
+        self._o_lock = threading.Lock()
+        self._o_mmap = None
+
+    def load(self):
+        """
+        Method to load the cassette file. The index is read, the bodies are memory-mapped.
+
+        :return: Nothing
+        """
+        with open(self.u_path, 'rb') as o_file:
+            self._o_mmap = mmap.mmap(o_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        i_start = len(_b_MAGIC) + 8
+        if self._o_mmap[:len(_b_MAGIC)] != _b_MAGIC:
+            raise ValueError('"%s" is not a cassette file' % self.u_path)
+        i_index_size = struct.unpack('<Q', self._o_mmap[len(_b_MAGIC):i_start])[0]
+        llx_index = json.loads(zlib.decompress(self._o_mmap[i_start:i_start + i_index_size]))
+
+        i_bodies = i_start + i_index_size
+        for s_method, u_url, i_status, s_reason, ds_headers, i_offset, i_length in llx_index:
+            tx_answer = (i_status, s_reason, ds_headers, i_bodies + i_offset, i_length)
+            self.dlx_answers.setdefault((s_method, u_url), []).append(tx_answer)
+
+    def save(self):
+        """
+        Method to write the recorded exchanges to the cassette file.
+
+        :return: Nothing
+        """
+        with self._o_lock:
+            llx_index = []
+            lb_bodies = []
+            i_offset = 0
+            for (s_method, u_url), lo_responses in self.dlx_answers.items():
+                for o_response in lo_responses:
+                    ds_headers = {s_header: s_value for s_header, s_value in o_response.headers.items()
+                                  if s_header.lower() not in _ts_TRANSFER_HEADERS}
+                    llx_index.append([s_method, u_url, o_response.status_code, o_response.reason, ds_headers,
+                                      i_offset, len(o_response.content)])
+                    lb_bodies.append(o_response.content)
+                    i_offset += len(o_response.content)
+
+        b_index = zlib.compress(json.dumps(llx_index, separators=(',', ':')).encode('utf-8'))
+        u_dir = os.path.dirname(self.u_path)
+        if u_dir:
+            os.makedirs(u_dir, exist_ok=True)
+        with open(self.u_path, 'wb') as o_file:
+            o_file.write(_b_MAGIC)
+            o_file.write(struct.pack('<Q', len(b_index)))
+            o_file.write(b_index)
+            for b_body in lb_bodies:
+                o_file.write(b_body)
+
+    def record(self, po_request, po_response):
+        """
+        Method to record an exchange.
+
+        :param po_request: The request sent.
+        :type po_request: requests.PreparedRequest
+
+        :param po_response: The answer received. Its body is read.
+        :type po_response: requests.Response
+
+        :return: Nothing
+        """
+        po_response.content
+        with self._o_lock:
+            self.dlx_answers.setdefault(_get_key(po_request), []).append(po_response)
+
+    def replay(self, po_request):
+        """
+        Method to get the recorded answer to a request.
+
+        :param po_request: The request to answer.
+        :type po_request: requests.PreparedRequest
+
+        :return: The answer.
+        :rtype: requests.Response
+
+        :raises CassetteMissError: When the request is not in the cassette.
+        """
+        tx_key = _get_key(po_request)
+        with self._o_lock:
+            ltx_answers = self.dlx_answers.get(tx_key)
+            if not ltx_answers:
+                raise CassetteMissError('%s %s is not in the cassette' % tx_key, request=po_request)
+
+            i_answer = self._di_replayed.get(tx_key, 0)
+            self._di_replayed[tx_key] = i_answer + 1
+            i_status, s_reason, ds_headers, i_offset, i_length = ltx_answers[min(i_answer, len(ltx_answers) - 1)]
+
+        o_response = requests.Response()
+        o_response.status_code = i_status
+        o_response.reason = s_reason
+        o_response.headers = requests.structures.CaseInsensitiveDict(ds_headers)
+        o_response._content = self._o_mmap[i_offset:i_offset + i_length]
+        o_response.encoding = requests.utils.get_encoding_from_headers(o_response.headers)
+        o_response.url = po_request.url
+        o_response.request = po_request
+        return o_response
+
+
+def get_cassette():
+    """
+    Function to get the cassette shared by the whole process. When recording, it must be saved at the end of the run,
+    see save_cassette().
+
+    :return: The cassette, or None when CASSETTE_MODE is not "record" or "replay".
+    :rtype: Union[None, cassette.Cassette]
+    """
+    global _o_CASSETTE
+
+    if cons.s_CASSETTE_MODE not in ('record', 'replay'):
+        return None
+
+    with _o_CASSETTE_LOCK:
+        if _o_CASSETTE is None:
+            o_cassette = Cassette(cons.s_CASSETTE)
+            if cons.s_CASSETTE_MODE == 'replay':
+                o_cassette.load()
+            _o_CASSETTE = o_cassette
+
+    return _o_CASSETTE
+
+
+def save_cassette():
+    """
+    Function to write the exchanges recorded so far to the cassette file. It's saved at the end of every run, instead
+    of when the program exits, because exit handlers don't run when the process is terminated by a signal (e.g. by
+    "docker stop").
+
+    :return: Nothing
+    """
+    if cons.s_CASSETTE_MODE == 'record' and _o_CASSETTE is not None:
+        _o_CASSETTE.save()
@@ -0,0 +1,78 @@
+"""
+Library to combine several covers into a single grid image (collage), so a message needs a single media upload.
+"""
+
+import io
+import math
+
+from . import cons
+
+
+def build_collage(plb_images, pi_columns=0, pi_tile=500, pi_quality=90):
+    """
+    Function to build a grid image with several images. Each image is scaled to a square tile (covers are almost always
+    square already) and the tiles are placed from left to right and top to bottom.
+
+    :param plb_images: Data of the images (any format supported by Pillow).
+    :type plb_images: List[Bytes]
+
+    :param pi_columns: Number of columns of the grid. 0 to use a square-ish grid.
+    :type pi_columns: Int
+
+    :param pi_tile: Size in pixels of each tile.
+    :type pi_tile: Int
+
+    :param pi_quality: JPEG quality of the resulting image.
+    :type pi_quality: Int
+
+    :return: The data of the collage in JPEG format, or None when there are no images.
+    :rtype: Union[Bytes, None]
+    """
+    if not plb_images:
+        return None
+
+    # numpy and Pillow are only imported in collage mode, they are slow to import
+    import numpy
+    import PIL.Image
+
+    i_images = len(plb_images)
+    i_columns = pi_columns if pi_columns > 0 else math.ceil(math.sqrt(i_images))
+    i_columns = min(i_columns, i_images)
+    i_rows = math.ceil(i_images / i_columns)
+
+    # All the tiles in a single (images, tile, tile, RGB) array, the empty cells of the last row are left black
+    ai_tiles = numpy.zeros((i_rows * i_columns, pi_tile, pi_tile, 3), dtype=numpy.uint8)
+    for i_image, b_image in enumerate(plb_images):
+        with PIL.Image.open(io.BytesIO(b_image)) as o_image:
+            # draft() lets the JPEG decoder scale the image down while decoding, which is much faster
+            o_image.draft('RGB', (pi_tile, pi_tile))
+            o_tile = o_image.convert('RGB').resize((pi_tile, pi_tile), PIL.Image.LANCZOS)
+        ai_tiles[i_image] = numpy.asarray(o_tile)
+
+    # Placing the tiles in the grid with a single reshape: (rows, columns, y, x, RGB) -> (rows, y, columns, x, RGB)
+    ai_grid = ai_tiles.reshape(i_rows, i_columns, pi_tile, pi_tile, 3)
+    ai_grid = ai_grid.transpose(0, 2, 1, 3, 4).reshape(i_rows * pi_tile, i_columns * pi_tile, 3)
+
+    o_buffer = io.BytesIO()
+    PIL.Image.fromarray(ai_grid).save(o_buffer, format='JPEG', quality=pi_quality, optimize=True)
+    return o_buffer.getvalue()
+
+
+def get_message_images(plb_covers):
+    """
+    Function to get the images to be attached to a message: a single collage in collage mode, or the covers otherwise.
+
+    :param plb_covers: Data of the covers of each release, None for the missing ones.
+    :type plb_covers: List[Union[Bytes, None]]
+
+    :return:
+    :rtype: List[Bytes]
+    """
+    lb_covers = [b_cover for b_cover in plb_covers if b_cover is not None]
+    if cons.b_COLLAGE and lb_covers:
+        lb_covers = [build_collage(lb_covers,
+                                   pi_columns=cons.i_COLLAGE_COLUMNS,
+                                   pi_tile=cons.i_COLLAGE_TILE,
+                                   pi_quality=cons.i_COLLAGE_QUALITY)]
+
+    return lb_covers
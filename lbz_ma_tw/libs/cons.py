@@ -11,6 +11,9 @@ import os
 s_PRG = 'ListenBrainz to Mastodon and Twitter'
 s_VER = 'v1.2.2023-06-06.dev'
 
+# User agent sent in the HTTP requests. MusicBrainz asks for a meaningful one with contact information
+s_USER_AGENT = 'lbz_ma_tw/%s ( https://github.com/HeuristicPerson/lbz_ma_tw )' % s_VER
+
 # Number of chars for fixed-width elements
 i_WIDTH = 58
 
@@ -23,18 +26,42 @@ b_DEBUG = False
 if _s_debug.lower() in _ts_ON_VALUES:
     b_DEBUG = True
 
+# Profile mode, every report is profiled and the results are written to PROFILE_DIR (see profiler.py)
+_s_profile = os.getenv('PROFILE', 'False')
+b_PROFILE = False
+if _s_profile.lower() in _ts_ON_VALUES:
+    b_PROFILE = True
+
+s_PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.expanduser('~/lbz_ma_tw_profiles'))
+
+# Milliseconds between the wall-clock stack samples taken in profile mode
+f_PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '5'))
+
+# Asynchronous mode, all the network operations run as coroutines in a single event loop
+_s_async = os.getenv('ASYNC', 'False')
+b_ASYNC = False
+if _s_async.lower() in _ts_ON_VALUES:
+    b_ASYNC = True
+
 # Language configuration, used in the creation of the tweet.
 s_LOCALE = os.getenv('LOCALE', 'en_GB.UTF-8')
 
 
 # ListenBrainz constants
 #-----------------------
+# Root URL of ListenBrainz API (only changed for testing and benchmarking)
+s_LB_API_ROOT = os.getenv('LB_API_ROOT', 'https://api.listenbrainz.org')
+
 # ListenBrainz user to get most popular albums from
 s_LB_USER = os.getenv('LB_USER', '')
 
-# Number of albums to get from that user
+# Number of albums to get from that user in the first request. When not enough verified albums are found among them,
+# more of them are requested (as few as possible, based on the ratio of verified albums found in the previous requests)
 i_LB_FETCH = int(os.getenv('LB_FETCH', '10'))
 
+# Maximum number of albums ListenBrainz returns in a single request
+i_LB_PAGE_MAX = 100
+
 # Number of verified albums. When fetching most popular albums from ListBrainz website, some of them won't be verified
 # e.g. they don't have any valid associated album ID in MusicBrainz website. So after getting all albums from,
 # ListenBrainz, just the number below will be kept. Since at the moment I'm verifying my entire collection of music (and
@@ -45,12 +72,92 @@ i_LB_VERIFIED = int(os.getenv('LB_VERIFIED', '3'))
 
 # Cover download options
 #-----------------------
+# Root URL of Cover Art Archive (only changed for testing and benchmarking)
+s_CAA_ROOT = os.getenv('CAA_ROOT', 'https://coverartarchive.org')
+
+# Root URL of MusicBrainz API (only changed for testing and benchmarking)
+s_MB_API_ROOT = os.getenv('MB_API_ROOT', 'https://musicbrainz.org/ws/2')
+
+# Number of releases whose cover availability is asked to MusicBrainz in a single search request (100 at most), so
+# Cover Art Archive is only queried for releases which might have a front cover. 0 to query all of them directly.
+i_MB_SEARCH_BATCH = max(0, min(100, int(os.getenv('MB_SEARCH_BATCH', '100'))))
+
 # Number of retries when downloading materials from ListBrainz and MusicBrainz
 i_DL_RETRIES = int(os.getenv('DL_RETRIES', '5'))
 
 # Number of seconds between download retries
 i_DL_DELAY = int(os.getenv('DL_DELAY', '5'))
 
+# Hosts of MusicBrainz, limited to f_MB_RATE requests per second, and of Cover Art Archive, limited to f_CAA_RATE
+ts_MB_HOSTS = ('musicbrainz.org',)
+ts_CAA_HOSTS = ('coverartarchive.org',)
+
+# Number of parallel workers used to get the covers information from Cover Art Archive
+i_MB_WORKERS = max(1, int(os.getenv('MB_WORKERS', '4')))
+
+# Maximum number of requests per second sent to MusicBrainz (no matter the number of workers). MusicBrainz asks for an
+# average of one request per second at most, see https://musicbrainz.org/doc/MusicBrainz_API/Rate_Limiting
+f_MB_RATE = float(os.getenv('MB_RATE', '1.0'))
+
+# Maximum number of requests per second sent to Cover Art Archive (0 for no limit). Its rate limit is not the one of
+# MusicBrainz, so the MB_WORKERS look up covers at the same time.
+f_CAA_RATE = float(os.getenv('CAA_RATE', '0'))
+
+
+
+# HTTP connections options
+#-------------------------
+# Number of seconds to wait for the connection to a server, and for its answer
+f_HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+f_HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+
+# Number of hosts whose connections are kept open, and number of open connections per host
+i_HTTP_POOLS = int(os.getenv('HTTP_POOLS', '10'))
+i_HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', str(max(10, i_MB_WORKERS))))
+
+# Maximum number of requests per second sent to any other host. 0 means no limit
+f_HTTP_RATE = float(os.getenv('HTTP_RATE', '0'))
+
+# Maximum number of seconds to wait between retries (the delay grows exponentially after every failed try)
+f_RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '60'))
+
+# Number of consecutive failed requests after which a host is considered down, and number of seconds no requests are
+# sent to it. 0 failures disables this behaviour
+i_BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+f_BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '60'))
+
+
+# Routes of hosts to other servers, as a comma separated list of "host=root URL", e.g.
+# "api.twitter.com=http://127.0.0.1:8080". The requests to those hosts are sent to the given servers instead (only for
+# testing and benchmarking, e.g. tweepy always uses https://api.twitter.com).
+ds_HTTP_ROUTES = {}
+for _s_route in os.getenv('HTTP_ROUTES', '').split(','):
+    if '=' in _s_route:
+        _s_host, _s_root = _s_route.split('=', 1)
+        ds_HTTP_ROUTES[_s_host.strip()] = _s_root.strip().rstrip('/')
+
+
+# Cache options
+#--------------
+# Directory where the persistent caches are stored. Empty to disable the caches.
+s_CACHE_DIR = os.getenv('CACHE_DIR', os.path.expanduser('~/.cache/lbz_ma_tw'))
+
+# Number of days the cover information of a release is kept in the cache
+i_CACHE_TTL = int(os.getenv('CACHE_TTL', '30'))
+
+# Number of days a release WITHOUT front cover is kept in the cache (it might be uploaded to Cover Art Archive soon)
+i_CACHE_NEGATIVE_TTL = int(os.getenv('CACHE_NEGATIVE_TTL', '1'))
+
+# Maximum number of releases kept in the cache, the least recently used ones are removed first
+i_CACHE_SIZE = int(os.getenv('CACHE_SIZE', '5000'))
+
+# Maximum number of cover images kept in the cache (0 to disable it), the least recently used ones are removed first
+i_CACHE_IMAGES = int(os.getenv('CACHE_IMAGES', '200'))
+
+# SQLite file of the run ledger, with the stages of every report already completed, so a report retried after a failure
+# resumes where it stopped and never publishes a message twice. Empty to disable it.
+s_LEDGER = os.getenv('LEDGER', os.path.join(s_CACHE_DIR, 'ledger.sqlite') if s_CACHE_DIR else '')
+
 
 # Mastodon and Twitter constants
 #-------------------------------
@@ -75,8 +182,107 @@ b_MASTODON = True
 if '' in (s_MA_INSTANCE, s_MA_TOKEN):
     b_MASTODON = False
 
+# Maximum number of characters of the messages of each platform (Mastodon instances can raise the default limit)
+i_TW_MSG_LENGTH = int(os.getenv('TW_MSG_LENGTH', '280'))
+i_MA_MSG_LENGTH = int(os.getenv('MA_MSG_LENGTH', '500'))
+
+# Target size of the images of each platform: maximum resolution in pixels (largest side, 0 for no limit) and maximum
+# size in bytes. The smallest Cover Art Archive thumbnail reaching the resolution is downloaded, and any image exceeding
+# the limits is scaled down and/or recompressed before uploading it.
+i_TW_IMAGE_SIZE = int(os.getenv('TW_IMAGE_SIZE', '500'))
+i_TW_IMAGE_BYTES = int(os.getenv('TW_IMAGE_BYTES', str(5 * 1024 * 1024)))
+i_MA_IMAGE_SIZE = int(os.getenv('MA_IMAGE_SIZE', '500'))
+i_MA_IMAGE_BYTES = int(os.getenv('MA_IMAGE_BYTES', str(8 * 1024 * 1024)))
+
+# JPEG quality of the recompressed images
+i_IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '85'))
+
+# Collage mode: all the covers are combined into a single grid image, so a single image is uploaded per message
+_s_collage = os.getenv('COLLAGE', 'False')
+b_COLLAGE = False
+if _s_collage.lower() in _ts_ON_VALUES:
+    b_COLLAGE = True
+
+# Number of columns of the collage (0 for a square-ish grid), size in pixels of each cover and JPEG quality
+i_COLLAGE_COLUMNS = int(os.getenv('COLLAGE_COLUMNS', '0'))
+i_COLLAGE_TILE = int(os.getenv('COLLAGE_TILE', '500'))
+i_COLLAGE_QUALITY = int(os.getenv('COLLAGE_QUALITY', '90'))
+
+# Number of images uploaded at the same time when submitting a message
+i_UPLOAD_WORKERS = max(1, int(os.getenv('UPLOAD_WORKERS', '4')))
+
 # Number of retries when submitting a tweet
 i_MSG_RETRIES = int(os.getenv('MSG_RETRIES', '5'))
 
 # Number of seconds to wait between tweet retries
 i_MSG_DELAY = int(os.getenv('MSG_DELAY', '5'))
+
+
+
+# Metrics constants
+#------------------
+# Files where the timings and counters of each run are exported (empty to not export them): a JSON summary, and a
+# Prometheus textfile collector file (e.g. /var/lib/node_exporter/textfile_collector/lbz_ma_tw.prom)
+s_METRICS_JSON = os.getenv('METRICS_JSON', '')
+s_METRICS_PROMETHEUS = os.getenv('METRICS_PROMETHEUS', '')
+
+
+# Schedule constants
+#-------------------
+# Day of the month and hour (0-23) when the reports are published. Year reports are only published in January.
+i_MSG_DAY = int(os.getenv('MSG_DAY', '4'))
+i_MSG_HOUR = int(os.getenv('MSG_HOUR', '20'))
+
+# Daemon mode: instead of publishing the reports once and exiting (run by cron), the program keeps running and publishes
+# them following the schedule above, keeping HTTP connections, clients and caches warm between runs.
+_s_daemon = os.getenv('DAEMON', 'False')
+b_DAEMON = False
+if _s_daemon.lower() in _ts_ON_VALUES:
+    b_DAEMON = True
+
+# Number of hours between prefetches in daemon mode (0 to disable them). A prefetch gets the current top releases of the
+# periods being reported (e.g. "this_month"), and caches their covers information and images, so on posting day only
+# the final stats are requested.
+i_PREFETCH_HOURS = int(os.getenv('PREFETCH_HOURS', '0'))
+
+# Number of top releases prefetched, more than LB_VERIFIED since the final top might still change
+i_PREFETCH_RELEASES = int(os.getenv('PREFETCH_RELEASES', str(2 * i_LB_VERIFIED)))
+
+# Batch mode constants
+#---------------------
+# JSON file (or JSON text) with a list of users to process, each one with its own ListenBrainz user, periods, locale and
+# publisher credentials (see users.User.from_dict()). When defined, the single user variables above are ignored.
+s_USERS_FILE = os.getenv('USERS_FILE', '')
+s_USERS = os.getenv('USERS', '')
+
+# Number of users processed at the same time
+i_USER_WORKERS = max(1, int(os.getenv('USER_WORKERS', '4')))
+
+# Cassette constants
+#-------------------
+# Cassette mode: "record" saves every HTTP exchange of the run (ListenBrainz, Cover Art Archive, images and publishers)
+# to the CASSETTE file at the end of every run; "replay" answers every request from that file, without network access,
+# e.g. to reproduce a production run or to profile the CPU side of the program. Empty to disable it.
+s_CASSETTE_MODE = os.getenv('CASSETTE_MODE', '').strip().lower()
+s_CASSETTE = os.getenv('CASSETTE', os.path.expanduser('~/lbz_ma_tw.cassette'))
+
+# Requests to the same URL (e.g. the uploads of the covers) get their answers in the order they are sent, so they are
+# sent one by one when recording or replaying, otherwise every replay would hand out the answers in a different order
+if s_CASSETTE_MODE in ('record', 'replay'):
+    i_MB_WORKERS = 1
+    i_UPLOAD_WORKERS = 1
+    i_USER_WORKERS = 1
+
+# Covers found in the caches aren't requested and reports in the ledger aren't published again, so a cassette recorded
+# with warm caches would miss requests of a replay with empty ones: the caches and the ledger are disabled in both modes
+if s_CASSETTE_MODE in ('record', 'replay'):
+    s_CACHE_DIR = ''
+    s_LEDGER = ''
+
+# No server is involved when replaying, so there is no reason to limit the rate of requests or to wait between retries
+if s_CASSETTE_MODE == 'replay':
+    f_MB_RATE = 0.0
+    f_CAA_RATE = 0.0
+    f_HTTP_RATE = 0.0
+    i_DL_DELAY = 0
+    i_MSG_DELAY = 0
@@ -0,0 +1,272 @@
+"""
+Library with persistent (SQLite) caches of Cover Art Archive metadata and cover images. Covers of a release almost never
+change, so there is no need to query Cover Art Archive (or download the same image) again for releases seen in previous
+runs or prefetched before the reports are published.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import cons
+
+
+# Cache objects shared by the whole process, see get_cache() and get_image_cache(). A cache that can't be opened (e.g.
+# CACHE_DIR isn't writable) is disabled for the rest of the process.
+_o_CACHE = None
+_o_IMAGE_CACHE = None
+_b_CACHE_FAILED = False
+_b_IMAGE_CACHE_FAILED = False
+_o_CACHE_LOCK = threading.Lock()
+
+
+def _connect(pu_path):
+    """
+    Function to open a SQLite database shared by several threads (access must be serialized by the caller).
+
+    :param pu_path: Path of the SQLite database file. Its parent directory is created when needed.
+    :type pu_path: Str
+
+    :return:
+    :rtype: sqlite3.Connection
+    """
+    u_dir = os.path.dirname(pu_path)
+    if u_dir:
+        os.makedirs(u_dir, exist_ok=True)
+
+    return sqlite3.connect(pu_path, check_same_thread=False)
+
+
+class CoverCache:
+    """
+    Class to store the front cover data (as returned by Cover Art Archive) of releases, indexed by release MBID. An empty
+    list of covers is a valid value: it means the release has no front cover (negative caching).
+    """
+    def __init__(self, pu_path, pi_ttl=30, pi_negative_ttl=1, pi_max_entries=5000):
+        """
+        :param pu_path: Path of the SQLite database file. Its parent directory is created when needed.
+        :type pu_path: Str
+
+        :param pi_ttl: Number of days a release with covers is kept in the cache.
+        :type pi_ttl: Int
+
+        :param pi_negative_ttl: Number of days a release without front cover is kept in the cache.
+        :type pi_negative_ttl: Int
+
+        :param pi_max_entries: Maximum number of releases in the cache. The least recently used ones are evicted.
+        :type pi_max_entries: Int
+        """
+        self.u_path = pu_path
+        self.i_ttl = pi_ttl * 86400
+        self.i_negative_ttl = pi_negative_ttl * 86400
+        self.i_max_entries = pi_max_entries
+
+        # The connection is shared by all the threads resolving covers, so access is serialized with a lock
+        self._o_lock = threading.Lock()
+        self._o_db = _connect(pu_path)
+        with self._o_lock, self._o_db:
+            self._o_db.execute('CREATE TABLE IF NOT EXISTS covers ('
+                               'mbid TEXT PRIMARY KEY, '
+                               'data TEXT NOT NULL, '
+                               'stored REAL NOT NULL, '
+                               'used REAL NOT NULL)')
+
+    def get(self, pu_mbid):
+        """
+        Method to get the covers data of a release.
+
+        :param pu_mbid: MusicBrainz Id of the release.
+        :type pu_mbid: Str
+
+        :return: None when the release is not in the cache (or it's expired), otherwise a list (maybe empty) with the
+                 front covers data.
+        :rtype: Union[None, List[Dict]]
+        """
+        f_now = time.time()
+        with self._o_lock, self._o_db:
+            o_row = self._o_db.execute('SELECT data, stored FROM covers WHERE mbid = ?', (pu_mbid,)).fetchone()
+            if o_row is None:
+                return None
+
+            ldx_data = json.loads(o_row[0])
+            i_ttl = self.i_ttl if ldx_data else self.i_negative_ttl
+            if f_now - o_row[1] > i_ttl:
+                self._o_db.execute('DELETE FROM covers WHERE mbid = ?', (pu_mbid,))
+                return None
+
+            self._o_db.execute('UPDATE covers SET used = ? WHERE mbid = ?', (f_now, pu_mbid))
+
+        return ldx_data
+
+    def get_missing(self, plu_mbids):
+        """
+        Method to get which releases are not in the cache (or are expired), without marking the rest as used.
+
+        :param plu_mbids: MusicBrainz Ids of the releases.
+        :type plu_mbids: List[Str]
+
+        :return: The MusicBrainz Ids not found, in the same order.
+        :rtype: List[Str]
+        """
+        f_now = time.time()
+        su_found = set()
+        with self._o_lock:
+            # SQLite limits the number of parameters of a query
+            for i_start in range(0, len(plu_mbids), 500):
+                lu_mbids = plu_mbids[i_start:i_start + 500]
+                s_query = 'SELECT mbid, data, stored FROM covers WHERE mbid IN (%s)' % ', '.join('?' * len(lu_mbids))
+                for u_mbid, u_data, f_stored in self._o_db.execute(s_query, lu_mbids):
+                    i_ttl = self.i_ttl if json.loads(u_data) else self.i_negative_ttl
+                    if f_now - f_stored <= i_ttl:
+                        su_found.add(u_mbid)
+
+        return [u_mbid for u_mbid in plu_mbids if u_mbid not in su_found]
+
+    def set(self, pu_mbid, pldx_data):
+        """
+        Method to store the covers data of a release.
+
+        :param pu_mbid: MusicBrainz Id of the release.
+        :type pu_mbid: Str
+
+        :param pldx_data: List with the data of the front covers. Empty when the release has no front cover.
+        :type pldx_data: List[Dict]
+
+        :return: Nothing
+        """
+        f_now = time.time()
+        with self._o_lock, self._o_db:
+            self._o_db.execute('INSERT OR REPLACE INTO covers (mbid, data, stored, used) VALUES (?, ?, ?, ?)',
+                               (pu_mbid, json.dumps(pldx_data), f_now, f_now))
+            self._o_db.execute('DELETE FROM covers WHERE mbid IN '
+                               '(SELECT mbid FROM covers ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                               (self.i_max_entries,))
+
+
+class ImageCache:
+    """
+    Class to store the data of cover images, indexed by URL. Cover Art Archive URLs include the id of the image, so the
+    data of a URL never changes.
+    """
+    def __init__(self, pu_path, pi_ttl=30, pi_max_entries=200):
+        """
+        :param pu_path: Path of the SQLite database file. Its parent directory is created when needed.
+        :type pu_path: Str
+
+        :param pi_ttl: Number of days an image is kept in the cache.
+        :type pi_ttl: Int
+
+        :param pi_max_entries: Maximum number of images in the cache. The least recently used ones are evicted.
+        :type pi_max_entries: Int
+        """
+        self.u_path = pu_path
+        self.i_ttl = pi_ttl * 86400
+        self.i_max_entries = pi_max_entries
+
+        self._o_lock = threading.Lock()
+        self._o_db = _connect(pu_path)
+        with self._o_lock, self._o_db:
+            self._o_db.execute('CREATE TABLE IF NOT EXISTS images ('
+                               'url TEXT PRIMARY KEY, '
+                               'data BLOB NOT NULL, '
+                               'stored REAL NOT NULL, '
+                               'used REAL NOT NULL)')
+
+    def get(self, pu_url):
+        """
+        Method to get the data of an image.
+
+        :param pu_url: URL of the image.
+        :type pu_url: Str
+
+        :return: None when the image is not in the cache (or it's expired), otherwise its data.
+        :rtype: Union[None, Bytes]
+        """
+        f_now = time.time()
+        with self._o_lock, self._o_db:
+            o_row = self._o_db.execute('SELECT data, stored FROM images WHERE url = ?', (pu_url,)).fetchone()
+            if o_row is None:
+                return None
+
+            if f_now - o_row[1] > self.i_ttl:
+                self._o_db.execute('DELETE FROM images WHERE url = ?', (pu_url,))
+                return None
+
+            self._o_db.execute('UPDATE images SET used = ? WHERE url = ?', (f_now, pu_url))
+
+        return bytes(o_row[0])
+
+    def set(self, pu_url, pb_data):
+        """
+        Method to store the data of an image.
+
+        :param pu_url: URL of the image.
+        :type pu_url: Str
+
+        :param pb_data:
+        :type pb_data: Bytes
+
+        :return: Nothing
+        """
+        f_now = time.time()
+        with self._o_lock, self._o_db:
+            self._o_db.execute('INSERT OR REPLACE INTO images (url, data, stored, used) VALUES (?, ?, ?, ?)',
+                               (pu_url, pb_data, f_now, f_now))
+            self._o_db.execute('DELETE FROM images WHERE url IN '
+                               '(SELECT url FROM images ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                               (self.i_max_entries,))
+
+
+def get_cache():
+    """
+    Function to get the cover cache shared by the whole process.
+
+    :return: The cache, or None if it's disabled (empty CACHE_DIR) or it can't be opened.
+    :rtype: Union[None, cover_cache.CoverCache]
+    """
+    global _o_CACHE, _b_CACHE_FAILED
+
+    if not cons.s_CACHE_DIR:
+        return None
+
+    with _o_CACHE_LOCK:
+        if _o_CACHE is None and not _b_CACHE_FAILED:
+            u_path = os.path.join(cons.s_CACHE_DIR, 'covers.sqlite')
+            try:
+                _o_CACHE = CoverCache(pu_path=u_path,
+                                      pi_ttl=cons.i_CACHE_TTL,
+                                      pi_negative_ttl=cons.i_CACHE_NEGATIVE_TTL,
+                                      pi_max_entries=cons.i_CACHE_SIZE)
+            except (OSError, sqlite3.Error) as o_exception:
+                _b_CACHE_FAILED = True
+                print('WARNING: Cover cache "%s" can\'t be opened (%s), running without it' % (u_path, o_exception))
+
+    return _o_CACHE
+
+
+def get_image_cache():
+    """
+    Function to get the image cache shared by the whole process.
+
+    :return: The cache, or None if it's disabled (empty CACHE_DIR or CACHE_IMAGES set to 0) or it can't be opened.
+    :rtype: Union[None, cover_cache.ImageCache]
+    """
+    global _o_IMAGE_CACHE, _b_IMAGE_CACHE_FAILED
+
+    if not cons.s_CACHE_DIR or cons.i_CACHE_IMAGES <= 0:
+        return None
+
+    with _o_CACHE_LOCK:
+        if _o_IMAGE_CACHE is None and not _b_IMAGE_CACHE_FAILED:
+            u_path = os.path.join(cons.s_CACHE_DIR, 'images.sqlite')
+            try:
+                _o_IMAGE_CACHE = ImageCache(pu_path=u_path,
+                                            pi_ttl=cons.i_CACHE_TTL,
+                                            pi_max_entries=cons.i_CACHE_IMAGES)
+            except (OSError, sqlite3.Error) as o_exception:
+                _b_IMAGE_CACHE_FAILED = True
+                print('WARNING: Image cache "%s" can\'t be opened (%s), running without it' % (u_path, o_exception))
+
+    return _o_IMAGE_CACHE
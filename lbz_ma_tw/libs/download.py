@@ -1,9 +1,43 @@
-import requests
+from . import cover_cache
+from . import http_client
+from . import metrics
+
+
+def dl_bytes(pu_url, pb_cache=False):
+    """
+    Function to download a file and keep it in memory.
+
+    :param pu_url: URL of the file.
+    :type pu_url: Str
+
+    :param pb_cache: Whether the file is read from (and stored in) the persistent image cache. Only for URLs whose
+                     content never changes, like Cover Art Archive images.
+    :type pb_cache: Bool
+
+    :return: The content of the file.
+    :rtype: Bytes
+    """
+    o_cache = cover_cache.get_image_cache() if pb_cache else None
+    if o_cache is not None:
+        b_data = o_cache.get(pu_url)
+        metrics.count('image_cache_misses' if b_data is None else 'image_cache_hits')
+        if b_data is not None:
+            return b_data
+
+    # Retries use the number of tries and delay specified in the constants file
+    with metrics.timer('download'):
+        o_response = http_client.get(pu_url)
+        b_data = o_response.content
+    metrics.count('download_bytes', len(b_data))
+
+    if o_cache is not None:
+        o_cache.set(pu_url, b_data)
+
+    return b_data
 
 
 def dl_file(pu_url, pu_path):
-    # TODO: Retry the download based on the retries and delay specified in the constants file
-    data = requests.get(pu_url)
+    data = dl_bytes(pu_url)
     # Save file data to local copy
     with open(pu_path, 'wb') as o_file:
-        o_file.write(data.content)
+        o_file.write(data)
@@ -0,0 +1,172 @@
+"""
+Library with the HTTP session shared by the whole process. All the modules (ListenBrainz, Cover Art Archive, cover
+downloads and publishers) use it, so keep-alive connections, and their TLS handshakes, are reused between requests.
+"""
+
+import threading
+import urllib.parse
+
+import requests
+import requests.adapters
+
+from . import cassette
+from . import cons
+from . import retry
+
+
+# Session shared by the whole process, see get_session()
+_o_SESSION = None
+_o_SESSION_LOCK = threading.Lock()
+
+
+def _route(pu_url):
+    """
+    Function to send a URL to another server when its host is routed (see cons.ds_HTTP_ROUTES).
+
+    :param pu_url:
+    :type pu_url: Str
+
+    :return: The URL to be requested.
+    :rtype: Str
+    """
+    if not cons.ds_HTTP_ROUTES:
+        return pu_url
+
+    o_url = urllib.parse.urlsplit(pu_url)
+    u_root = cons.ds_HTTP_ROUTES.get(o_url.hostname or '')
+    if u_root is None:
+        return pu_url
+
+    o_root = urllib.parse.urlsplit(u_root)
+    return urllib.parse.urlunsplit((o_root.scheme, o_root.netloc, o_root.path + o_url.path, o_url.query, ''))
+
+
+class _SharedSession(requests.Session):
+    """
+    Session shared by the whole process. It's never closed by its users because some libraries (e.g. tweepy) close
+    their session after every single request, which would throw away all the pooled connections.
+    """
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        # The cassette (see cassette.py) is indexed by the original URL, so it doesn't depend on the routes
+        o_cassette = cassette.get_cassette()
+        if o_cassette is not None and cons.s_CASSETTE_MODE == 'replay':
+            return o_cassette.replay(request)
+
+        # Rate limits and circuit breakers still work with the original host, only the connection goes elsewhere
+        u_url = request.url
+        request.url = _route(u_url)
+        try:
+            o_response = super().send(request, **kwargs)
+        finally:
+            request.url = u_url
+
+        if o_cassette is not None:
+            o_cassette.record(request, o_response)
+        return o_response
+
+
+def get_session():
+    """
+    Function to get the HTTP session shared by the whole process. It's created the first time it's requested.
+
+    :return: The session.
+    :rtype: requests.Session
+    """
+    global _o_SESSION
+
+    with _o_SESSION_LOCK:
+        if _o_SESSION is None:
+            o_session = _SharedSession()
+            o_session.headers['User-Agent'] = cons.s_USER_AGENT
+
+            # One pool of connections per host, each one with enough connections for all the parallel workers
+            o_adapter = requests.adapters.HTTPAdapter(pool_connections=cons.i_HTTP_POOLS,
+                                                      pool_maxsize=cons.i_HTTP_POOL_SIZE)
+            o_session.mount('http://', o_adapter)
+            o_session.mount('https://', o_adapter)
+            _o_SESSION = o_session
+
+    return _o_SESSION
+
+
+def get_timeout():
+    """
+    Function to get the timeout to be used in the requests.
+
+    :return: A tuple with the connection and read timeouts in seconds.
+    :rtype: Tuple[Float, Float]
+    """
+    return cons.f_HTTP_CONNECT_TIMEOUT, cons.f_HTTP_READ_TIMEOUT
+
+
+def get_host(pu_url):
+    """
+    Function to get the host of a URL.
+
+    :param pu_url:
+    :type pu_url: Str
+
+    :return: The host, e.g. 'coverartarchive.org'.
+    :rtype: Str
+    """
+    return urllib.parse.urlsplit(pu_url).hostname or ''
+
+
+def classify_error(po_exception):
+    """
+    Function to decide whether a failed request can be retried (see retry.call()). Connection problems, timeouts,
+    "429 Too Many Requests" and server errors are retried; the rest of errors (e.g. 404) are not.
+
+    :param po_exception: Exception raised by requests.
+    :type po_exception: Exception
+
+    :return: Tuple with a boolean (whether the request can be retried) and the number of seconds the server asked us to
+             wait (None when unknown).
+    :rtype: Tuple[Bool, Union[Float, None]]
+    """
+    if isinstance(po_exception, requests.exceptions.HTTPError) and po_exception.response is not None:
+        i_status = po_exception.response.status_code
+        if i_status in (408, 429) or i_status >= 500:
+            return True, retry.get_rate_limit_wait(po_exception.response.headers)
+        return False, None
+
+    if isinstance(po_exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True, None
+
+    return False, None
+
+
+def get(pu_url, pdx_params=None, pi_tries=None, pf_delay=None):
+    """
+    Function to send a GET request using the shared session. The request is retried when it fails (see retry.call()).
+
+    :param pu_url: URL to request.
+    :type pu_url: Str
+
+    :param pdx_params: Query parameters of the request.
+    :type pdx_params: Dict
+
+    :param pi_tries: Maximum number of tries. cons.i_DL_RETRIES by default.
+    :type pi_tries: Int
+
+    :param pf_delay: Base delay between tries in seconds. cons.i_DL_DELAY by default.
+    :type pf_delay: Float
+
+    :return: The response of the server.
+    :rtype: requests.Response
+
+    :raises requests.exceptions.RequestException: When the request failed, e.g. requests.exceptions.HTTPError for
+                                                  error status codes.
+    """
+    u_host = get_host(pu_url)
+
+    def _get():
+        o_response = get_session().get(pu_url, params=pdx_params, timeout=get_timeout())
+        retry.note_headers(u_host, o_response.headers)
+        o_response.raise_for_status()
+        return o_response
+
+    return retry.call(_get, pu_host=u_host, pf_classify=classify_error, pi_tries=pi_tries, pf_delay=pf_delay)
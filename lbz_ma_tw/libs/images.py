@@ -0,0 +1,109 @@
+"""
+Library to choose the right size of the covers and to adapt them to the limits of each platform before uploading them.
+"""
+
+import io
+
+
+# Size in pixels (largest side) of the thumbnails provided by Cover Art Archive. 'small' and 'large' are the legacy names
+# of '250' and '500'.
+_di_THUMBNAIL_SIZES = {'250': 250,
+                       'small': 250,
+                       '500': 500,
+                       'large': 500,
+                       '1200': 1200}
+
+# Minimum JPEG quality used when recompressing an image to fit a byte budget. Below it, the image is scaled down instead
+_i_MIN_QUALITY = 50
+
+
+def get_thumbnail_url(po_image, pi_size):
+    """
+    Function to get the URL of the smallest thumbnail of an image which is, at least, pi_size pixels big.
+
+    :param po_image:
+    :type po_image: lb_mb_data._Image
+
+    :param pi_size: Target size in pixels. 0 to get the original image.
+    :type pi_size: Int
+
+    :return: The URL of the thumbnail. The original image when no thumbnail is big enough.
+    :rtype: Str
+    """
+    u_url = po_image.u_image
+    i_url_size = None
+    if pi_size > 0:
+        for u_key, u_thumbnail in po_image.du_thumbnails.items():
+            i_size = _di_THUMBNAIL_SIZES.get(u_key)
+            if i_size is not None and i_size >= pi_size and (i_url_size is None or i_size < i_url_size):
+                u_url = u_thumbnail
+                i_url_size = i_size
+
+    if not u_url:
+        raise KeyError('No image available with %s pixels' % pi_size)
+
+    return u_url
+
+
+def fit_image(pb_image, pi_size=0, pi_max_bytes=0, pi_quality=85):
+    """
+    Function to adapt an image to a maximum resolution and a maximum size in bytes. The image is returned untouched when
+    it already fits; otherwise it's scaled down and/or recompressed as JPEG, in memory.
+
+    :param pb_image: Data of the image.
+    :type pb_image: Bytes
+
+    :param pi_size: Maximum size in pixels of the largest side of the image. 0 for no limit.
+    :type pi_size: Int
+
+    :param pi_max_bytes: Maximum size of the data of the image. 0 for no limit.
+    :type pi_max_bytes: Int
+
+    :param pi_quality: JPEG quality used when the image has to be recompressed. It's lowered when needed to fit
+                       pi_max_bytes.
+    :type pi_quality: Int
+
+    :return: The data of the adapted image.
+    :rtype: Bytes
+    """
+    # Pillow is only imported when an image is going to be uploaded, it's slow to import
+    import PIL.Image
+
+    try:
+        o_image = PIL.Image.open(io.BytesIO(pb_image))
+    except (OSError, PIL.UnidentifiedImageError):
+        # Not an image Pillow can read, the platform will decide what to do with it
+        return pb_image
+
+    with o_image:
+        i_size = max(o_image.size)
+        b_too_big = pi_size > 0 and i_size > pi_size
+        b_too_heavy = pi_max_bytes > 0 and len(pb_image) > pi_max_bytes
+        if not (b_too_big or b_too_heavy):
+            return pb_image
+
+        if b_too_big:
+            i_size = pi_size
+            # draft() lets the JPEG decoder scale the image down while decoding, which is much faster
+            o_image.draft('RGB', (i_size, i_size))
+        o_image = o_image.convert('RGB')
+
+    i_quality = pi_quality
+    while True:
+        o_resized = o_image
+        if max(o_image.size) > i_size:
+            o_resized = o_image.copy()
+            o_resized.thumbnail((i_size, i_size), PIL.Image.LANCZOS)
+
+        o_buffer = io.BytesIO()
+        o_resized.save(o_buffer, format='JPEG', quality=i_quality, optimize=True)
+        b_image = o_buffer.getvalue()
+
+        if pi_max_bytes <= 0 or len(b_image) <= pi_max_bytes or i_size <= 1:
+            return b_image
+
+        # First the quality is lowered, then the resolution (the size in bytes is roughly proportional to the area)
+        if i_quality > _i_MIN_QUALITY:
+            i_quality = max(_i_MIN_QUALITY, i_quality - 15)
+        else:
+            i_size = max(1, int(max(o_resized.size) * 0.9 * (pi_max_bytes / len(b_image)) ** 0.5))
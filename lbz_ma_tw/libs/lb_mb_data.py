@@ -2,16 +2,36 @@
 Library with classes to store MusicBrainz and ListenBrainz data.
 """
 
-import musicbrainzngs
-import pylistenbrainz
+import concurrent.futures
+import heapq
+import math
+import sys
+
+import requests
 
 from . import cons
+from . import cover_cache
+from . import http_client
+from . import metrics
+from . import retry
+
+
+def _intern(px_value):
+    """
+    Function to intern a string read from JSON, so the same MBIDs and names repeated in thousands of rows (e.g. the
+    artist of many releases) are stored just once.
+    """
+    return sys.intern(px_value) if isinstance(px_value, str) else px_value
 
 
 class Release:
     """
     Class to store data about releases (which are each of the multiple versions of a music album)
     """
+    # Large stats fetches create thousands of releases, so they don't get a dictionary of attributes each
+    __slots__ = ('i_listen_count', 'lu_artist_mbids', 'u_artist_msid', 'u_artist_name', 'u_release_mbid',
+                 'u_release_msid', 'u_release_name', 'lo_covers')
+
     def __init__(self):
         self.i_listen_count = 0
         self.lu_artist_mbids = []  #
@@ -57,46 +77,104 @@ class Release:
         :return: Nothing, the object will be populated
         """
         self.i_listen_count = pdx_json['listen_count']
-        self.lu_artist_mbids = pdx_json['artist_mbids']
+        self.lu_artist_mbids = [_intern(u_mbid) for u_mbid in pdx_json['artist_mbids'] or []]
 
         try:
-            self.u_artist_msid = pdx_json['artist_msid']
+            self.u_artist_msid = _intern(pdx_json['artist_msid'])
         except KeyError:
             pass
 
-        self.u_artist_name = pdx_json['artist_name']
-        self.u_release_mbid = pdx_json['release_mbid']
+        self.u_artist_name = _intern(pdx_json['artist_name'])
+        self.u_release_mbid = _intern(pdx_json['release_mbid'])
 
         try:
-            self.u_release_msid = pdx_json['release_msid']
+            self.u_release_msid = _intern(pdx_json['release_msid'])
         except KeyError:
             pass
         
         self.u_release_name = pdx_json['release_name']
 
-    def fetch_mb_covers(self):
+    def to_dict(self):
+        """
+        Method to get the data of the release (with its covers) as a dictionary that can be stored as JSON, see
+        from_dict().
+
+        :rtype: Dict
+        """
+        return {'listen_count': self.i_listen_count,
+                'artist_mbids': self.lu_artist_mbids,
+                'artist_msid': self.u_artist_msid,
+                'artist_name': self.u_artist_name,
+                'release_mbid': self.u_release_mbid,
+                'release_msid': self.u_release_msid,
+                'release_name': self.u_release_name,
+                'covers': [o_cover.to_dict_data() for o_cover in self.lo_covers]}
+
+    def from_dict(self, pdx_data):
+        """
+        Method to populate the object (covers included) from a dictionary built by to_dict().
+
+        :param pdx_data:
+        :type pdx_data: Dict
+
+        :return: Nothing, the object will be populated
+        """
+        self.from_lb_json(pdx_data)
+        self.lo_covers = []
+        for dx_data in pdx_data['covers']:
+            o_image = _Image()
+            o_image.from_dict_data(dx_data)
+            self.lo_covers.append(o_image)
+
+    def fetch_mb_covers(self, pb_front=None):
         """
-        Method to load the MusicBrainz covers.
+        Method to load the MusicBrainz covers. The persistent cover cache is checked first, and only when the release is
+        not found there, Cover Art Archive is queried.
+
+        :param pb_front: Whether the release is known to have a front cover (see get_front_flags()). When False, Cover
+                         Art Archive is not queried. None when unknown.
+        :type pb_front: Union[Bool, None]
 
         :return: Nothing, the covers will be stored in the object.
         """
         self.lo_covers = []
 
         if self.u_release_mbid:
-            for i_try in range(cons.i_DL_RETRIES):
+            o_cache = cover_cache.get_cache()
+            ldx_covers = None
+            if o_cache is not None:
+                ldx_covers = o_cache.get(self.u_release_mbid)
+                metrics.count('cover_cache_misses' if ldx_covers is None else 'cover_cache_hits')
+
+            if ldx_covers is None and pb_front is False:
+                metrics.count('caa_lookups_skipped')
+                ldx_covers = []
+
+            elif ldx_covers is None:
+                # Retries, rate limit (as required by MusicBrainz) and backoff are handled by the HTTP client
                 try:
-                    ldx_data = musicbrainzngs.get_image_list(self.u_release_mbid)['images']
-                    for dx_data in ldx_data:
-                        o_image = _Image()
-                        o_image.from_dict_data(dx_data)
-                        if o_image.b_front:
-                            self.lo_covers.append(o_image)
-                    break
-                except musicbrainzngs.musicbrainz.ResponseError:
+                    ldx_data = _get_caa_images(self.u_release_mbid)
+                    ldx_covers = [dx_data for dx_data in ldx_data if dx_data['front']]
+                except requests.exceptions.HTTPError as o_exception:
+                    # 404 means the release has no artwork at all
+                    if o_exception.response.status_code == 404:
+                        ldx_covers = []
+                except (requests.exceptions.RequestException, retry.CircuitOpenError):
                     pass
 
+                if o_cache is not None and ldx_covers is not None:
+                    o_cache.set(self.u_release_mbid, ldx_covers)
+
+            for dx_data in ldx_covers or []:
+                o_image = _Image()
+                o_image.from_dict_data(dx_data)
+                self.lo_covers.append(o_image)
+
 
 class _Image:
+    __slots__ = ('b_approved', 'b_back', 'u_comment', 'i_edit', 'b_front', 'i_id', 'u_image', 'du_thumbnails',
+                 'lu_types')
+
     def __init__(self):
         self.b_approved = False  # Whether the image has been approved
         self.b_back = False      # Whether the image correspond to the back of the release
@@ -142,8 +220,116 @@ class _Image:
         self.du_thumbnails = pdx_data['thumbnails']
         self.lu_types = pdx_data['types']
 
+    def to_dict_data(self):
+        """
+        Method to get the data of the cover object, with the same format used by from_dict_data().
 
-def get_lb_releases(pu_user, pi_count=25, pi_offset=0, pu_time_range='all_time'):
+        :rtype: Dict
+        """
+        return {'approved': self.b_approved,
+                'back': self.b_back,
+                'comment': self.u_comment,
+                'edit': self.i_edit,
+                'front': self.b_front,
+                'id': self.i_id,
+                'image': self.u_image,
+                'thumbnails': self.du_thumbnails,
+                'types': self.lu_types}
+
+
+class ReleaseTable:
+    """
+    Class to store the releases of a stats fetch, in ListenBrainz order (from the most listened to the less listened),
+    indexed by MusicBrainz Id. Duplicated releases (ListenBrainz sometimes points twice to the same release) are found
+    in constant time, so building the table is linear no matter how many rows are fetched.
+    """
+    __slots__ = ('lo_releases', '_do_verified')
+
+    def __init__(self):
+        self.lo_releases = []    # All the distinct releases, verified or not
+        self._do_verified = {}   # MusicBrainz Id -> release, in insertion order
+
+    def __len__(self):
+        return len(self.lo_releases)
+
+    def __iter__(self):
+        return iter(self.lo_releases)
+
+    def __contains__(self, pu_mbid):
+        return pu_mbid in self._do_verified
+
+    def add(self, po_release):
+        """
+        Method to add a release, unless another one with the same MusicBrainz Id was already added. Unverified releases
+        (without MusicBrainz Id) are always added.
+
+        :param po_release:
+        :type po_release: lb_mb_data.Release
+
+        :return: True when the release was added, False when it was a duplicate.
+        :rtype: Bool
+        """
+        u_mbid = po_release.u_release_mbid
+        if u_mbid:
+            if u_mbid in self._do_verified:
+                return False
+            self._do_verified[u_mbid] = po_release
+
+        self.lo_releases.append(po_release)
+        return True
+
+    def extend(self, plo_releases, pi_verified=0):
+        """
+        Method to add releases from an iterable, consumed lazily.
+
+        :param plo_releases:
+        :type plo_releases: Iterable[lb_mb_data.Release]
+
+        :param pi_verified: Number of verified releases after which no more releases are consumed (e.g. so no more
+                            pages are requested to ListenBrainz, see iter_lb_releases()). 0 to consume all of them.
+        :type pi_verified: Int
+
+        :return: Nothing
+        """
+        if pi_verified and len(self._do_verified) >= pi_verified:
+            return
+
+        for o_release in plo_releases:
+            self.add(o_release)
+            if pi_verified and len(self._do_verified) >= pi_verified:
+                break
+
+    def get(self, pu_mbid):
+        """
+        :return: The release with a MusicBrainz Id, None when it's not in the table.
+        :rtype: Union[lb_mb_data.Release, None]
+        """
+        return self._do_verified.get(pu_mbid)
+
+    def get_verified(self):
+        """
+        :return: The verified releases (with MusicBrainz Id), in ListenBrainz order.
+        :rtype: List[lb_mb_data.Release]
+        """
+        return list(self._do_verified.values())
+
+    def get_top(self, pi_count, pb_verified=True):
+        """
+        Method to get the most listened releases. Releases with the same number of listens keep ListenBrainz order.
+
+        :param pi_count: Number of releases.
+        :type pi_count: Int
+
+        :param pb_verified: Whether only the verified releases must be considered.
+        :type pb_verified: Bool
+
+        :rtype: List[lb_mb_data.Release]
+        """
+        lo_releases = self._do_verified.values() if pb_verified else self.lo_releases
+        return heapq.nlargest(pi_count, lo_releases, key=lambda o_release: o_release.i_listen_count)
+
+
+def get_lb_releases(pu_user, pi_count=25, pi_offset=0, pu_time_range='all_time', pb_covers=True):
     """
     Function to get the latest releases for a user from ListenBrainz.
 
@@ -165,26 +351,210 @@ def get_lb_releases(pu_user, pi_count=25, pi_offset=0, pu_time_range='all_time')
                             - 'year'
     :type pu_time_range: Str
 
+    :param pb_covers: Whether the covers of the releases must be fetched from MusicBrainz or not.
+    :type pb_covers: Bool
+
     :return:
     :rtype List[lb_mb_data.Release]
     """
+    lo_releases = list(iter_lb_releases(pu_user=pu_user,
+                                        pi_count=pi_count,
+                                        pi_offset=pi_offset,
+                                        pu_time_range=pu_time_range))
+    if pb_covers:
+        fetch_mb_covers(lo_releases)
 
-    client = pylistenbrainz.ListenBrainz()
-    dx_data = client.get_user_releases(username=pu_user,
-                                       count=pi_count,
-                                       offset=pi_offset,
-                                       time_range=pu_time_range)
+    return lo_releases
 
-    try:
-        ldx_releases = dx_data['payload']['releases']
-    except TypeError:
-        ldx_releases = []
 
-    lo_releases = []
-    for dx_result in ldx_releases:
-        o_release = Release()
-        o_release.from_lb_json(dx_result)
-        o_release.fetch_mb_covers()
-        lo_releases.append(o_release)
+@metrics.timer('lb_page')
+def _get_lb_page(pu_user, pi_count, pi_offset, pu_time_range):
+    """
+    Function to get a page of releases of a user from ListenBrainz.
 
-    return lo_releases
+    Parameters are the same as in get_lb_releases().
+
+    :return: Tuple with the data of the releases in the page and the total number of releases of the user (None when
+             unknown).
+    :rtype: Tuple[List[Dict], Union[Int, None]]
+    """
+    u_url = '%s/1/stats/user/%s/releases' % (cons.s_LB_API_ROOT, pu_user)
+    o_response = http_client.get(u_url, pdx_params={'count': pi_count,
+                                                     'offset': pi_offset,
+                                                     'range': pu_time_range})
+
+    # ListenBrainz answers with "204 No Content" when the statistics of the user haven't been calculated yet
+    if o_response.status_code == 204:
+        return [], 0
+
+    dx_payload = o_response.json()['payload']
+    return dx_payload['releases'], dx_payload.get('total_release_count')
+
+
+def iter_lb_releases(pu_user, pi_count=25, pi_offset=0, pu_time_range='all_time', pi_wanted=0):
+    """
+    Generator to get the latest releases for a user from ListenBrainz. Covers are NOT fetched, so the caller can filter
+    the releases first and only fetch the covers (see fetch_mb_covers()) of the ones that are going to be used. Nothing
+    is requested to ListenBrainz until the first release is consumed.
+
+    When pi_wanted is specified, the releases are requested page by page (the first one with pi_count releases) until
+    the consumer stops asking for more or the releases of the user are exhausted. The size of every new page adapts to
+    the ratio of useful releases (verified and not duplicated) seen so far, so the missing ones are obtained with as few
+    rows and requests as possible.
+
+    Parameters are the same as in get_lb_releases(), plus:
+
+    :param pi_wanted: Number of useful releases the consumer is expected to keep. 0 to get a single page.
+    :type pi_wanted: Int
+
+    :return: The releases, from the most listened to the less listened.
+    :rtype Iterator[lb_mb_data.Release]
+    """
+    i_offset = pi_offset
+    i_count = min(pi_count, cons.i_LB_PAGE_MAX)
+    i_fetched = 0
+    su_useful_mbids = set()
+
+    while True:
+        ldx_releases, i_total = _get_lb_page(pu_user=pu_user,
+                                             pi_count=i_count,
+                                             pi_offset=i_offset,
+                                             pu_time_range=pu_time_range)
+
+        for dx_result in ldx_releases:
+            o_release = Release()
+            o_release.from_lb_json(dx_result)
+            if o_release.u_release_mbid:
+                su_useful_mbids.add(o_release.u_release_mbid)
+            yield o_release
+
+        # Stopping when a single page was asked, or there are no more releases
+        i_fetched += len(ldx_releases)
+        i_offset += len(ldx_releases)
+        b_exhausted = len(ldx_releases) < i_count or (i_total is not None and i_offset >= i_total)
+        if not pi_wanted or b_exhausted:
+            break
+
+        # The consumer wants more releases, so the next page is sized after the ratio of useful releases found so far.
+        # Without any useful release yet, the page size is just doubled.
+        i_missing = max(1, pi_wanted - len(su_useful_mbids))
+        if su_useful_mbids:
+            i_count = math.ceil(i_missing * i_fetched / len(su_useful_mbids))
+        else:
+            i_count *= 2
+        i_count = max(1, min(i_count, cons.i_LB_PAGE_MAX))
+
+
+@metrics.timer('caa_lookup')
+def _get_caa_images(pu_mbid):
+    """
+    Function to get the list of images of a release from Cover Art Archive.
+
+    :param pu_mbid: MusicBrainz Id of the release.
+    :type pu_mbid: Str
+
+    :return: List with the data of each image, see _Image.from_dict_data().
+    :rtype: List[Dict]
+
+    :raises requests.exceptions.RequestException: When the images couldn't be obtained (e.g. 404 when the release has
+                                                  no artwork at all).
+    """
+    o_response = http_client.get('%s/release/%s' % (cons.s_CAA_ROOT, pu_mbid))
+    return o_response.json()['images']
+
+
+@metrics.timer('mb_search')
+def _get_mb_front_flags(plu_mbids):
+    """
+    Function to get the front cover flags of several releases with a single MusicBrainz search.
+
+    :param plu_mbids: MusicBrainz Ids of the releases (cons.i_MB_SEARCH_BATCH at most).
+    :type plu_mbids: List[Str]
+
+    :return: Dictionary with whether each release has a front cover in Cover Art Archive. The releases not found, or
+             without the flag, are not included.
+    :rtype: Dict[Str, Bool]
+
+    :raises requests.exceptions.RequestException: When the search failed.
+    """
+    dx_params = {'query': 'reid:(%s)' % ' OR '.join(plu_mbids),
+                 'limit': len(plu_mbids),
+                 'fmt': 'json'}
+    o_response = http_client.get('%s/release' % cons.s_MB_API_ROOT, pdx_params=dx_params)
+
+    su_mbids = set(plu_mbids)
+    db_front = {}
+    for dx_release in o_response.json().get('releases', []):
+        x_front = (dx_release.get('cover-art-archive') or {}).get('front')
+        if dx_release.get('id') in su_mbids and isinstance(x_front, bool):
+            db_front[dx_release['id']] = x_front
+
+    return db_front
+
+
+def get_front_flags(plo_releases):
+    """
+    Function to find out which releases have a front cover before querying Cover Art Archive for each one of them. The
+    releases already in the cover cache are skipped, and the rest are asked to MusicBrainz in batches of
+    cons.i_MB_SEARCH_BATCH releases.
+
+    A release is only considered to have no front cover when MusicBrainz says so explicitly; when the search fails, or
+    the release is not found (e.g. it's not indexed yet), its flag is unknown and Cover Art Archive is queried as usual.
+
+    :param plo_releases:
+    :type plo_releases: List[lb_mb_data.Release]
+
+    :return: Dictionary with whether each release has a front cover, indexed by MusicBrainz Id. Only the known flags
+             are included.
+    :rtype: Dict[Str, Bool]
+    """
+    lu_mbids = list(dict.fromkeys(o_release.u_release_mbid for o_release in plo_releases if o_release.u_release_mbid))
+    o_cache = cover_cache.get_cache()
+    if o_cache is not None:
+        lu_mbids = o_cache.get_missing(lu_mbids)
+
+    # A single release is cheaper to query directly
+    db_front = {}
+    if cons.i_MB_SEARCH_BATCH and len(lu_mbids) > 1:
+        for i_start in range(0, len(lu_mbids), cons.i_MB_SEARCH_BATCH):
+            try:
+                db_front.update(_get_mb_front_flags(lu_mbids[i_start:i_start + cons.i_MB_SEARCH_BATCH]))
+            except (requests.exceptions.RequestException, retry.CircuitOpenError, ValueError):
+                pass
+
+    return db_front
+
+
+def fetch_mb_covers(plo_releases, pi_workers=None):
+    """
+    Function to load the MusicBrainz covers of several releases at the same time using a pool of workers. The global
+    rate limit of requests to MusicBrainz is respected no matter the number of workers. Cover Art Archive is not queried
+    for the releases MusicBrainz says have no front cover (see get_front_flags()).
+
+    :param plo_releases: Releases to get the covers for.
+    :type plo_releases: List[lb_mb_data.Release]
+
+    :param pi_workers: Number of parallel workers. If not specified, cons.i_MB_WORKERS will be used.
+    :type pi_workers: Int
+
+    :return: The same list of releases (in the same order) with their covers loaded.
+    :rtype: List[lb_mb_data.Release]
+    """
+    if pi_workers is None:
+        pi_workers = cons.i_MB_WORKERS
+
+    db_front = get_front_flags(plo_releases)
+
+    def _fetch(po_release):
+        po_release.fetch_mb_covers(pb_front=db_front.get(po_release.u_release_mbid))
+
+    i_workers = max(1, min(pi_workers, len(plo_releases)))
+    if i_workers == 1:
+        for o_release in plo_releases:
+            _fetch(o_release)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=i_workers) as o_executor:
+            # Consuming the results, so any exception raised by the workers is propagated
+            list(o_executor.map(_fetch, plo_releases))
+
+    return plo_releases
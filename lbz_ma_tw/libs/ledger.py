@@ -0,0 +1,321 @@
+"""
+Library with a persistent (SQLite) ledger of the reports, see cons.s_LEDGER. Every stage of a report completed by a run
+(the releases resolved with their covers, the covers uploaded to each platform and the message posted to each platform)
+is recorded, indexed by user, period, interval (e.g. '2025-09' for the month report published in October) and platform.
+When a report is retried after a failure (e.g. Twitter failed after Mastodon had already posted), it resumes from the
+first stage not completed, so the retry costs almost nothing and no message is ever posted twice.
+"""
+
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from . import cons
+from . import cover_cache
+from . import lb_mb_data
+
+
+# Seconds an uploaded media is attached to messages of later tries. Platforms remove the media not attached to any
+# message after some time (one day in Twitter and Mastodon), so old ones are uploaded again.
+_i_MEDIA_TTL = 12 * 3600
+
+# Days the stages of a report are kept (enough for the year report to be retried for a while)
+_i_KEEP_DAYS = 400
+
+# Ledger shared by the whole process, see get_ledger(). A ledger that can't be opened is disabled for the rest of the
+# process.
+_o_LEDGER = None
+_b_LEDGER_FAILED = False
+_o_LEDGER_LOCK = threading.Lock()
+
+
+class Ledger:
+    """
+    Class to store the completed stages of the reports, as JSON data. Each stage is indexed by user, period, interval,
+    platform (empty for stages shared by all the platforms) and name of the stage.
+    """
+    def __init__(self, pu_path, pi_keep_days=_i_KEEP_DAYS):
+        """
+        :param pu_path: Path of the SQLite database file. Its parent directory is created when needed.
+        :type pu_path: Str
+
+        :param pi_keep_days: Number of days the stages are kept.
+        :type pi_keep_days: Int
+        """
+        self.u_path = pu_path
+
+        # The connection is shared by all the threads publishing messages, so access is serialized with a lock
+        self._o_lock = threading.Lock()
+        self._o_db = cover_cache._connect(pu_path)
+        with self._o_lock, self._o_db:
+            self._o_db.execute('CREATE TABLE IF NOT EXISTS stages ('
+                               'user TEXT NOT NULL, '
+                               'period TEXT NOT NULL, '
+                               'interval TEXT NOT NULL, '
+                               'platform TEXT NOT NULL, '
+                               'stage TEXT NOT NULL, '
+                               'data TEXT NOT NULL, '
+                               'stored REAL NOT NULL, '
+                               'PRIMARY KEY (user, period, interval, platform, stage))')
+            self._o_db.execute('DELETE FROM stages WHERE stored < ?', (time.time() - pi_keep_days * 86400,))
+
+    def get(self, ptu_key, ps_stage):
+        """
+        Method to get the data of a completed stage.
+
+        :param ptu_key: User, period, interval and platform of the stage.
+        :type ptu_key: Tuple[Str, Str, Str, Str]
+
+        :param ps_stage: Name of the stage, e.g. 'status'.
+        :type ps_stage: Str
+
+        :return: The data of the stage, None when it's not completed.
+        :rtype: Any
+        """
+        with self._o_lock, self._o_db:
+            o_row = self._o_db.execute('SELECT data FROM stages '
+                                       'WHERE user = ? AND period = ? AND interval = ? AND platform = ? AND stage = ?',
+                                       ptu_key + (ps_stage,)).fetchone()
+
+        return json.loads(o_row[0]) if o_row is not None else None
+
+    def set(self, ptu_key, ps_stage, px_data):
+        """
+        Method to record a completed stage.
+
+        :param ptu_key: User, period, interval and platform of the stage.
+        :type ptu_key: Tuple[Str, Str, Str, Str]
+
+        :param ps_stage: Name of the stage, e.g. 'status'.
+        :type ps_stage: Str
+
+        :param px_data: Data of the stage. It must be JSON serializable.
+        :type px_data: Any
+
+        :return: Nothing
+        """
+        with self._o_lock, self._o_db:
+            self._o_db.execute('INSERT OR REPLACE INTO stages (user, period, interval, platform, stage, data, stored) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               ptu_key + (ps_stage, json.dumps(px_data), time.time()))
+
+    def update(self, ptu_key, ps_stage, pf_update):
+        """
+        Method to change the data of a stage atomically, so several threads can add data to the same stage (e.g. the
+        media uploaded in parallel) without losing any of it.
+
+        :param ptu_key: User, period, interval and platform of the stage.
+        :type ptu_key: Tuple[Str, Str, Str, Str]
+
+        :param ps_stage: Name of the stage, e.g. 'media'.
+        :type ps_stage: Str
+
+        :param pf_update: Function receiving the current data of the stage (None when it's not completed) and returning
+                          the new one.
+        :type pf_update: Callable
+
+        :return: Nothing
+        """
+        with self._o_lock, self._o_db:
+            o_row = self._o_db.execute('SELECT data FROM stages '
+                                       'WHERE user = ? AND period = ? AND interval = ? AND platform = ? AND stage = ?',
+                                       ptu_key + (ps_stage,)).fetchone()
+            px_data = pf_update(json.loads(o_row[0]) if o_row is not None else None)
+            self._o_db.execute('INSERT OR REPLACE INTO stages (user, period, interval, platform, stage, data, stored) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               ptu_key + (ps_stage, json.dumps(px_data), time.time()))
+
+
+class Run:
+    """
+    Class with the stages of the report of a user for a period, e.g. the month report of September 2025.
+    """
+    def __init__(self, po_ledger, pu_user, ps_period, ps_interval):
+        """
+        :param po_ledger:
+        :type po_ledger: ledger.Ledger
+
+        :param pu_user: ListenBrainz user.
+        :type pu_user: Str
+
+        :param ps_period: Period of the report, e.g. 'month'.
+        :type ps_period: Str
+
+        :param ps_interval: Interval of the report, see get_interval().
+        :type ps_interval: Str
+        """
+        self.o_ledger = po_ledger
+        self.tu_key = (pu_user, ps_period, ps_interval)
+
+    def get_releases(self):
+        """
+        :return: The releases of the report, with their covers. None when they haven't been resolved yet.
+        :rtype: Union[List[lb_mb_data.Release], None]
+        """
+        ldx_releases = self.o_ledger.get(self.tu_key + ('',), 'releases')
+        if ldx_releases is None:
+            return None
+
+        lo_releases = []
+        for dx_release in ldx_releases:
+            o_release = lb_mb_data.Release()
+            o_release.from_dict(dx_release)
+            lo_releases.append(o_release)
+
+        return lo_releases
+
+    def set_releases(self, plo_releases):
+        """
+        :param plo_releases: The releases of the report, with their covers already resolved.
+        :type plo_releases: List[lb_mb_data.Release]
+
+        :return: Nothing
+        """
+        self.o_ledger.set(self.tu_key + ('',), 'releases', [o_release.to_dict() for o_release in plo_releases])
+
+    def get_media_ids(self, ps_platform):
+        """
+        Method to get the images uploaded to a platform recently enough to be attached to a message.
+
+        :param ps_platform: Name of the platform, e.g. 'toot'.
+        :type ps_platform: Str
+
+        :return: Dictionary with the media id of each image, indexed by its key (see get_media_key()).
+        :rtype: Dict[Str, Union[Str, Int]]
+        """
+        f_oldest = time.time() - _i_MEDIA_TTL
+        dlx_uploads = self.o_ledger.get(self.tu_key + (ps_platform,), 'media') or {}
+        return {s_hash: x_media_id for s_hash, (x_media_id, f_uploaded) in dlx_uploads.items() if f_uploaded > f_oldest}
+
+    def add_media_ids(self, ps_platform, pdx_media_ids):
+        """
+        Method to record the images uploaded to a platform. The ones recorded before are kept.
+
+        :param ps_platform: Name of the platform, e.g. 'toot'.
+        :type ps_platform: Str
+
+        :param pdx_media_ids: Dictionary with the media id of each uploaded image, indexed by its key.
+        :type pdx_media_ids: Dict[Str, Union[Str, Int]]
+
+        :return: Nothing
+        """
+        f_now = time.time()
+
+        def _add(pdlx_uploads):
+            dlx_uploads = pdlx_uploads or {}
+            dlx_uploads.update({s_key: [x_media_id, f_now] for s_key, x_media_id in pdx_media_ids.items()})
+            return dlx_uploads
+
+        self.o_ledger.update(self.tu_key + (ps_platform,), 'media', _add)
+
+    def get_status(self, ps_platform):
+        """
+        :param ps_platform: Name of the platform, e.g. 'toot'.
+        :type ps_platform: Str
+
+        :return: The id of the message posted to the platform, None when it hasn't been posted yet.
+        :rtype: Union[Str, Int, None]
+        """
+        return self.o_ledger.get(self.tu_key + (ps_platform,), 'status')
+
+    def set_status(self, ps_platform, px_status_id):
+        """
+        :param ps_platform: Name of the platform, e.g. 'toot'.
+        :type ps_platform: Str
+
+        :param px_status_id: Id of the message posted to the platform.
+        :type px_status_id: Union[Str, Int]
+
+        :return: Nothing
+        """
+        self.o_ledger.set(self.tu_key + (ps_platform,), 'status', px_status_id)
+
+
+def get_media_key(pb_data, pdi_copies):
+    """
+    Function to get the key identifying an uploaded image in the ledger: the hash of its data. The same image might be
+    attached twice to a message (e.g. two editions sharing their cover), and each copy is a different media, so the
+    second copy gets the key "<hash>.2", and so on.
+
+    :param pb_data:
+    :type pb_data: Bytes
+
+    :param pdi_copies: Number of copies of each image already seen in the message, indexed by hash. It's updated in
+                       place.
+    :type pdi_copies: Dict[Str, Int]
+
+    :rtype: Str
+    """
+    s_hash = hashlib.sha1(pb_data).hexdigest()
+    pdi_copies[s_hash] = pdi_copies.get(s_hash, 0) + 1
+    return s_hash if pdi_copies[s_hash] == 1 else '%s.%s' % (s_hash, pdi_copies[s_hash])
+
+
+def get_interval(ps_period, po_today=None):
+    """
+    Function to get the interval of a report published on a date, so the retries of a report share the same stages, but
+    the report of the next interval doesn't.
+
+    :param ps_period: Period of the report, 'month' or 'year' (or any other ListenBrainz time range).
+    :type ps_period: Str
+
+    :param po_today: Date of the report. Today by default.
+    :type po_today: datetime.date
+
+    :return: The last month for month reports (e.g. '2025-09'), the last year for year reports (e.g. '2025'), and the
+             date itself for any other period.
+    :rtype: Str
+    """
+    o_today = po_today or datetime.date.today()
+    if ps_period == 'month':
+        return (o_today.replace(day=1) - datetime.timedelta(days=1)).strftime('%Y-%m')
+    elif ps_period == 'year':
+        return str(o_today.year - 1)
+    return o_today.isoformat()
+
+
+def get_ledger():
+    """
+    Function to get the ledger shared by the whole process.
+
+    :return: The ledger, or None if it's disabled (empty LEDGER, or a cassette being recorded or replayed) or it can't
+             be opened. It's also disabled in debug mode, since nothing is really posted.
+    :rtype: Union[None, ledger.Ledger]
+    """
+    global _o_LEDGER, _b_LEDGER_FAILED
+
+    if not cons.s_LEDGER or cons.b_DEBUG:
+        return None
+
+    with _o_LEDGER_LOCK:
+        if _o_LEDGER is None and not _b_LEDGER_FAILED:
+            try:
+                _o_LEDGER = Ledger(cons.s_LEDGER)
+            except (OSError, sqlite3.Error) as o_exception:
+                _b_LEDGER_FAILED = True
+                print('WARNING: Ledger "%s" can\'t be opened (%s), running without it' % (cons.s_LEDGER, o_exception))
+
+    return _o_LEDGER
+
+
+def get_run(pu_user, ps_period):
+    """
+    Function to get the stages of the current report of a user.
+
+    :param pu_user: ListenBrainz user.
+    :type pu_user: Str
+
+    :param ps_period: Period of the report, e.g. 'month'.
+    :type ps_period: Str
+
+    :return: The stages of the report, None when the ledger is disabled (see get_ledger()).
+    :rtype: Union[None, ledger.Run]
+    """
+    o_ledger = get_ledger()
+    if o_ledger is None:
+        return None
+
+    return Run(o_ledger, pu_user, ps_period, get_interval(ps_period))
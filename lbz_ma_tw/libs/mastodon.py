@@ -1,60 +1,162 @@
 """
 Library to send messages to mastodon.
 """
+import concurrent.futures
+import functools
+import threading
+import uuid
+
 import mastodon
-import urllib3
 
+from . import cons
+from . import http_client
+from . import images
+from . import metrics
+from . import retry
+
+
+# Whether the same uploaded media can be attached to several messages. Mastodon attaches every media to a single status,
+# so the covers are uploaded again for every message.
+b_REUSABLE_MEDIA = False
+
+# Mastodon clients already created, indexed by (instance, token), see _get_client()
+_do_CLIENTS = {}
+_o_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_client(ps_instance, ps_token):
+    """
+    Function to get a Mastodon client, which is created only once per instance and token and uses the HTTP session
+    shared by the whole process.
+
+    :param ps_instance: URL of the Mastodon instance.
+    :type ps_instance: Str
+
+    :param ps_token: Access token of the account.
+    :type ps_token: Str
 
-def toot(ps_text, pls_images='', pb_debug=False, ps_instance='', ps_token='', pi_retries=5, ):
+    :return: The client.
+    :rtype: mastodon.Mastodon
+    """
+    with _o_CLIENTS_LOCK:
+        o_client = _do_CLIENTS.get((ps_instance, ps_token))
+        if o_client is None:
+            o_client = mastodon.Mastodon(access_token=ps_token,
+                                         api_base_url=ps_instance,
+                                         session=http_client.get_session(),
+                                         request_timeout=http_client.get_timeout())
+            _do_CLIENTS[(ps_instance, ps_token)] = o_client
+
+    return o_client
+
+
+def _classify_error(po_exception):
+    """
+    Function to decide whether a failed Mastodon request can be retried (see retry.call()). Rate-limit headers are
+    already honoured by Mastodon.py itself.
+
+    :param po_exception:
+    :type po_exception: Exception
+
+    :return: Tuple with a boolean (whether the request can be retried) and None (the time to wait is unknown).
+    :rtype: Tuple[Bool, None]
+    """
+    b_retry = isinstance(po_exception, (mastodon.MastodonNetworkError,
+                                        mastodon.MastodonServerError,
+                                        mastodon.MastodonRatelimitError))
+    return b_retry, None
+
+
+def upload_image(pb_image, ps_instance='', ps_token=''):
+    """
+    Function to upload an image to Mastodon, so it can be attached to a toot later (see toot()). The image is adapted
+    first to the size limits of Mastodon (see images.fit_image()).
+
+    :param pb_image: Data of the image.
+    :type pb_image: Bytes
+
+    :return: The id of the uploaded media.
+    :rtype: Str
+    """
+    pb_image = images.fit_image(pb_image,
+                                pi_size=cons.i_MA_IMAGE_SIZE,
+                                pi_max_bytes=cons.i_MA_IMAGE_BYTES,
+                                pi_quality=cons.i_IMAGE_QUALITY)
+    metrics.count('upload_bytes', len(pb_image))
+    o_mastodon = _get_client(ps_instance=ps_instance, ps_token=ps_token)
+    #TODO: Guess the mime_type from the file extension. Create a function because it'll helpful for twitter also
+    f_upload = functools.partial(o_mastodon.media_post, media_file=pb_image, mime_type='image/jpeg')
+    # Every try is measured
+    f_upload = metrics.timer('mastodon_upload')(f_upload)
+    ds_media_meta = retry.call(f_upload,
+                               pu_host=http_client.get_host(ps_instance),
+                               pf_classify=_classify_error,
+                               pi_tries=cons.i_MSG_RETRIES,
+                               pf_delay=cons.i_MSG_DELAY)
+    return ds_media_meta['id']
+
+
+def toot(ps_text, plb_images=(), pb_debug=False, ps_instance='', ps_token='', pi_retries=None, pls_media_ids=()):
     """
     Function to publish information in Mastodon.
     :param ps_text:
     :type ps_text: Str
 
-    :param pls_images: List with the URL of images to be uploaded.
-    :type pls_images: List[Str]
+    :param plb_images: List with the data of the images to be uploaded.
+    :type plb_images: List[Bytes]
+
+    :param pls_media_ids: List with the ids of images already uploaded (see upload_image()). They are attached before
+                          the ones in plb_images.
+    :type pls_media_ids: List[Str]
 
     :param pb_debug: Whether the function is working in debug mode or not. In debug mode, the toots won't be sent at
                      all.
     :type pb_debug: Bool
 
-    :return: A boolean indicating whether the post was successful or not.
-    :rtype: Bool
+    :param pi_retries: Maximum number of tries when posting the toot. cons.i_MSG_RETRIES by default.
+    :type pi_retries: Int
+
+    :return: The id of the toot once it's posted, True in debug mode (nothing is posted).
+    :rtype: Union[Str, Bool]
     """
     # [0/?] Initialization
     #---------------------
-    b_published = False
+    x_published = False
 
     # [2/?] Actual tweet posting
     #---------------------------
     if pb_debug:
-        b_published = True
+        x_published = True
 
     else:
         # [1/?] Authentication
         #----------------------
         #TODO: Replace mastodon server from with one read from environment variables
-        o_mastodon = mastodon.Mastodon(access_token=ps_token, api_base_url=ps_instance)
+        o_mastodon = _get_client(ps_instance=ps_instance, ps_token=ps_token)
 
         # [2/?] Uploading the image of the entry to mastodon
         #---------------------------------------------------
-        ls_media_ids = []
-        if pls_images:
-            o_http_pool = urllib3.PoolManager()
-            for s_image in pls_images:
-                o_response = o_http_pool.request('GET', s_image)
-                s_img_data = o_response.data
-                #TODO: Guess the mime_type from the file extension. Create a function because it'll helpful for twitter also
-                ds_media_meta = o_mastodon.media_post(media_file=s_img_data, mime_type='image/jpeg')
-                s_media_id = ds_media_meta['id']
-                ls_media_ids.append(s_media_id)
+        ls_media_ids = list(pls_media_ids)
+        if plb_images:
+            f_upload = functools.partial(upload_image, ps_instance=ps_instance, ps_token=ps_token)
+            i_workers = min(cons.i_UPLOAD_WORKERS, len(plb_images))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=i_workers) as o_executor:
+                # map() keeps the order of the images
+                ls_media_ids += list(o_executor.map(f_upload, plb_images))
 
         # [3/?] Posting the message
         #--------------------------
-        for i_retry in range(pi_retries):
-            o_mastodon.status_post(ps_text, media_ids=ls_media_ids)
-            b_published = True
-            break
-            #time.sleep(i_DELAY)
+        # The same idempotency key is used in all the tries, so Mastodon never publishes the toot twice (e.g. when the
+        # toot was received but the answer timed out)
+        f_post = functools.partial(o_mastodon.status_post, ps_text,
+                                   media_ids=ls_media_ids,
+                                   idempotency_key=uuid.uuid4().hex)
+        f_post = metrics.timer('mastodon_post')(f_post)
+        dx_status = retry.call(f_post,
+                               pu_host=http_client.get_host(ps_instance),
+                               pf_classify=_classify_error,
+                               pi_tries=pi_retries if pi_retries is not None else cons.i_MSG_RETRIES,
+                               pf_delay=cons.i_MSG_DELAY)
+        x_published = str(dx_status['id'])
 
-    return b_published
+    return x_published
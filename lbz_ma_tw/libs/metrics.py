@@ -0,0 +1,184 @@
+"""
+Library to measure the run: timers around every network operation (ListenBrainz pages, Cover Art Archive lookups,
+downloads, uploads and posts) and counters (retries, cache hits, bytes...). The results of a run can be exported as a
+JSON summary and as a Prometheus textfile collector file.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+from . import cons
+
+
+# Prefix of the Prometheus metrics
+_s_PROM_PREFIX = 'lbz_ma_tw'
+
+_o_LOCK = threading.Lock()
+_dlf_TIMERS = {}    # Name -> [count, total seconds, max seconds]
+_di_COUNTERS = {}   # Name -> value
+_f_STARTED = time.time()
+
+
+def reset():
+    """
+    Function to discard all the measures, e.g. at the beginning of each run in daemon mode.
+
+    :return: Nothing
+    """
+    global _f_STARTED
+
+    with _o_LOCK:
+        _dlf_TIMERS.clear()
+        _di_COUNTERS.clear()
+        _f_STARTED = time.time()
+
+
+def add_time(pu_name, pf_seconds):
+    """
+    Function to add a measure to a timer.
+
+    :param pu_name: Name of the timer, e.g. 'caa_lookup'.
+    :type pu_name: Str
+
+    :param pf_seconds:
+    :type pf_seconds: Float
+
+    :return: Nothing
+    """
+    with _o_LOCK:
+        lf_timer = _dlf_TIMERS.setdefault(pu_name, [0, 0.0, 0.0])
+        lf_timer[0] += 1
+        lf_timer[1] += pf_seconds
+        lf_timer[2] = max(lf_timer[2], pf_seconds)
+
+
+@contextlib.contextmanager
+def timer(pu_name):
+    """
+    Context manager (or decorator) to measure the time spent in a block of code. The time is measured even when the
+    block raises an exception.
+
+    :param pu_name: Name of the timer, e.g. 'caa_lookup'.
+    :type pu_name: Str
+    """
+    f_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(pu_name, time.perf_counter() - f_start)
+
+
+def count(pu_name, pi_value=1):
+    """
+    Function to increase a counter.
+
+    :param pu_name: Name of the counter, e.g. 'retries'.
+    :type pu_name: Str
+
+    :param pi_value:
+    :type pi_value: Int
+
+    :return: Nothing
+    """
+    with _o_LOCK:
+        _di_COUNTERS[pu_name] = _di_COUNTERS.get(pu_name, 0) + pi_value
+
+
+def get_summary():
+    """
+    Function to get the measures of the current run.
+
+    :return: Dictionary with the start time and duration of the run (in seconds), the timers (count, total and max
+             seconds of each one) and the counters.
+    :rtype: Dict
+    """
+    with _o_LOCK:
+        return {'started': _f_STARTED,
+                'duration': time.time() - _f_STARTED,
+                'timers': {u_name: {'count': lf_timer[0], 'total': lf_timer[1], 'max': lf_timer[2]}
+                           for u_name, lf_timer in sorted(_dlf_TIMERS.items())},
+                'counters': dict(sorted(_di_COUNTERS.items()))}
+
+
+def _get_prometheus_text(pdx_summary):
+    """
+    Function to build the Prometheus text exposition of a run summary.
+
+    :param pdx_summary: See get_summary().
+    :type pdx_summary: Dict
+
+    :rtype: Str
+    """
+    ls_lines = []
+
+    def _add(ps_name, ps_type, ps_help, plx_samples):
+        ls_lines.append('# HELP %s_%s %s' % (_s_PROM_PREFIX, ps_name, ps_help))
+        ls_lines.append('# TYPE %s_%s %s' % (_s_PROM_PREFIX, ps_name, ps_type))
+        for s_labels, x_value in plx_samples:
+            ls_lines.append('%s_%s%s %s' % (_s_PROM_PREFIX, ps_name, s_labels, x_value))
+
+    _add('last_run_timestamp_seconds', 'gauge', 'Start time of the last run.', [('', pdx_summary['started'])])
+    _add('last_run_duration_seconds', 'gauge', 'Duration of the last run.', [('', pdx_summary['duration'])])
+
+    dx_timers = pdx_summary['timers']
+    for s_name, s_field, s_help in (('operation_count', 'count', 'Number of operations in the last run.'),
+                                    ('operation_seconds', 'total', 'Seconds spent in the operations in the last run.'),
+                                    ('operation_max_seconds', 'max', 'Seconds of the slowest operation in the last run.')):
+        _add(s_name, 'gauge', s_help,
+             [('{operation="%s"}' % u_name, dx_timer[s_field]) for u_name, dx_timer in dx_timers.items()])
+
+    _add('events', 'gauge', 'Events (retries, cache hits, bytes...) counted in the last run.',
+         [('{event="%s"}' % u_name, i_value) for u_name, i_value in pdx_summary['counters'].items()])
+
+    return '\n'.join(ls_lines) + '\n'
+
+
+def _write_atomically(pu_path, ps_text):
+    """
+    Function to write a file in a single step, so readers (e.g. node_exporter) never see a partial file.
+    """
+    u_dir = os.path.dirname(pu_path)
+    if u_dir:
+        os.makedirs(u_dir, exist_ok=True)
+
+    u_tmp = '%s.%s.tmp' % (pu_path, os.getpid())
+    with open(u_tmp, 'w', encoding='utf-8') as o_file:
+        o_file.write(ps_text)
+    os.replace(u_tmp, pu_path)
+
+
+def export(pu_json_path='', pu_prometheus_path=''):
+    """
+    Function to export the measures of the current run.
+
+    :param pu_json_path: Path of the JSON summary. Empty to not write it.
+    :type pu_json_path: Str
+
+    :param pu_prometheus_path: Path of the Prometheus textfile collector file (it must end in ".prom"). Empty to not
+                               write it.
+    :type pu_prometheus_path: Str
+
+    :return: The summary, see get_summary().
+    :rtype: Dict
+    """
+    dx_summary = get_summary()
+    if pu_json_path:
+        _write_atomically(pu_json_path, json.dumps(dx_summary, indent=2) + '\n')
+    if pu_prometheus_path:
+        _write_atomically(pu_prometheus_path, _get_prometheus_text(dx_summary))
+
+    return dx_summary
+
+
+def export_run():
+    """
+    Function to export the measures of the current run to the files configured in cons (METRICS_JSON and
+    METRICS_PROMETHEUS).
+
+    :return: Nothing
+    """
+    if cons.s_METRICS_JSON or cons.s_METRICS_PROMETHEUS:
+        export(pu_json_path=cons.s_METRICS_JSON, pu_prometheus_path=cons.s_METRICS_PROMETHEUS)
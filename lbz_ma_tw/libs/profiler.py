@@ -0,0 +1,229 @@
+"""
+Library to profile the reports in production (PROFILE mode). Every profiled run writes to PROFILE_DIR:
+
+  - <name>.pstats: cProfile statistics of all the threads involved (see the pstats module, snakeviz...).
+  - <name>.collapsed: Wall-clock stack samples of all the threads, in the "collapsed stacks" format read by
+    flamegraph.pl, speedscope, inferno...
+  - <name>.txt: Wall-clock attribution of the samples (time blocked on network, sleeping because of backoff or rate
+    limits, waiting for other threads, and running), and the functions blocked on network the longest.
+"""
+
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+from . import cons
+
+
+# Only one run is profiled at a time (the profile hooks are global), so profiled users in batch mode are serialized
+_o_RUN_LOCK = threading.Lock()
+
+# Files whose frames mean the thread is waiting for the network
+_ts_NETWORK_FILES = ('socket.py', 'ssl.py', os.path.join('http', 'client.py'),
+                     os.path.join('urllib3', 'connection.py'), os.path.join('urllib3', 'response.py'))
+
+# Directory of the program, its frames are the ones the network time is attributed to. The generic plumbing (HTTP
+# client, retries...) is skipped, so the time is attributed to whoever needed the request.
+_u_PROGRAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_ts_PLUMBING_FILES = ('http_client.py', 'retry.py', 'throttle.py', 'metrics.py', 'profiler.py')
+
+# Functions that only sleep on purpose (backoff and rate limits), by file and name
+_ts_SLEEP_FUNCTIONS = ((os.path.join('libs', 'retry.py'), 'call'),
+                       (os.path.join('libs', 'throttle.py'), 'wait'))
+
+
+def _get_frame_name(po_frame):
+    """
+    Function to get the name of a frame in the collapsed stacks, e.g. "lb_mb_data.py:_get_caa_images".
+    """
+    return '%s:%s' % (os.path.basename(po_frame.f_code.co_filename), po_frame.f_code.co_name)
+
+
+def _get_category(po_frame):
+    """
+    Function to classify a stack sample by what the thread is doing.
+
+    :param po_frame: Innermost frame of the thread.
+    :type po_frame: frame
+
+    :return: 'network', 'sleep' (backoff and rate limits), 'wait' (for other threads), 'run' or None for the idle
+             workers of a pool, which are not worth sampling.
+    :rtype: Union[Str, None]
+    """
+    u_file = po_frame.f_code.co_filename
+    u_function = po_frame.f_code.co_name
+
+    # Idle workers are blocked in queue.get(), a C function, so their innermost Python frame is the worker loop itself
+    if u_function == '_worker' and u_file.endswith(os.path.join('futures', 'thread.py')):
+        return None
+
+    o_frame = po_frame
+    while o_frame is not None:
+        if o_frame.f_code.co_filename.endswith(_ts_NETWORK_FILES):
+            return 'network'
+        o_frame = o_frame.f_back
+
+    for u_sleep_file, u_sleep_function in _ts_SLEEP_FUNCTIONS:
+        if u_function == u_sleep_function and u_file.endswith(u_sleep_file):
+            return 'sleep'
+
+    # selectors.py is the event loop of the asynchronous mode, waiting for the threads doing the requests
+    if os.path.basename(u_file) in ('threading.py', 'queue.py', 'selectors.py'):
+        return 'wait'
+
+    return 'run'
+
+
+class _Sampler(threading.Thread):
+    """
+    Thread taking wall-clock stack samples of all the other threads at regular intervals.
+    """
+    def __init__(self, pf_interval):
+        super().__init__(name='profiler-sampler', daemon=True)
+        self.f_interval = pf_interval
+        self.di_stacks = collections.Counter()      # Collapsed stack -> number of samples
+        self.di_categories = collections.Counter()  # Category -> number of samples
+        self.di_network = collections.Counter()     # Caller blocked on network -> number of samples
+        self.f_elapsed = 0.0
+        self.i_samples = 0
+        self._o_stop = threading.Event()
+
+    def run(self):
+        f_start = time.perf_counter()
+        while not self._o_stop.wait(self.f_interval):
+            self._sample()
+        self.f_elapsed = time.perf_counter() - f_start
+
+    def stop(self):
+        self._o_stop.set()
+        self.join()
+
+    def _sample(self):
+        do_threads = {o_thread.ident: o_thread.name for o_thread in threading.enumerate()}
+        self.i_samples += 1
+        for i_thread, o_frame in sys._current_frames().items():
+            if i_thread == self.ident:
+                continue
+
+            s_category = _get_category(o_frame)
+            if s_category is None:
+                continue
+
+            ls_frames = []
+            s_caller = ''
+            while o_frame is not None:
+                ls_frames.append(_get_frame_name(o_frame))
+                u_file = o_frame.f_code.co_filename
+                if not s_caller and u_file.startswith(_u_PROGRAM_DIR) and \
+                        os.path.basename(u_file) not in _ts_PLUMBING_FILES:
+                    s_caller = ls_frames[-1]
+                o_frame = o_frame.f_back
+
+            # Threads of the same pool share the name prefix (e.g. "ThreadPoolExecutor-0_1"), so they are merged
+            s_thread = do_threads.get(i_thread, 'thread').rsplit('_', 1)[0]
+            ls_frames.append(s_thread)
+            self.di_stacks[';'.join(reversed(ls_frames))] += 1
+            self.di_categories[s_category] += 1
+            if s_category == 'network':
+                self.di_network[s_caller or ls_frames[0]] += 1
+
+
+class _ThreadProfiles:
+    """
+    Class to enable cProfile in every thread started while profiling (cProfile only profiles the thread enabling it).
+    """
+    def __init__(self):
+        self.lo_profiles = []
+        self._o_lock = threading.Lock()
+
+    def hook(self, po_frame, ps_event, px_arg):
+        # Called by the first event of each new thread (see threading.setprofile()), enabling cProfile replaces it
+        o_profile = cProfile.Profile()
+        with self._o_lock:
+            self.lo_profiles.append(o_profile)
+        o_profile.enable()
+
+
+def _get_report(po_sampler, pi_top=15):
+    """
+    Function to build the text with the wall-clock attribution of the samples.
+    """
+    f_sample = po_sampler.f_elapsed / po_sampler.i_samples if po_sampler.i_samples else 0.0
+    i_total = sum(po_sampler.di_categories.values()) or 1
+
+    ls_lines = ['Wall time: %.3f s (%s samples every %.1f ms)'
+                % (po_sampler.f_elapsed, po_sampler.i_samples, po_sampler.f_interval * 1000),
+                'The times below are added up for all the threads, so they can be longer than the wall time.',
+                '']
+    for s_category, s_title in (('network', 'Blocked on network'),
+                                ('sleep', 'Sleeping (backoff, rate limits)'),
+                                ('wait', 'Waiting for other threads'),
+                                ('run', 'Running')):
+        i_count = po_sampler.di_categories[s_category]
+        ls_lines.append('%s %8.3f s %5.1f%%' % (s_title.ljust(34, '.'), i_count * f_sample, 100.0 * i_count / i_total))
+
+    ls_lines += ['', 'Blocked on network by caller:']
+    for s_frame, i_count in po_sampler.di_network.most_common(pi_top):
+        ls_lines.append('  %s %8.3f s' % (s_frame.ljust(48, '.'), i_count * f_sample))
+
+    return '\n'.join(ls_lines) + '\n'
+
+
+def run(pf_function, *px_args, pu_name='run', **dx_kwargs):
+    """
+    Function to run a function profiling it (see the module docstring for the files written).
+
+    :param pf_function: Function to be profiled.
+    :type pf_function: Callable
+
+    :param pu_name: Name of the run, used in the names of the files (after the date and time).
+    :type pu_name: Str
+
+    :return: Whatever pf_function returns.
+    """
+    with _o_RUN_LOCK:
+        o_threads = _ThreadProfiles()
+        o_sampler = _Sampler(cons.f_PROFILE_INTERVAL / 1000.0)
+        o_main = cProfile.Profile()
+
+        threading.setprofile(o_threads.hook)
+        o_sampler.start()
+        o_main.enable()
+        try:
+            return pf_function(*px_args, **dx_kwargs)
+        finally:
+            o_main.disable()
+            threading.setprofile(None)
+            o_sampler.stop()
+            _save(pu_name, o_main, o_threads.lo_profiles, o_sampler)
+
+
+def _save(pu_name, po_main, plo_profiles, po_sampler):
+    """
+    Function to write the files of a profiled run.
+    """
+    os.makedirs(cons.s_PROFILE_DIR, exist_ok=True)
+    u_prefix = os.path.join(cons.s_PROFILE_DIR, '%s_%s' % (time.strftime('%Y%m%d-%H%M%S'), pu_name))
+
+    # The worker threads have already finished (their pools are closed), so their profiles can be collected now
+    o_stats = pstats.Stats(po_main)
+    for o_profile in plo_profiles:
+        try:
+            o_stats.add(o_profile)
+        except TypeError:
+            # Threads which didn't call any function have no stats
+            pass
+    o_stats.dump_stats(u_prefix + '.pstats')
+
+    with open(u_prefix + '.collapsed', 'w', encoding='utf-8') as o_file:
+        for s_stack, i_count in sorted(po_sampler.di_stacks.items()):
+            o_file.write('%s %s\n' % (s_stack, i_count))
+
+    with open(u_prefix + '.txt', 'w', encoding='utf-8') as o_file:
+        o_file.write(_get_report(po_sampler))
+
+    print('Profile saved: %s.{pstats,collapsed,txt}' % u_prefix)
@@ -1,101 +1,188 @@
 """
-Library with functions to build tweets with information about releases listened.
+Library with functions to build tweets with information about releases listened. Dates are formatted with Babel, so no
+process-wide locale is changed and messages in several languages can be built at the same time (e.g. in batch mode).
+Messages are memoized, so building the same message again (e.g. once per publisher) costs nothing.
 """
 import datetime
-import locale
+import functools
 
-import dateutil.relativedelta
+import babel
+import babel.dates
 
 
-def build_tweet_text(plo_releases, ps_period='month', ps_locale='', pi_latest=3):
+# Locale used when the locale of the user is unknown, or there are no templates for its language
+_s_DEFAULT_LOCALE = 'en_GB.UTF-8'
+
+# Heading and album line of each language. The album line has three formats, from the most verbose to the shortest one,
+# and the most verbose one fitting the maximum length of the message is used.
+_ds_HEADINGS = {'en': '#TopAlbums in %s',
+                'es': '#TopDiscos de %s'}
+_dts_ALBUM_LINES = {'en': ('%s. %s (by %s)', '%s %s (by %s)', '%s %s (%s)'),
+                    'es': ('%s. %s (por %s)', '%s %s (por %s)', '%s %s (%s)')}
+
+_s_ELLIPSIS = '…'
+
+
+def build_tweet_text(plo_releases, ps_period='month', ps_locale='', pi_max_length=280):
     """
     Function to build a tweet about listened releases; it'll automatically try to reduce the length of the tweet, so it
-    fits into the maximum allowed spaced of 280 characters.
+    fits into the maximum allowed length. When not even the shortest format fits, the names of the releases and artists
+    are shortened, line by line.
+
+    :param plo_releases:
+    :type plo_releases: List[lb_mb_data.Release]
+
+    :param ps_period: Period of the report, 'month' or 'year'.
+    :type ps_period: Str
+
+    :param ps_locale: Locale of the message, e.g. 'es_ES.UTF-8'.
+    :type ps_locale: Str
+
+    :param pi_max_length: Maximum number of characters of the message, e.g. 280 for Twitter.
+    :type pi_max_length: Int
+
+    :return: The text with the top albums. Empty when there are no releases.
+    :rtype: Str
+    """
+    o_locale = _get_locale(ps_locale)
+    if not plo_releases:
+        return ''
+
+    s_interval = _get_interval_name(ps_period, str(o_locale), datetime.date.today())
+    ttu_releases = tuple((str(o_release.u_release_name), str(o_release.u_artist_name)) for o_release in plo_releases)
+    return _render(ttu_releases, _ds_HEADINGS[o_locale.language] % s_interval, o_locale.language, pi_max_length)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_locale(ps_locale):
+    """
+    Function to get the Babel locale of a locale name, e.g. 'es_ES.UTF-8'. The default locale is used (with a warning,
+    just once) when the locale is unknown or there are no templates for its language.
+
+    :rtype: babel.Locale
+    """
+    try:
+        o_locale = babel.Locale.parse(ps_locale.split('.')[0])
+    except (ValueError, TypeError, babel.UnknownLocaleError):
+        o_locale = None
+
+    if o_locale is None or o_locale.language not in _ds_HEADINGS:
+        print('WARNING: Locale "%s" not found, using "%s" instead' % (ps_locale, _s_DEFAULT_LOCALE))
+        o_locale = babel.Locale.parse(_s_DEFAULT_LOCALE.split('.')[0])
+
+    return o_locale
+
+
+@functools.lru_cache(maxsize=64)
+def _get_interval_name(ps_period, ps_locale, po_today):
     """
-    for s_format in ('normal', 'short', 'shorter'):
-        s_tweet_candidate = _build_tweet_text(plo_releases=plo_releases, ps_period=ps_period, ps_format=s_format,
-                                              ps_locale=ps_locale,
-                                              pi_latest=pi_latest)
-        if len(s_tweet_candidate) <= 280:
-            s_tweet = s_tweet_candidate
-            break
+    Function to get the name of the last time interval, e.g. 'September' or '2025'.
 
+    :param ps_period: 'month' or 'year'.
+    :type ps_period: Str
+
+    :param ps_locale: Babel locale identifier, e.g. 'es_ES'.
+    :type ps_locale: Str
+
+    :param po_today: Date the interval is relative to.
+    :type po_today: datetime.date
+
+    :rtype: Str
+    """
+    if ps_period == 'month':
+        o_last_month = po_today.replace(day=1) - datetime.timedelta(days=1)
+        return babel.dates.format_date(o_last_month, 'LLLL', locale=ps_locale)
+    elif ps_period == 'year':
+        return str(po_today.year - 1)
     else:
-        s_tweet = _build_tweet_text(plo_releases=plo_releases, ps_period=ps_period, ps_format='shorter',
-                                    ps_locale=ps_locale,
-                                    pi_latest=pi_latest)
-        s_tweet = s_tweet[:280]
-    return s_tweet
+        raise ValueError('Invalid interval name, allowed values are "month", and "year"')
+
+
+def _shorten(pu_text, pi_length):
+    """
+    Function to shorten a text to a number of characters, ending it with an ellipsis when it's cut.
+    """
+    if len(pu_text) <= pi_length:
+        return pu_text
+    if pi_length <= 0:
+        return ''
+    return pu_text[:pi_length - 1].rstrip() + _s_ELLIPSIS
+
+
+def _share(pli_lengths, pi_budget):
+    """
+    Function to share a number of characters among several lines: the short lines keep their length, and the rest of
+    the budget is evenly shared by the long ones.
+
+    :param pli_lengths: Length of every line.
+    :type pli_lengths: List[Int]
+
+    :param pi_budget: Characters available for all the lines.
+    :type pi_budget: Int
+
+    :return: Characters available for every line.
+    :rtype: List[Int]
+    """
+    li_shares = list(pli_lengths)
+    i_lines = len(pli_lengths)
+    for i_line in sorted(range(len(pli_lengths)), key=pli_lengths.__getitem__):
+        li_shares[i_line] = min(pli_lengths[i_line], pi_budget // i_lines)
+        pi_budget -= li_shares[i_line]
+        i_lines -= 1
 
+    return li_shares
 
-def _build_tweet_text(plo_releases, ps_period='month', ps_format='normal', ps_locale='', pi_latest=3):
+
+@functools.lru_cache(maxsize=256)
+def _render(pttu_releases, pu_heading, ps_language, pi_max_length):
     """
     Function to build the text of the tweet with the top albums.
 
-    :param plo_releases:
-    :type plo_releases: List[Str]
+    :param pttu_releases: Tuples with the name and the artist of each release.
+    :type pttu_releases: Tuple[Tuple[Str, Str]]
+
+    :param pu_heading: First line of the message.
+    :type pu_heading: Str
 
-    :param ps_format: Format of the tweet. Allowed values are 'normal', 'short', 'shorter'. Twitter only accepts 256
-                     characters, so we'll try to fit all the information in them.
-    :type ps_format: Str
+    :param ps_language: Language of the templates, e.g. 'es'.
+    :type ps_language: Str
+
+    :param pi_max_length: Maximum number of characters of the message.
+    :type pi_max_length: Int
 
     :return: The text with the top albums
     :rtype Str
     """
-    s_msg = ''
-
-    # Dictionary with heading and album line in different locales
-    #------------------------------------------------------------
-    dds_heading = {'normal':  {'en_GB.UTF-8': '#TopAlbums in %s\n',
-                               'es_ES.UTF-8': '#TopDiscos de %s\n'},
-                   'short':   {'en_GB.UTF-8': '#TopAlbums in %s\n',
-                               'es_ES.UTF-8': '#TopDiscos de %s\n'},
-                   'shorter': {'en_GB.UTF-8': '#TopAlbums in %s\n',
-                               'es_ES.UTF-8': '#TopDiscos de %s\n'}
-                   }
-    dds_album_line = {'normal':  {'en_GB.UTF-8': '%s. %s (by %s)\n',
-                                  'es_ES.UTF-8': '%s. %s (por %s)\n'},
-                      'short':   {'en_GB.UTF-8': '%s %s (by %s)\n',
-                                  'es_ES.UTF-8': '%s %s (por %s)\n'},
-                      'shorter': {'en_GB.UTF-8': '%s %s (%s)\n',
-                                  'es_ES.UTF-8': '%s %s (%s)\n'}
-                      }
-
-    # Setting the locale and using en_GB.UTF-8 when the chosen option is not valid
-    #-----------------------------------------------------------------------------
-    if (ps_locale in dds_heading[ps_format]) and (ps_locale in dds_album_line[ps_format]):
-        s_locale = ps_locale
-    else:
-        print('WARNING: Locale "%s" not found, using "en_GB.UTF-8" instead' % ps_locale)
-        s_locale = 'en_GB.UTF-8'
-
-    locale.setlocale(locale.LC_TIME, ps_locale)
-
-    if plo_releases:
-        s_heading_tpl = dds_heading[ps_format][s_locale]
-        s_album_tpl = dds_album_line[ps_format][s_locale]
-
-        # Getting the name of the last time interval
-        #-------------------------------------------
-        if ps_period == 'month':
-            o_last_month = datetime.datetime.now() - dateutil.relativedelta.relativedelta(months=1)
-            s_last_interval = o_last_month.strftime('%B')
-        elif ps_period == 'year':
-            o_last_year = datetime.datetime.now() - dateutil.relativedelta.relativedelta(years=1)
-            s_last_interval = o_last_year.strftime('%Y')
-        else:
-            raise ValueError('Invalid interval name, allowed values are "month", and "year"')
-
-        # Building the heading message
-        #-----------------------------
-        try:
-            s_msg += s_heading_tpl % (pi_latest, s_last_interval)
-        except TypeError:
-            s_msg += s_heading_tpl % s_last_interval
-
-        for i_release, o_release in enumerate(plo_releases, start=1):
-            s_msg += s_album_tpl % (i_release,
-                                    o_release.u_release_name,
-                                    o_release.u_artist_name)
-
-    return s_msg.strip()
+    # All the formats are measured in a single pass
+    #----------------------------------------------
+    ts_formats = _dts_ALBUM_LINES[ps_language]
+    lls_lines = [[] for s_format in ts_formats]
+    li_lengths = [len(pu_heading)] * len(ts_formats)
+    for i_release, (u_release, u_artist) in enumerate(pttu_releases, start=1):
+        for i_format, s_format in enumerate(ts_formats):
+            u_line = s_format % (i_release, u_release, u_artist)
+            lls_lines[i_format].append(u_line)
+            li_lengths[i_format] += len(u_line) + 1
+
+    for ls_lines, i_length in zip(lls_lines, li_lengths):
+        if i_length <= pi_max_length:
+            return '\n'.join([pu_heading] + ls_lines).strip()
+
+    # Not even the shortest format fits, so the names of every line are shortened to its share of the length
+    #--------------------------------------------------------------------------------------------------------
+    s_format = ts_formats[-1]
+    li_overheads = [len(s_format % (i_release, '', '')) for i_release in range(1, len(pttu_releases) + 1)]
+    i_budget = pi_max_length - len(pu_heading) - len(pttu_releases) - sum(li_overheads)
+    li_shares = _share([len(u_release) + len(u_artist) for u_release, u_artist in pttu_releases], max(0, i_budget))
+
+    ls_lines = [pu_heading]
+    for i_release, ((u_release, u_artist), i_share) in enumerate(zip(pttu_releases, li_shares), start=1):
+        # The release gets at least half of the line, and whatever the artist doesn't need
+        i_release_length = min(len(u_release), max(i_share - len(u_artist), (i_share + 1) // 2))
+        i_artist_length = i_share - i_release_length
+        ls_lines.append(s_format % (i_release,
+                                    _shorten(u_release, i_release_length),
+                                    _shorten(u_artist, i_artist_length)))
+
+    # The heading alone might not fit
+    return '\n'.join(ls_lines).strip()[:pi_max_length]
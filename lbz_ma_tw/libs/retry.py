@@ -0,0 +1,280 @@
+"""
+Library with the retry engine shared by all the network operations: jittered exponential backoff, support of the
+Retry-After and rate-limit headers sent by the servers, per-host rate limiting (see throttle.py) and a per-host circuit
+breaker to fail fast when a host is down.
+"""
+
+import datetime
+import email.utils
+import random
+import threading
+import time
+
+from . import cons
+from . import metrics
+from . import throttle
+
+
+# Circuit breakers already created, indexed by host, see get_breaker()
+_do_BREAKERS = {}
+_o_BREAKERS_LOCK = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """
+    Exception raised when a host is considered down and no request is sent to it.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Class to stop sending requests to a host after several consecutive failures. After a cooldown period a single
+    request is allowed again; the circuit is closed if it succeeds, or opened again if it fails.
+    """
+    def __init__(self, pi_failures=5, pf_cooldown=60.0):
+        """
+        :param pi_failures: Number of consecutive failures opening the circuit. 0 to disable the circuit breaker.
+        :type pi_failures: Int
+
+        :param pf_cooldown: Number of seconds the circuit stays open.
+        :type pf_cooldown: Float
+        """
+        self.i_failures = pi_failures
+        self.f_cooldown = pf_cooldown
+        self._i_consecutive = 0
+        self._f_opened = None
+        self._o_lock = threading.Lock()
+
+    def check(self, pu_host=''):
+        """
+        Method to check whether a request can be sent.
+
+        :param pu_host: Name of the host, only used in the error message.
+        :type pu_host: Str
+
+        :return: Nothing
+
+        :raises retry.CircuitOpenError: When the circuit is open.
+        """
+        with self._o_lock:
+            if self._f_opened is not None:
+                if time.monotonic() - self._f_opened < self.f_cooldown:
+                    raise CircuitOpenError('Host "%s" is down, not sending more requests for a while' % pu_host)
+                # Half-open: letting one request through, the next failure opens the circuit again
+                self._f_opened = None
+                self._i_consecutive = max(0, self.i_failures - 1)
+
+    def success(self):
+        """
+        Method to record a successful request.
+
+        :return: Nothing
+        """
+        with self._o_lock:
+            self._i_consecutive = 0
+            self._f_opened = None
+
+    def failure(self):
+        """
+        Method to record a failed request.
+
+        :return: Nothing
+        """
+        with self._o_lock:
+            self._i_consecutive += 1
+            if self.i_failures and self._i_consecutive >= self.i_failures:
+                self._f_opened = time.monotonic()
+
+
+def get_breaker(pu_host):
+    """
+    Function to get the circuit breaker of a host, shared by the whole process.
+
+    :param pu_host: Name of the host.
+    :type pu_host: Str
+
+    :return:
+    :rtype: retry.CircuitBreaker
+    """
+    with _o_BREAKERS_LOCK:
+        o_breaker = _do_BREAKERS.get(pu_host)
+        if o_breaker is None:
+            o_breaker = CircuitBreaker(pi_failures=cons.i_BREAKER_FAILURES, pf_cooldown=cons.f_BREAKER_COOLDOWN)
+            _do_BREAKERS[pu_host] = o_breaker
+
+    return o_breaker
+
+
+def get_backoff(pi_try, pf_delay):
+    """
+    Function to get the time to wait before a retry, using exponential backoff with "full jitter", so several clients
+    failing at the same time don't retry at the same time.
+
+    :param pi_try: Number of the failed try, starting at 0.
+    :type pi_try: Int
+
+    :param pf_delay: Base delay in seconds.
+    :type pf_delay: Float
+
+    :return: Number of seconds to wait.
+    :rtype: Float
+    """
+    return random.uniform(0, min(cons.f_RETRY_MAX_DELAY, pf_delay * 2 ** pi_try))
+
+
+def get_rate_limit_wait(pdx_headers):
+    """
+    Function to get the number of seconds a server asks us to wait, reading the standard Retry-After header and the
+    rate-limit headers of ListenBrainz, Twitter and Mastodon.
+
+    :param pdx_headers: Headers of the response (case-insensitive dictionary).
+    :type pdx_headers: Mapping[Str, Str]
+
+    :return: Number of seconds to wait, None when the server doesn't say anything about it (or the value can't be parsed).
+    :rtype: Union[Float, None]
+    """
+    if not pdx_headers:
+        return None
+
+    f_now = time.time()
+
+    # Retry-After: seconds or HTTP date
+    u_value = pdx_headers.get('Retry-After')
+    if u_value:
+        try:
+            return max(0.0, float(u_value))
+        except ValueError:
+            pass
+        try:
+            return _get_wait_until(email.utils.parsedate_to_datetime(u_value), f_now)
+        except (TypeError, ValueError):
+            return None
+
+    # The rest of headers only matter when there are no requests left
+    u_remaining = pdx_headers.get('X-RateLimit-Remaining') or pdx_headers.get('X-Rate-Limit-Remaining')
+    if u_remaining is None or u_remaining.strip() not in ('0', '0.0'):
+        return None
+
+    # ListenBrainz: seconds
+    u_value = pdx_headers.get('X-RateLimit-Reset-In')
+    if u_value:
+        try:
+            return max(0.0, float(u_value))
+        except ValueError:
+            return None
+
+    # MusicBrainz and Twitter: epoch; Mastodon: ISO 8601 date
+    u_value = pdx_headers.get('X-RateLimit-Reset') or pdx_headers.get('X-Rate-Limit-Reset')
+    if u_value:
+        try:
+            return max(0.0, float(u_value) - f_now)
+        except ValueError:
+            pass
+        try:
+            return _get_wait_until(datetime.datetime.fromisoformat(u_value.replace('Z', '+00:00')), f_now)
+        except (TypeError, ValueError):
+            return None
+
+    return None
+
+
+def _get_wait_until(po_date, pf_now):
+    """
+    Function to get the number of seconds until a date sent by a server. Dates without timezone are taken as UTC.
+
+    :param po_date:
+    :type po_date: datetime.datetime
+
+    :param pf_now: Current time, as returned by time.time().
+    :type pf_now: Float
+
+    :return: Number of seconds to wait, 0 when the date has already passed.
+    :rtype: Float
+    """
+    o_date = po_date if po_date.tzinfo is not None else po_date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, o_date.timestamp() - pf_now)
+
+
+def note_headers(pu_host, pdx_headers):
+    """
+    Function to read the rate-limit headers of a successful response, so no more requests are sent to the host until
+    our quota is restored.
+
+    :param pu_host: Name of the host.
+    :type pu_host: Str
+
+    :param pdx_headers: Headers of the response (case-insensitive dictionary).
+    :type pdx_headers: Mapping[Str, Str]
+
+    :return: Nothing
+    """
+    f_wait = get_rate_limit_wait(pdx_headers)
+    if f_wait and cons.s_CASSETTE_MODE != 'replay':
+        throttle.get_host_limiter(pu_host).block_until(time.monotonic() + f_wait)
+
+
+def call(pf_function, pu_host, pf_classify, pi_tries=None, pf_delay=None):
+    """
+    Function to call a function sending requests to a host, retrying it when it fails.
+
+    :param pf_function: Function without parameters sending the request(s).
+    :type pf_function: Callable
+
+    :param pu_host: Name of the host the requests are sent to. Rate limit and circuit breaker are per host.
+    :type pu_host: Str
+
+    :param pf_classify: Function receiving an exception raised by pf_function and returning a tuple with a boolean
+                        (whether the request can be retried) and the number of seconds the server asked us to wait
+                        (None when unknown). Non-retryable errors are raised immediately and don't count as host
+                        failures (e.g. 404).
+    :type pf_classify: Callable
+
+    :param pi_tries: Maximum number of tries. cons.i_DL_RETRIES by default.
+    :type pi_tries: Int
+
+    :param pf_delay: Base delay between tries in seconds. cons.i_DL_DELAY by default.
+    :type pf_delay: Float
+
+    :return: Whatever pf_function returns.
+
+    :raises Exception: The last exception raised by pf_function, or retry.CircuitOpenError.
+    """
+    if pi_tries is None:
+        pi_tries = cons.i_DL_RETRIES
+    if pf_delay is None:
+        pf_delay = cons.i_DL_DELAY
+
+    o_limiter = throttle.get_host_limiter(pu_host)
+    o_breaker = get_breaker(pu_host)
+
+    i_try = 0
+    while True:
+        o_breaker.check(pu_host)
+        o_limiter.wait()
+        try:
+            x_result = pf_function()
+            o_breaker.success()
+            return x_result
+
+        except Exception as o_exception:
+            b_retry, f_wait = pf_classify(o_exception)
+            if cons.s_CASSETTE_MODE == 'replay':
+                # The waits asked by the servers of a recorded run are already over
+                f_wait = None
+            if not b_retry:
+                o_breaker.success()
+                raise
+
+            o_breaker.failure()
+            i_try += 1
+            if i_try >= pi_tries:
+                raise
+
+            metrics.count('retries')
+
+            if f_wait is not None:
+                metrics.count('server_waits')
+                # The server told us when to come back, so nobody else bothers it in the meantime
+                o_limiter.block_until(time.monotonic() + f_wait)
+            time.sleep(max(f_wait or 0.0, get_backoff(i_try - 1, pf_delay)))
@@ -0,0 +1,98 @@
+"""
+Library to run the reports periodically from a single long-running process (daemon mode), with the same schedule used
+by the cron template config/lbz_ma_tw.tpl: every month, on a given day and hour.
+"""
+
+import datetime
+import time
+
+
+# Maximum number of seconds slept in a row. The remaining time is recalculated after each nap, so changes of the system
+# clock (or a suspended host) don't delay the runs too much.
+_i_MAX_SLEEP = 3600
+
+
+def get_next_run(pdt_now, pi_day=4, pi_hour=20):
+    """
+    Function to get the next moment a report must be published after a given one.
+
+    :param pdt_now: Reference moment.
+    :type pdt_now: datetime.datetime
+
+    :param pi_day: Day of the month of the reports.
+    :type pi_day: Int
+
+    :param pi_hour: Hour (0-23) of the reports.
+    :type pi_hour: Int
+
+    :return:
+    :rtype: datetime.datetime
+    """
+    dt_next = pdt_now.replace(day=pi_day, hour=pi_hour, minute=0, second=0, microsecond=0)
+    if dt_next <= pdt_now:
+        if dt_next.month == 12:
+            dt_next = dt_next.replace(year=dt_next.year + 1, month=1)
+        else:
+            dt_next = dt_next.replace(month=dt_next.month + 1)
+
+    return dt_next
+
+
+def _run_job(pf_job):
+    """
+    Function to run a job, printing (instead of raising) its errors so the scheduler keeps running.
+    """
+    try:
+        pf_job()
+    except Exception as o_exception:
+        print('ERROR! %s' % o_exception, flush=True)
+
+
+def run_forever(pf_job, pi_day=4, pi_hour=20, pf_background=None, pi_background_hours=0):
+    """
+    Function to run a job every month, on a given day and hour, forever. Errors raised by the job are printed, and the
+    job is run again next month. Optionally, a background job (e.g. a prefetch) is run periodically between them.
+
+    :param pf_job: Function to be run, without arguments.
+    :type pf_job: Callable
+
+    :param pi_day: Day of the month of the runs.
+    :type pi_day: Int
+
+    :param pi_hour: Hour (0-23) of the runs.
+    :type pi_hour: Int
+
+    :param pf_background: Function to be run periodically between the runs of pf_job, without arguments.
+    :type pf_background: Union[Callable, None]
+
+    :param pi_background_hours: Number of hours between runs of pf_background. 0 to never run it.
+    :type pi_background_hours: Int
+
+    :return: Nothing
+    """
+    o_background_delta = None
+    if pf_background is not None and pi_background_hours > 0:
+        o_background_delta = datetime.timedelta(hours=pi_background_hours)
+    dt_background = datetime.datetime.now()
+
+    while True:
+        dt_next = get_next_run(datetime.datetime.now(), pi_day=pi_day, pi_hour=pi_hour)
+        print('\nNext run: %s' % dt_next.strftime('%Y-%m-%d %H:%M'), flush=True)
+
+        while True:
+            dt_now = datetime.datetime.now()
+            if dt_now >= dt_next:
+                break
+
+            # The background job is run while waiting for the main one
+            dt_wake = dt_next
+            if o_background_delta is not None:
+                if dt_background <= dt_now:
+                    _run_job(pf_background)
+                    dt_background = datetime.datetime.now() + o_background_delta
+                    continue
+                dt_wake = min(dt_wake, dt_background)
+
+            time.sleep(min((dt_wake - dt_now).total_seconds(), _i_MAX_SLEEP))
+
+        _run_job(pf_job)
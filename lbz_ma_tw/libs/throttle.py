@@ -0,0 +1,95 @@
+"""
+Library with small tools to limit the rate of requests sent to remote services.
+"""
+
+import threading
+import time
+
+from . import cons
+
+
+# Limiters already created, indexed by host, see get_host_limiter()
+_do_HOST_LIMITERS = {}
+_o_HOST_LIMITERS_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Class to limit the number of calls per second shared by several threads. The bucket is refilled at a constant rate
+    and each call takes a token from it, blocking until one is available. A remote server can also ask us to stop
+    sending requests for a while (see block_until()).
+    """
+    def __init__(self, pf_rate=1.0, pi_burst=1):
+        """
+        :param pf_rate: Maximum number of calls per second in the long run. 0 (or a negative number) means no limit.
+        :type pf_rate: Float
+
+        :param pi_burst: Maximum number of calls allowed at once after a period of inactivity.
+        :type pi_burst: Int
+        """
+        self.f_rate = pf_rate
+        self.i_burst = max(1, pi_burst)
+        self._f_tokens = float(self.i_burst)
+        self._f_updated = time.monotonic()
+        self._f_blocked_until = 0.0
+        self._o_lock = threading.Lock()
+
+    def wait(self):
+        """
+        Method to block the current thread until a new call is allowed.
+
+        :return: Nothing
+        """
+        while True:
+            with self._o_lock:
+                f_now = time.monotonic()
+                f_wait = self._f_blocked_until - f_now
+                if f_wait <= 0:
+                    if self.f_rate <= 0:
+                        return
+
+                    self._f_tokens = min(self.i_burst, self._f_tokens + (f_now - self._f_updated) * self.f_rate)
+                    self._f_updated = f_now
+                    if self._f_tokens >= 1:
+                        self._f_tokens -= 1
+                        return
+                    f_wait = (1 - self._f_tokens) / self.f_rate
+
+            time.sleep(f_wait)
+
+    def block_until(self, pf_timestamp):
+        """
+        Method to stop all the calls until a moment in time, e.g. when the server says our quota is exhausted.
+
+        :param pf_timestamp: Moment (as returned by time.monotonic()) when the calls are allowed again.
+        :type pf_timestamp: Float
+
+        :return: Nothing
+        """
+        with self._o_lock:
+            self._f_blocked_until = max(self._f_blocked_until, pf_timestamp)
+
+
+def get_host_limiter(pu_host):
+    """
+    Function to get the rate limiter of a host, shared by the whole process. MusicBrainz is limited to cons.f_MB_RATE
+    requests per second, Cover Art Archive to cons.f_CAA_RATE, and the rest of hosts to cons.f_HTTP_RATE.
+
+    :param pu_host: Name of the host, e.g. 'coverartarchive.org'.
+    :type pu_host: Str
+
+    :return:
+    :rtype: throttle.TokenBucket
+    """
+    with _o_HOST_LIMITERS_LOCK:
+        o_limiter = _do_HOST_LIMITERS.get(pu_host)
+        if o_limiter is None:
+            if pu_host in cons.ts_MB_HOSTS:
+                o_limiter = TokenBucket(pf_rate=cons.f_MB_RATE)
+            elif pu_host in cons.ts_CAA_HOSTS:
+                o_limiter = TokenBucket(pf_rate=cons.f_CAA_RATE, pi_burst=cons.i_MB_WORKERS)
+            else:
+                o_limiter = TokenBucket(pf_rate=cons.f_HTTP_RATE, pi_burst=cons.i_HTTP_POOL_SIZE)
+            _do_HOST_LIMITERS[pu_host] = o_limiter
+
+    return o_limiter
@@ -2,59 +2,236 @@
 Library to submit messages to twitter.
 """
 
-import time
+import concurrent.futures
+import functools
+import io
+import threading
 
 import tweepy
 
 from . import cons
+from . import http_client
+from . import images
+from . import metrics
+from . import retry
 
 
-def tweet(pu_text, plu_images=[]):
+# Whether the same uploaded media can be attached to several messages. Twitter allows it while the media hasn't expired
+# (24 hours), so a cover shared by several messages is uploaded just once.
+b_REUSABLE_MEDIA = True
+
+
+class AuthenticationError(Exception):
+    """
+    Exception raised when Twitter rejects the credentials of the account.
+    """
+
+
+# Twitter clients already created, indexed by their credentials, see _get_client()
+_do_CLIENTS = {}
+_o_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_client(ps_consumer_key, ps_consumer_secret, ps_access_token, ps_access_token_secret):
+    """
+    Function to get a Twitter client, which is created only once per set of credentials and uses the HTTP session
+    shared by the whole process.
+
+    :return: The client.
+    :rtype: tweepy.API
+    """
+    tu_key = (ps_consumer_key, ps_consumer_secret, ps_access_token, ps_access_token_secret)
+    with _o_CLIENTS_LOCK:
+        o_client = _do_CLIENTS.get(tu_key)
+        if o_client is None:
+            o_auth = tweepy.OAuthHandler(ps_consumer_key, ps_consumer_secret)
+            o_auth.set_access_token(ps_access_token, ps_access_token_secret)
+            o_client = tweepy.API(o_auth, timeout=http_client.get_timeout()[1])
+            # tweepy creates its own session, we replace it with the shared one to reuse the connections
+            o_client.session = http_client.get_session()
+            _do_CLIENTS[tu_key] = o_client
+
+    return o_client
+
+
+def _get_account(ptu_credentials=None):
+    """
+    Function to get the Twitter client of an account.
+
+    :param ptu_credentials: Tuple with consumer key, consumer secret, access token and access token secret. If not
+                            specified, the account configured in the constants file is used.
+    :type ptu_credentials: Tuple[Str, Str, Str, Str]
+
+    :rtype: tweepy.API
+    """
+    if ptu_credentials is None:
+        ptu_credentials = (cons.s_TW_CONSUMER_KEY, cons.s_TW_CONSUMER_SECRET,
+                           cons.s_TW_ACCESS_TOKEN, cons.s_TW_ACCESS_TOKEN_SECRET)
+
+    return _get_client(*ptu_credentials)
+
+
+def _classify_error(po_exception):
+    """
+    Function to decide whether a failed Twitter request can be retried (see retry.call()). Server errors, "429 Too Many
+    Requests" and connection problems (connection errors and timeouts) are retried.
+
+    :param po_exception:
+    :type po_exception: Exception
+
+    :return: Tuple with a boolean (whether the request can be retried) and the number of seconds Twitter asked us to
+             wait (None when unknown).
+    :rtype: Tuple[Bool, Union[Float, None]]
+    """
+    if isinstance(po_exception, (tweepy.errors.TwitterServerError, tweepy.errors.TooManyRequests)):
+        return True, retry.get_rate_limit_wait(po_exception.response.headers)
+
+    if isinstance(po_exception, tweepy.errors.HTTPException):
+        return False, None
+
+    # Other tweepy exceptions are raised when the request couldn't be sent at all (wrapping the error of requests, without
+    # "from", so it's only available as the context), or for errors that won't go away (e.g. "Authentication required!")
+    if isinstance(po_exception, tweepy.errors.TweepyException):
+        o_cause = po_exception.__cause__ or po_exception.__context__
+        if o_cause is not None:
+            return http_client.classify_error(o_cause)
+
+    return False, None
+
+
+@metrics.timer('twitter_upload')
+def _upload_image(pb_image, pu_name='cover.jpg', ptu_credentials=None):
+    """
+    Function to upload an image to Twitter, without retries. See upload_image().
+    """
+    o_media_file = _get_account(ptu_credentials).media_upload(filename=pu_name, file=io.BytesIO(pb_image))
+    return o_media_file.media_id
+
+
+def _fit_image(pb_image):
+    """
+    Function to adapt an image to the size limits of Twitter (see images.fit_image()), just before uploading it.
+    """
+    b_image = images.fit_image(pb_image,
+                               pi_size=cons.i_TW_IMAGE_SIZE,
+                               pi_max_bytes=cons.i_TW_IMAGE_BYTES,
+                               pi_quality=cons.i_IMAGE_QUALITY)
+    metrics.count('upload_bytes', len(b_image))
+    return b_image
+
+
+def _upload_fitted_image(pb_image, pu_name='cover.jpg', ptu_credentials=None):
+    """
+    Function to upload an image already adapted to the size limits of Twitter. The upload is retried on its own, and
+    its failures count against the upload host (see retry.call()), not against the host where tweets are posted.
+    """
+    f_upload = functools.partial(_upload_image, pb_image=pb_image, pu_name=pu_name, ptu_credentials=ptu_credentials)
+    return retry.call(f_upload,
+                      pu_host=_get_account(ptu_credentials).upload_host,
+                      pf_classify=_classify_error,
+                      pi_tries=cons.i_MSG_RETRIES,
+                      pf_delay=cons.i_MSG_DELAY)
+
+
+def upload_image(pb_image, pu_name='cover.jpg', ptu_credentials=None):
+    """
+    Function to upload an image to Twitter, so it can be attached to a tweet later (see tweet()). The image is adapted
+    first to the size limits of Twitter (see images.fit_image()).
+
+    :param pb_image: Data of the image.
+    :type pb_image: Bytes
+
+    :param pu_name: Name of the file. Tweepy only uses it to guess the mime type, the data is read from pb_image.
+    :type pu_name: Str
+
+    :param ptu_credentials: Credentials of the account, see _get_account().
+    :type ptu_credentials: Tuple[Str, Str, Str, Str]
+
+    :return: The id of the uploaded media.
+    :rtype: Int
+    """
+    return _upload_fitted_image(_fit_image(pb_image), pu_name=pu_name, ptu_credentials=ptu_credentials)
+
+
+def _upload_images(plb_images, ptu_credentials=None):
+    """
+    Function to upload images in parallel, each one with its own retries (see _upload_fitted_image()).
+
+    :param plb_images: Data of the images, already adapted to the size limits of Twitter.
+    :type plb_images: List[Bytes]
+
+    :param ptu_credentials: Credentials of the account, see _get_account().
+    :type ptu_credentials: Tuple[Str, Str, Str, Str]
+
+    :return: The ids of the uploaded media, in the same order as the images.
+    :rtype: List[Int]
+
+    :raises Exception: The exception raised by the first failed upload, if any.
+    """
+    if not plb_images:
+        return []
+
+    lu_names = ['cover_%s.jpg' % i_image for i_image in range(1, len(plb_images) + 1)]
+    f_upload = functools.partial(_upload_fitted_image, ptu_credentials=ptu_credentials)
+    i_workers = min(cons.i_UPLOAD_WORKERS, len(plb_images))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=i_workers) as o_executor:
+        # map() keeps the order of the images
+        return list(o_executor.map(f_upload, plb_images, lu_names))
+
+
+def tweet(pu_text, plb_images=(), pli_media_ids=(), ptu_credentials=None):
     """
 
     :param pu_text:
 
-    :param plu_images: List of images to be attached to the post
-    :type plu_images: List[Str[
+    :param plb_images: List with the data of the images to be attached to the post
+    :type plb_images: List[Bytes]
+
+    :param pli_media_ids: List with the ids of images already uploaded (see upload_image()). They are attached before
+                          the ones in plb_images.
+    :type pli_media_ids: List[Int]
+
+    :param ptu_credentials: Credentials of the account, see _get_account().
+    :type ptu_credentials: Tuple[Str, Str, Str, Str]
 
-    :return:
+    :return: The id of the tweet once it's posted, True in debug mode (nothing is posted), False when it couldn't be
+             posted.
+    :rtype: Union[Int, Bool]
     """
     # [0/?] Initialization
     #---------------------
-    b_tweeted = False
+    x_tweeted = False
 
     # [2/?] Actual tweet posting
     #---------------------------
     if cons.b_DEBUG:
-        b_tweeted = True
+        x_tweeted = True
 
     else:
         # [1/?] Authentication
         #---------------------
-        o_auth = tweepy.OAuthHandler(cons.s_TW_CONSUMER_KEY, cons.s_TW_CONSUMER_SECRET)
-        o_auth.set_access_token(cons.s_TW_ACCESS_TOKEN, cons.s_TW_ACCESS_TOKEN_SECRET)
-        o_twitter_account = tweepy.API(o_auth)
-
-        if plu_images:
-            for i_retry in range(cons.i_MSG_RETRIES):
-                try:
-                    li_media_ids = []
-                    for u_file in plu_images:
-                        o_media_file = o_twitter_account.media_upload(filename=u_file)
-                        li_media_ids.append(o_media_file.media_id)
-                    o_twitter_account.update_status(status=pu_text, media_ids=li_media_ids)
-                    b_tweeted = True
-                    break
-                except tweepy.errors.TwitterServerError:
-                    time.sleep(cons.i_MSG_DELAY)
-
-        else:
-            for i_retry in range(cons.i_MSG_RETRIES):
-                try:
-                    o_twitter_account.update_status(status=pu_text)
-                    b_tweeted = True
-                    break
-                except tweepy.errors.TwitterServerError:
-                    time.sleep(cons.i_MSG_DELAY)
-
-    return b_tweeted
+        o_twitter_account = _get_account(ptu_credentials)
+
+        # The images are uploaded (and retried) before posting, so a failed post doesn't upload them again
+        lb_images = [_fit_image(b_image) for b_image in plb_images]
+
+        def _post(pli_all_media_ids):
+            with metrics.timer('twitter_post'):
+                if pli_all_media_ids:
+                    return o_twitter_account.update_status(status=pu_text, media_ids=pli_all_media_ids)
+                return o_twitter_account.update_status(status=pu_text)
+
+        try:
+            li_media_ids = list(pli_media_ids) + _upload_images(lb_images, ptu_credentials)
+            o_status = retry.call(functools.partial(_post, li_media_ids),
+                                  pu_host=o_twitter_account.host,
+                                  pf_classify=_classify_error,
+                                  pi_tries=cons.i_MSG_RETRIES,
+                                  pf_delay=cons.i_MSG_DELAY)
+            x_tweeted = o_status.id
+        except (tweepy.errors.TwitterServerError, tweepy.errors.TooManyRequests, retry.CircuitOpenError):
+            pass
+        except tweepy.errors.BadRequest:
+            raise AuthenticationError('Wrong Twitter authentication keys.') from None
+
+    return x_tweeted
@@ -0,0 +1,130 @@
+"""
+Library with the configuration of the users whose reports are published. By default there is a single user configured
+with the environment variables (see cons.py), but a list of users can be provided to run in batch mode.
+"""
+
+import json
+
+from . import cons
+
+
+class User:
+    """
+    Class to store the configuration of a user: ListenBrainz account, periods of the reports, locale and credentials of
+    the publishers.
+    """
+    def __init__(self):
+        self.u_lb_user = ''               # ListenBrainz user to get the most popular albums from
+        self.ls_periods = []              # Periods of the reports ('month', 'year'). Empty for the default ones
+        self.s_locale = cons.s_LOCALE     # Locale used to build the messages
+        self.s_ma_instance = ''           # Mastodon instance URL
+        self.s_ma_token = ''              # Mastodon token
+        self.s_tw_consumer_key = ''       # Twitter credentials
+        self.s_tw_consumer_secret = ''
+        self.s_tw_access_token = ''
+        self.s_tw_access_token_secret = ''
+        self.b_mastodon = False           # Whether the messages must be published in Mastodon
+        self.b_twitter = False            # Whether the messages must be published in Twitter
+
+    def __str__(self):
+        u_out = '<User>\n'
+        u_out += '  .u_lb_user:                %s\n' % self.u_lb_user
+        u_out += '  .ls_periods:               %s\n' % self.ls_periods
+        u_out += '  .s_locale:                 %s\n' % self.s_locale
+        u_out += '  .s_ma_instance:            %s\n' % self.s_ma_instance
+        u_out += '  .s_ma_token:               %s\n' % self.s_ma_token
+        u_out += '  .s_tw_consumer_key:        %s\n' % self.s_tw_consumer_key
+        u_out += '  .s_tw_consumer_secret:     %s\n' % self.s_tw_consumer_secret
+        u_out += '  .s_tw_access_token:        %s\n' % self.s_tw_access_token
+        u_out += '  .s_tw_access_token_secret: %s\n' % self.s_tw_access_token_secret
+        u_out += '  .b_mastodon:               %s\n' % self.b_mastodon
+        u_out += '  .b_twitter:                %s\n' % self.b_twitter
+        return u_out
+
+    def from_cons(self):
+        """
+        Method to populate the object from the environment variables read in the constants file.
+
+        :return: Nothing, the object will be populated
+        """
+        self.u_lb_user = cons.s_LB_USER
+        self.s_locale = cons.s_LOCALE
+        self.s_ma_instance = cons.s_MA_INSTANCE
+        self.s_ma_token = cons.s_MA_TOKEN
+        self.s_tw_consumer_key = cons.s_TW_CONSUMER_KEY
+        self.s_tw_consumer_secret = cons.s_TW_CONSUMER_SECRET
+        self.s_tw_access_token = cons.s_TW_ACCESS_TOKEN
+        self.s_tw_access_token_secret = cons.s_TW_ACCESS_TOKEN_SECRET
+        self.b_mastodon = cons.b_MASTODON
+        self.b_twitter = cons.b_TWITTER
+
+    def from_dict(self, pdx_data):
+        """
+        Method to populate the object from a dictionary (e.g. an entry of the users file). Keys are the same as the
+        environment variables, in lower case, plus "periods":
+
+            {"lb_user": "john", "periods": ["month"], "locale": "en_GB.UTF-8",
+             "ma_instance": "https://mastodon.social", "ma_token": "...",
+             "tw_consumer_key": "...", "tw_consumer_secret": "...", "tw_access_token": "...",
+             "tw_access_token_secret": "..."}
+
+        :param pdx_data:
+        :type pdx_data: Dict[Str, Union[Str, List[Str]]]
+
+        :return: Nothing, the object will be populated
+        """
+        self.u_lb_user = pdx_data['lb_user']
+        self.ls_periods = list(pdx_data.get('periods', []))
+        self.s_locale = pdx_data.get('locale', cons.s_LOCALE)
+        self.s_ma_instance = pdx_data.get('ma_instance', '')
+        self.s_ma_token = pdx_data.get('ma_token', '')
+        self.s_tw_consumer_key = pdx_data.get('tw_consumer_key', '')
+        self.s_tw_consumer_secret = pdx_data.get('tw_consumer_secret', '')
+        self.s_tw_access_token = pdx_data.get('tw_access_token', '')
+        self.s_tw_access_token_secret = pdx_data.get('tw_access_token_secret', '')
+        self.b_mastodon = '' not in (self.s_ma_instance, self.s_ma_token)
+        self.b_twitter = '' not in self.get_tw_credentials()
+
+        for s_period in self.ls_periods:
+            if s_period not in ('month', 'year'):
+                raise ValueError('Invalid period "%s" for user "%s", allowed values are "month", and "year"'
+                                 % (s_period, self.u_lb_user))
+
+    def get_tw_credentials(self):
+        """
+        Method to get the Twitter credentials of the user.
+
+        :return: Tuple with consumer key, consumer secret, access token and access token secret.
+        :rtype: Tuple[Str, Str, Str, Str]
+        """
+        return (self.s_tw_consumer_key, self.s_tw_consumer_secret,
+                self.s_tw_access_token, self.s_tw_access_token_secret)
+
+
+def get_users():
+    """
+    Function to get the users to process. When USERS_FILE or USERS are defined, the users are read from them (batch
+    mode). Otherwise, a single user configured with the environment variables is returned.
+
+    :return:
+    :rtype: List[users.User]
+    """
+    s_json = ''
+    if cons.s_USERS_FILE:
+        with open(cons.s_USERS_FILE, 'r', encoding='utf-8') as o_file:
+            s_json = o_file.read()
+    elif cons.s_USERS:
+        s_json = cons.s_USERS
+
+    lo_users = []
+    if s_json:
+        for dx_data in json.loads(s_json):
+            o_user = User()
+            o_user.from_dict(dx_data)
+            lo_users.append(o_user)
+    else:
+        o_user = User()
+        o_user.from_cons()
+        lo_users.append(o_user)
+
+    return lo_users
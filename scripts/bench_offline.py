@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the report pipeline: all the services are replaced by local fakes (see fake_services.py) with
+configurable latency, error rate and payload sizes, so runs are repeatable and don't need network access.
+
+For every LB_FETCH size, it measures the end-to-end latency, the requests received by each service and the peak memory
+(Python allocations) of:
+
+  - lb_mb_data.get_lb_releases(): a page of releases with their covers.
+  - _report(): the whole monthly report, published to Mastodon and Twitter.
+
+And, once, of mastodon.toot() and twitter.tweet() with LB_VERIFIED covers. Finally, a report is recorded to a cassette
+and replayed several times (see cassette.py), checking every replay sends the same messages as the recorded run.
+
+Usage: bench_offline.py [--fetch 5,10,25,50] [--runs 3] [--latency 0.02] [--error-rate 0] [--image-kb 100] ...
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fake_services
+
+# The program reads its configuration when imported, so the caches are disabled before. The processes of the cassette
+# check import this module too, but they keep the caches (see _check_cassette()).
+if __name__ == '__main__':
+    os.environ['CACHE_DIR'] = ''
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lbz_ma_tw'))
+
+import lbz_ma_tw
+import libs.cassette as cassette
+import libs.cons as cons
+import libs.lb_mb_data as lb_mb_data
+import libs.mastodon as mastodon
+import libs.retry as retry
+import libs.throttle as throttle
+import libs.twitter as twitter
+import libs.users as users
+
+
+ts_SERVICES = ('listenbrainz', 'musicbrainz', 'caa', 'images', 'mastodon', 'twitter')
+
+
+def _get_user():
+    """
+    Function to get a user publishing to both fake Mastodon and fake Twitter.
+    """
+    o_user = users.User()
+    o_user.from_dict({'lb_user': 'benchmark',
+                      'periods': ['month'],
+                      'locale': 'en_GB.UTF-8',
+                      'ma_instance': 'https://%s' % fake_services.s_MASTODON_HOST,
+                      'ma_token': 'benchmark',
+                      'tw_consumer_key': 'benchmark',
+                      'tw_consumer_secret': 'benchmark',
+                      'tw_access_token': 'benchmark',
+                      'tw_access_token_secret': 'benchmark'})
+    return o_user
+
+
+def _run_report():
+    """
+    Function to publish the report of the benchmark user, in a process configured by environment variables (see
+    _check_cassette()).
+    """
+    lbz_ma_tw._report(_get_user(), ps_period='month')
+    cassette.save_cassette()
+
+
+def _check_cassette(pdo_services, pi_replays, pb_async=False):
+    """
+    Function to record a report to a cassette and replay it several times, each run in its own process, so the cassette
+    mode is configured exactly as in production (by environment variables). The caches are left enabled, as in
+    production: the report is recorded with caches warmed by a previous run, and every replay starts with empty ones.
+
+    :return: Number of replays whose messages weren't sent the same way as in the recorded run, or that wrote anything to
+             their cache directory.
+    :rtype: Int
+    """
+    s_dir = os.path.dirname(os.path.abspath(__file__))
+    s_routes = ','.join('%s=%s' % tu_route for tu_route in fake_services.get_routes(pdo_services).items())
+    with tempfile.TemporaryDirectory() as s_tmp_dir:
+        ds_env = dict(os.environ, CASSETTE=os.path.join(s_tmp_dir, 'benchmark.cassette'), HTTP_ROUTES=s_routes,
+                      ASYNC='yes' if pb_async else 'no', MB_RATE='0', DL_DELAY='0', MSG_DELAY='0')
+        ds_env.pop('LEDGER', None)
+        ls_command = [sys.executable, '-c', 'import bench_offline; bench_offline._run_report()']
+
+        def _get_results(ps_mode, ps_cache_dir):
+            o_process = subprocess.run(ls_command, cwd=s_dir,
+                                       env=dict(ds_env, CASSETTE_MODE=ps_mode, CACHE_DIR=ps_cache_dir),
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            return o_process.returncode, [s_line for s_line in o_process.stdout.splitlines()
+                                          if s_line.startswith('Sending ')]
+
+        s_warm_dir = os.path.join(s_tmp_dir, 'warm')
+        _get_results('', s_warm_dir)
+        tx_recorded = _get_results('record', s_warm_dir)
+        if tx_recorded[0] or not tx_recorded[1] or any('DONE!' not in s_line for s_line in tx_recorded[1]):
+            raise RuntimeError('The report could not be recorded: %s' % (tx_recorded,))
+
+        i_mismatches = 0
+        for i_replay in range(pi_replays):
+            s_empty_dir = os.path.join(s_tmp_dir, 'replay%s' % i_replay)
+            if _get_results('replay', s_empty_dir) != tx_recorded or os.path.exists(s_empty_dir):
+                i_mismatches += 1
+
+        return i_mismatches
+
+
+def _reset_state():
+    """
+    Function to forget the state kept between requests (rate limiters and circuit breakers), so every run starts the
+    same way. Connection pools are kept, like in a real process.
+    """
+    retry._do_BREAKERS.clear()
+    throttle._do_HOST_LIMITERS.clear()
+
+
+def _measure(pf_function, pdo_services, pi_runs):
+    """
+    Function to measure a function: latency of every run, requests per service (of a single run) and peak memory (in an
+    extra run, since tracemalloc slows everything down).
+
+    :return: Dictionary with the measures.
+    :rtype: Dict
+    """
+    lf_times = []
+    di_requests = {}
+    di_errors = {}
+    for i_run in range(pi_runs):
+        _reset_state()
+        ddi_before = {s_name: o_service.get_counters() for s_name, o_service in pdo_services.items()}
+        f_start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            pf_function()
+        lf_times.append(time.perf_counter() - f_start)
+        if i_run == 0:
+            for s_name, o_service in pdo_services.items():
+                di_after = o_service.get_counters()
+                di_requests[s_name] = di_after['requests'] - ddi_before[s_name]['requests']
+                di_errors[s_name] = di_after['errors'] - ddi_before[s_name]['errors']
+
+    _reset_state()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pf_function()
+    i_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'median_ms': statistics.median(lf_times) * 1000,
+            'min_ms': min(lf_times) * 1000,
+            'requests': di_requests,
+            'errors': di_errors,
+            'peak_kib': i_peak / 1024}
+
+
+def _print_row(ps_benchmark, px_fetch, pdx_result):
+    s_requests = ' '.join('%5s' % pdx_result['requests'][s_name] for s_name in ts_SERVICES)
+    print('%-16s %5s %10.1f %10.1f  %s %7s %9.0f' % (ps_benchmark, px_fetch, pdx_result['median_ms'],
+                                                     pdx_result['min_ms'], s_requests,
+                                                     sum(pdx_result['errors'].values()), pdx_result['peak_kib']))
+
+
+def main():
+    o_parser = argparse.ArgumentParser(description='Offline benchmark of lbz_ma_tw against local fake services.')
+    o_parser.add_argument('--fetch', default='5,10,25,50', help='LB_FETCH sizes, comma separated (default 5,10,25,50).')
+    o_parser.add_argument('--verified', type=int, default=cons.i_LB_VERIFIED, help='LB_VERIFIED (default %(default)s).')
+    o_parser.add_argument('--runs', type=int, default=3, help='Runs of every benchmark (default 3).')
+    o_parser.add_argument('--latency', type=float, default=0.02, help='Latency of the services in seconds '
+                                                                      '(default %(default)s).')
+    o_parser.add_argument('--error-rate', type=float, default=0.0, help='Ratio of requests failing with 503 '
+                                                                        '(default 0).')
+    o_parser.add_argument('--image-kb', type=int, default=100, help='Size of the cover images in KiB (default 100).')
+    o_parser.add_argument('--releases', type=int, default=200, help='Releases of the user in ListenBrainz '
+                                                                    '(default 200).')
+    o_parser.add_argument('--unverified', type=float, default=0.3, help='Ratio of releases without MusicBrainz id '
+                                                                        '(default 0.3).')
+    o_parser.add_argument('--mb-rate', type=float, default=0.0, help='MB_RATE, requests per second to MusicBrainz '
+                                                                     '(default 0, no limit).')
+    o_parser.add_argument('--async', dest='b_async', action='store_true', help='Use the asynchronous mode.')
+    o_parser.add_argument('--replays', type=int, default=5, help='Replays of the recorded cassette (default '
+                                                                 '%(default)s).')
+    o_parser.add_argument('--json', default='', help='File where the results are written as JSON.')
+    o_args = o_parser.parse_args()
+
+    do_services = fake_services.start_all(pf_latency=o_args.latency,
+                                          pf_error_rate=o_args.error_rate,
+                                          pi_image_size=o_args.image_kb * 1024,
+                                          pi_releases=o_args.releases,
+                                          pf_unverified=o_args.unverified)
+    cons.ds_HTTP_ROUTES = fake_services.get_routes(do_services)
+    cons.s_CACHE_DIR = ''
+    cons.i_LB_VERIFIED = o_args.verified
+    cons.f_MB_RATE = o_args.mb_rate
+    cons.b_ASYNC = o_args.b_async
+    # Injected errors are retried quickly, the benchmark measures the pipeline, not the backoff
+    cons.i_DL_DELAY = 0.01
+    cons.i_MSG_DELAY = 0.01
+
+    o_user = _get_user()
+    dx_results = {'arguments': vars(o_args), 'benchmarks': []}
+
+    print('%-16s %5s %10s %10s  %s %7s %9s' % ('benchmark', 'fetch', 'median ms', 'min ms',
+                                               ' '.join('%5s' % s_name[:5] for s_name in ts_SERVICES),
+                                               'errors', 'peak KiB'))
+    for i_fetch in [int(s_fetch) for s_fetch in o_args.fetch.split(',')]:
+        cons.i_LB_FETCH = i_fetch
+        for s_benchmark, f_benchmark in (('get_lb_releases', lambda: lb_mb_data.get_lb_releases(
+                                              pu_user=o_user.u_lb_user, pi_count=i_fetch, pu_time_range='month')),
+                                         ('_report', lambda: lbz_ma_tw._report(o_user, ps_period='month'))):
+            dx_result = _measure(f_benchmark, do_services, o_args.runs)
+            _print_row(s_benchmark, i_fetch, dx_result)
+            dx_results['benchmarks'].append(dict(dx_result, benchmark=s_benchmark, fetch=i_fetch))
+
+    lb_covers = [do_services['images'].b_image] * cons.i_LB_VERIFIED
+    for s_benchmark, f_benchmark in (('mastodon.toot', lambda: mastodon.toot('Benchmark', plb_images=lb_covers,
+                                                                               ps_instance=o_user.s_ma_instance,
+                                                                               ps_token=o_user.s_ma_token)),
+                                     ('twitter.tweet', lambda: twitter.tweet('Benchmark', plb_images=lb_covers,
+                                                                             ptu_credentials=o_user.get_tw_credentials()))):
+        dx_result = _measure(f_benchmark, do_services, o_args.runs)
+        _print_row(s_benchmark, '-', dx_result)
+        dx_results['benchmarks'].append(dict(dx_result, benchmark=s_benchmark, fetch=None))
+
+    i_mismatches = _check_cassette(do_services, o_args.replays, pb_async=o_args.b_async)
+    print('\nCassette: %s replays, %s different from the recorded run' % (o_args.replays, i_mismatches))
+    dx_results['cassette'] = {'replays': o_args.replays, 'mismatches': i_mismatches}
+
+    for o_service in do_services.values():
+        o_service.stop()
+
+    if o_args.json:
+        with open(o_args.json, 'w', encoding='utf-8') as o_file:
+            json.dump(dx_results, o_file, indent=2)
+
+    return 1 if i_mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: time from launching the interpreter until lbz_ma_tw.py sends its first request (to ListenBrainz).
+
+A local HTTP server replaces ListenBrainz; it answers "no content" so the program exits right after the first request
+without contacting any other service. The script fails (exit code 1) when the median time is above the budget.
+
+Usage: bench_startup.py [--runs N] [--budget SECONDS] [--mastodon] [--twitter]
+"""
+
+import argparse
+import http.server
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+
+u_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lbz_ma_tw', 'lbz_ma_tw.py')
+
+
+class _FirstRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handler storing the moment the first request of each run arrives.
+    """
+    f_first = None
+
+    def do_GET(self):
+        if _FirstRequestHandler.f_first is None:
+            _FirstRequestHandler.f_first = time.perf_counter()
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *px_args):
+        pass
+
+
+def _get_env(pu_root, pb_mastodon, pb_twitter):
+    """
+    Function to build the environment of the benchmarked program.
+    """
+    ds_env = dict(os.environ)
+    ds_env.update({'LB_API_ROOT': pu_root,
+                   'LB_USER': 'benchmark',
+                   'CACHE_DIR': '',
+                   'MA_INSTANCE': pu_root if pb_mastodon else '',
+                   'MA_TOKEN': 'benchmark' if pb_mastodon else '',
+                   'DAEMON': 'False'})
+    for s_var in ('TW_CONSUMER_KEY', 'TW_CONSUMER_SECRET', 'TW_ACCESS_TOKEN', 'TW_ACCESS_TOKEN_SECRET'):
+        ds_env[s_var] = 'benchmark' if pb_twitter else ''
+    for s_var in ('USERS', 'USERS_FILE'):
+        ds_env.pop(s_var, None)
+    return ds_env
+
+
+def main():
+    o_parser = argparse.ArgumentParser(description='Startup time benchmark of lbz_ma_tw.py.')
+    o_parser.add_argument('--runs', type=int, default=5, help='Number of runs (default 5).')
+    o_parser.add_argument('--budget', type=float, default=1.0, help='Maximum median time in seconds (default 1.0).')
+    o_parser.add_argument('--mastodon', action='store_true', help='Enable the Mastodon publisher.')
+    o_parser.add_argument('--twitter', action='store_true', help='Enable the Twitter publisher.')
+    o_args = o_parser.parse_args()
+
+    o_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _FirstRequestHandler)
+    threading.Thread(target=o_server.serve_forever, daemon=True).start()
+    u_root = 'http://127.0.0.1:%s' % o_server.server_address[1]
+    ds_env = _get_env(u_root, o_args.mastodon, o_args.twitter)
+
+    lf_times = []
+    for i_run in range(o_args.runs):
+        _FirstRequestHandler.f_first = None
+        f_start = time.perf_counter()
+        # Whatever happens after the first request is not measured
+        subprocess.run([sys.executable, u_MAIN], env=ds_env, stdout=subprocess.DEVNULL, check=False)
+        if _FirstRequestHandler.f_first is None:
+            print('Run %s: no request received' % (i_run + 1))
+            return 1
+        lf_times.append(_FirstRequestHandler.f_first - f_start)
+        print('Run %s: %.3f s' % (i_run + 1, lf_times[-1]))
+
+    o_server.shutdown()
+
+    f_median = statistics.median(lf_times)
+    b_ok = f_median <= o_args.budget
+    print('Median: %.3f s (min %.3f s), budget %.3f s... %s' % (f_median, min(lf_times), o_args.budget,
+                                                                 'OK' if b_ok else 'OVER BUDGET!'))
+    return 0 if b_ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,362 @@
+"""
+Local stand-ins of the services used by lbz_ma_tw (ListenBrainz, MusicBrainz, Cover Art Archive, the cover image host,
+Mastodon and Twitter), for offline benchmarks. Every service runs its own HTTP server, with configurable latency, error rate and
+payload sizes, and counts the requests it receives.
+
+The program reaches them through HTTP_ROUTES (see cons.ds_HTTP_ROUTES), so the real host names are still used for rate
+limits and circuit breakers, see get_routes().
+"""
+
+import hashlib
+import http.server
+import io
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+
+# Host names of the real services
+s_LB_HOST = 'api.listenbrainz.org'
+s_MB_HOST = 'musicbrainz.org'
+s_CAA_HOST = 'coverartarchive.org'
+s_IMAGE_HOST = 'archive.org'
+s_MASTODON_HOST = 'mastodon.example'
+ts_TWITTER_HOSTS = ('api.twitter.com', 'upload.twitter.com')
+
+
+def _build_image(pi_size):
+    """
+    Function to build a valid JPEG image of (at least) pi_size bytes. Decoders ignore the padding after the end of the
+    image, so the image is small to decode but as big as needed to transfer.
+    """
+    import PIL.Image
+
+    o_buffer = io.BytesIO()
+    PIL.Image.new('RGB', (500, 500), (30, 120, 60)).save(o_buffer, format='JPEG')
+    b_image = o_buffer.getvalue()
+    return b_image + b'\0' * max(0, pi_size - len(b_image))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Request handler dispatching to the service owning the server. Keep-alive connections are supported, like in the
+    real services.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *px_args):
+        pass
+
+    def _handle(self, ps_method):
+        o_service = self.server.o_service
+        i_length = int(self.headers.get('Content-Length', 0))
+        b_body = self.rfile.read(i_length) if i_length else b''
+
+        o_url = urllib.parse.urlsplit(self.path)
+        dx_query = dict(urllib.parse.parse_qsl(o_url.query))
+        i_status, dx_headers, b_data = o_service.answer(ps_method, o_url.path, dx_query, b_body)
+
+        self.send_response(i_status)
+        for s_header, s_value in dx_headers.items():
+            self.send_header(s_header, s_value)
+        self.send_header('Content-Length', str(len(b_data)))
+        self.end_headers()
+        self.wfile.write(b_data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class FakeService:
+    """
+    Base class of the fake services. Subclasses implement _answer().
+    """
+    s_NAME = ''
+
+    def __init__(self, pf_latency=0.0, pf_error_rate=0.0, pi_seed=0):
+        """
+        :param pf_latency: Seconds waited before answering every request.
+        :type pf_latency: Float
+
+        :param pf_error_rate: Ratio (0-1) of requests answered with "503 Service Unavailable".
+        :type pf_error_rate: Float
+
+        :param pi_seed: Seed of the random errors, so runs are repeatable.
+        :type pi_seed: Int
+        """
+        self.f_latency = pf_latency
+        self.f_error_rate = pf_error_rate
+        self.i_requests = 0
+        self.i_errors = 0
+        self.i_bytes = 0
+        self._o_random = random.Random(pi_seed)
+        self._o_lock = threading.Lock()
+        self._o_server = None
+        self.u_root = ''
+
+    def start(self):
+        """
+        Method to start the server in a background thread.
+
+        :return: Root URL of the server, e.g. "http://127.0.0.1:12345".
+        :rtype: Str
+        """
+        self._o_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._o_server.daemon_threads = True
+        self._o_server.o_service = self
+        threading.Thread(target=self._o_server.serve_forever, name='fake-%s' % self.s_NAME, daemon=True).start()
+        self.u_root = 'http://127.0.0.1:%s' % self._o_server.server_address[1]
+        return self.u_root
+
+    def stop(self):
+        self._o_server.shutdown()
+        self._o_server.server_close()
+
+    def get_counters(self):
+        """
+        :return: Dictionary with the number of requests, injected errors and bytes sent.
+        :rtype: Dict[Str, Int]
+        """
+        with self._o_lock:
+            return {'requests': self.i_requests, 'errors': self.i_errors, 'bytes': self.i_bytes}
+
+    def answer(self, ps_method, ps_path, pdx_query, pb_body):
+        if self.f_latency > 0:
+            time.sleep(self.f_latency)
+
+        with self._o_lock:
+            self.i_requests += 1
+            b_error = self._o_random.random() < self.f_error_rate
+            if b_error:
+                self.i_errors += 1
+
+        if b_error:
+            i_status, dx_headers, b_data = 503, {}, b''
+        else:
+            i_status, dx_headers, b_data = self._answer(ps_method, ps_path, pdx_query, pb_body)
+
+        with self._o_lock:
+            self.i_bytes += len(b_data)
+        return i_status, dx_headers, b_data
+
+    def _answer(self, ps_method, ps_path, pdx_query, pb_body):
+        raise NotImplementedError
+
+    @staticmethod
+    def _json(px_data, pi_status=200):
+        return pi_status, {'Content-Type': 'application/json'}, json.dumps(px_data).encode('utf-8')
+
+
+class ListenBrainz(FakeService):
+    """
+    ListenBrainz statistics API: /1/stats/user/<user>/releases. The releases of a user are always the same, and a share
+    of them have no MusicBrainz id (unverified) or repeat the id of a previous one.
+    """
+    s_NAME = 'listenbrainz'
+
+    def __init__(self, pi_releases=200, pf_unverified=0.3, pf_duplicated=0.05, **dx_kwargs):
+        super().__init__(**dx_kwargs)
+        self.ldx_releases = []
+        for i_release in range(pi_releases):
+            u_mbid = _get_mbid(i_release)
+            f_random = self._o_random.random()
+            if f_random < pf_unverified:
+                u_mbid = ''
+            elif f_random < pf_unverified + pf_duplicated and i_release:
+                u_mbid = _get_mbid(i_release - 1)
+            self.ldx_releases.append({'artist_mbids': [],
+                                      'artist_msid': '',
+                                      'artist_name': 'Artist %s' % i_release,
+                                      'listen_count': 1000 - i_release,
+                                      'release_mbid': u_mbid,
+                                      'release_msid': '',
+                                      'release_name': 'Release %s' % i_release})
+
+    def _answer(self, ps_method, ps_path, pdx_query, pb_body):
+        o_match = re.match(r'/1/stats/user/([^/]+)/releases$', ps_path)
+        if ps_method != 'GET' or not o_match:
+            return self._json({'error': 'Not found'}, 404)
+
+        i_offset = int(pdx_query.get('offset', 0))
+        i_count = int(pdx_query.get('count', 25))
+        return self._json({'payload': {'releases': self.ldx_releases[i_offset:i_offset + i_count],
+                                       'total_release_count': len(self.ldx_releases),
+                                       'user_id': o_match.group(1),
+                                       'range': pdx_query.get('range', 'all_time')}})
+
+
+def _get_mbid(pi_release):
+    """
+    Function to get a fake (but well-formed) MusicBrainz id of a release.
+    """
+    s_hash = hashlib.md5(str(pi_release).encode('ascii')).hexdigest()
+    return '%s-%s-%s-%s-%s' % (s_hash[:8], s_hash[8:12], s_hash[12:16], s_hash[16:20], s_hash[20:])
+
+
+def _has_cover(pu_mbid, pf_no_cover):
+    """
+    Function to decide whether a release has artwork. The same release always gets the same answer, so MusicBrainz and
+    Cover Art Archive agree.
+    """
+    return int(pu_mbid[:8], 16) / 0xffffffff >= pf_no_cover
+
+
+class MusicBrainz(FakeService):
+    """
+    MusicBrainz release search by id: /ws/2/release?query=reid:(<mbid> OR <mbid>...). The cover art flags of every
+    release agree with CoverArtArchive.
+    """
+    s_NAME = 'musicbrainz'
+
+    def __init__(self, pf_no_cover=0.1, **dx_kwargs):
+        super().__init__(**dx_kwargs)
+        self.f_no_cover = pf_no_cover
+
+    def _answer(self, ps_method, ps_path, pdx_query, pb_body):
+        o_match = re.match(r'reid:\((.*)\)$', pdx_query.get('query', ''))
+        if ps_method != 'GET' or ps_path != '/ws/2/release' or not o_match:
+            return self._json({'error': 'Not found'}, 404)
+
+        ldx_releases = []
+        for u_mbid in o_match.group(1).split(' OR '):
+            b_cover = _has_cover(u_mbid, self.f_no_cover)
+            ldx_releases.append({'id': u_mbid,
+                                 'score': 100,
+                                 'cover-art-archive': {'artwork': b_cover, 'front': b_cover, 'back': b_cover,
+                                                       'count': 2 if b_cover else 0, 'darkened': False}})
+        return self._json({'count': len(ldx_releases), 'offset': 0, 'releases': ldx_releases})
+
+
+class CoverArtArchive(FakeService):
+    """
+    Cover Art Archive: /release/<mbid>. A share of the releases have no artwork (404); the rest have a front cover and a
+    back cover, whose images are in the image host.
+    """
+    s_NAME = 'caa'
+
+    def __init__(self, pf_no_cover=0.1, **dx_kwargs):
+        super().__init__(**dx_kwargs)
+        self.f_no_cover = pf_no_cover
+
+    def _answer(self, ps_method, ps_path, pdx_query, pb_body):
+        o_match = re.match(r'/release/([0-9a-f-]+)$', ps_path)
+        if ps_method != 'GET' or not o_match:
+            return self._json({}, 404)
+
+        u_mbid = o_match.group(1)
+        if not _has_cover(u_mbid, self.f_no_cover):
+            return 404, {}, b''
+
+        ldx_images = []
+        for i_image, s_type in enumerate(('Front', 'Back')):
+            u_root = 'https://%s/download/mbid-%s/%s' % (s_IMAGE_HOST, u_mbid, i_image)
+            ldx_images.append({'approved': True,
+                               'back': s_type == 'Back',
+                               'comment': '',
+                               'edit': 1,
+                               'front': s_type == 'Front',
+                               'id': i_image,
+                               'image': u_root + '.jpg',
+                               'thumbnails': {s_size: '%s-%s.jpg' % (u_root, s_size)
+                                              for s_size in ('250', '500', '1200', 'small', 'large')},
+                               'types': [s_type]})
+        return self._json({'images': ldx_images, 'release': 'https://musicbrainz.org/release/%s' % u_mbid})
+
+
+class ImageHost(FakeService):
+    """
+    Host of the cover images: every path is a JPEG image of the configured size.
+    """
+    s_NAME = 'images'
+
+    def __init__(self, pi_image_size=100 * 1024, **dx_kwargs):
+        super().__init__(**dx_kwargs)
+        self.b_image = _build_image(pi_image_size)
+
+    def _answer(self, ps_method, ps_path, pdx_query, pb_body):
+        return 200, {'Content-Type': 'image/jpeg'}, self.b_image
+
+
+class Mastodon(FakeService):
+    """
+    Mastodon API: instance information, media uploads and statuses.
+    """
+    s_NAME = 'mastodon'
+
+    def __init__(self, **dx_kwargs):
+        super().__init__(**dx_kwargs)
+        self._o_ids = itertools.count(1)
+
+    def _answer(self, ps_method, ps_path, pdx_query, pb_body):
+        if ps_method == 'GET' and re.match(r'/api/v[12]/instance/?$', ps_path):
+            return self._json({'uri': s_MASTODON_HOST, 'title': 'Fake', 'version': '4.2.0'})
+        if ps_method == 'POST' and re.match(r'/api/v[12]/media$', ps_path):
+            return self._json({'id': str(next(self._o_ids)), 'type': 'image', 'url': None})
+        if ps_method == 'POST' and ps_path == '/api/v1/statuses':
+            return self._json({'id': str(next(self._o_ids)), 'content': '', 'media_attachments': []})
+        return self._json({'error': 'Not found'}, 404)
+
+
+class Twitter(FakeService):
+    """
+    Twitter API v1.1: media uploads and status updates (both api.twitter.com and upload.twitter.com).
+    """
+    s_NAME = 'twitter'
+
+    def __init__(self, **dx_kwargs):
+        super().__init__(**dx_kwargs)
+        self._o_ids = itertools.count(1)
+
+    def _answer(self, ps_method, ps_path, pdx_query, pb_body):
+        if ps_method == 'POST' and ps_path == '/1.1/media/upload.json':
+            i_id = next(self._o_ids)
+            return self._json({'media_id': i_id, 'media_id_string': str(i_id), 'size': len(pb_body)})
+        if ps_method == 'POST' and ps_path == '/1.1/statuses/update.json':
+            i_id = next(self._o_ids)
+            return self._json({'id': i_id, 'id_str': str(i_id), 'text': ''})
+        return self._json({'errors': [{'code': 34, 'message': 'Not found'}]}, 404)
+
+
+def start_all(pf_latency=0.0, pf_error_rate=0.0, pi_image_size=100 * 1024, pi_releases=200, pf_unverified=0.3):
+    """
+    Function to start all the fake services.
+
+    :return: Dictionary with the services, by name.
+    :rtype: Dict[Str, FakeService]
+    """
+    dx_common = {'pf_latency': pf_latency, 'pf_error_rate': pf_error_rate}
+    do_services = {'listenbrainz': ListenBrainz(pi_releases=pi_releases, pf_unverified=pf_unverified, **dx_common),
+                   'musicbrainz': MusicBrainz(**dx_common),
+                   'caa': CoverArtArchive(**dx_common),
+                   'images': ImageHost(pi_image_size=pi_image_size, **dx_common),
+                   'mastodon': Mastodon(**dx_common),
+                   'twitter': Twitter(**dx_common)}
+    for o_service in do_services.values():
+        o_service.start()
+    return do_services
+
+
+def get_routes(pdo_services):
+    """
+    Function to get the routes from the real hosts to the fake services (see cons.ds_HTTP_ROUTES).
+
+    :param pdo_services: See start_all().
+    :type pdo_services: Dict[Str, FakeService]
+
+    :rtype: Dict[Str, Str]
+    """
+    ds_routes = {s_LB_HOST: pdo_services['listenbrainz'].u_root,
+                 s_MB_HOST: pdo_services['musicbrainz'].u_root,
+                 s_CAA_HOST: pdo_services['caa'].u_root,
+                 s_IMAGE_HOST: pdo_services['images'].u_root,
+                 s_MASTODON_HOST: pdo_services['mastodon'].u_root}
+    for s_host in ts_TWITTER_HOSTS:
+        ds_routes[s_host] = pdo_services['twitter'].u_root
+    return ds_routes
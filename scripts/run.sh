@@ -10,14 +10,23 @@ echo "#                      |_|             |_|                   #"
 echo '##############################################################'
 echo ""
 
-VER=$(python -c "import sys;sys.path.append('/app/lbz_ma_tw/');import libs.cons as cons;print(cons.s_VER)")
+# The version is read straight from the constants file, starting a Python interpreter just for it is too slow
+VER=$(sed -n "s/^s_VER = '\(.*\)'.*/\1/p" /app/lbz_ma_tw/libs/cons.py)
 
 echo "Starting zipzop/lbz_ma_tw:$VER"
 echo "=============================================================="
 
+export PYTHONUNBUFFERED=1
+
+# In daemon mode the program keeps running and follows the schedule by itself
+case $(echo "$DAEMON" | tr '[:upper:]' '[:lower:]') in
+  1|true|on|yes|y)
+    exec python /app/lbz_ma_tw/lbz_ma_tw.py
+    ;;
+esac
+
 # Copying cron template with proper value
 sed -e "s|%H%|$MSG_HOUR|" /app/config/lbz_ma_tw.tpl > /app/config/lbz_ma_tw.cron
 
 # Finally we launch the cron
-export PYTHONUNBUFFERED=1
 supercronic -quiet -passthrough-logs /app/config/lbz_ma_tw.cron
\ No newline at end of file